@@ -1,17 +1,19 @@
+import asyncio
 import json
-import time
 import argparse
 import logging
 
 
-from lib import get_module_logger, update_transaction_id
-from lib import TradingEngine, PaperExchange, BitFlyerExchange, products_from_config
+from lib import get_module_logger
+from lib.history import INTERVAL_SECONDS
+from lib import TradingEngine, EngineRunner, CandleSchedule, PaperExchange, BitFlyerExchange, \
+    products_from_config
 
 
 logger = get_module_logger()
 
 
-def main(config, use_bitflyer, threshold, wait_time, dryrun):
+def main(config, use_bitflyer, threshold, wait_time, dryrun, align=False, settle=5.0, light=0):
     logger.info('start trade program')
 
     trading_config = config.get('trading') or {}
@@ -36,29 +38,25 @@ def main(config, use_bitflyer, threshold, wait_time, dryrun):
     logger.info(f'trading products: {[spec.name for spec in products]}')
 
     # Event loop
+    # 銘柄ごとのエンジンを並行に動かす（1銘柄のAPIの遅れが他の銘柄の判断を遅らせない）
     logger.info('start event loop')
-    while True:
-        # 予期せぬエラーで停止されると困るのでtryでくくる
-        try:
-            # 取引ごとにログを追えるようにトランザクションIDを更新する
-            update_transaction_id()
-
-            for engine in engines:
-                logger.debug(f'start trade cycle: {engine.spec.name}')
-                engine.step()
-                logger.debug(f'end trade cycle: {engine.spec.name}')
-
-        except Exception as e:
-            # 予期せぬエラーが発生したがそのままループを継続させる
-            logger.warning(f'unhandled error occurred. but keep event loop. error: {e}')
-
-        finally:
-            # APIリクエストの上限に注意して待機する
-            logger.debug(f'wait a {wait_time} sec')
-            try:
-                time.sleep(wait_time)
-            except Exception as time_error:
-                logger.warning(f'time.sleep() error occurred. error: {time_error}')
+    schedule = None
+    if align:
+        # 固定間隔ではなく足の確定に合わせて起きる（間は light 秒ごとにストップだけ確認する）
+        interval = INTERVAL_SECONDS.get(exchange.candle_interval)
+        if interval is None:
+            raise SystemExit(f'--align does not support candle-interval '
+                             f'{exchange.candle_interval!r} (use {" / ".join(INTERVAL_SECONDS)})')
+        schedule = CandleSchedule(interval, settle=settle, light=light or None)
+        logger.info(f'align cycles to {exchange.candle_interval} candle close '
+                    f'(settle={settle}s, light={light or "off"})')
+    runner = EngineRunner(engines, wait_time, schedule=schedule)
+    try:
+        asyncio.run(runner.run())
+    except KeyboardInterrupt:
+        logger.info('stop event loop')
+    finally:
+        exchange.close()
 
 
 if __name__ == '__main__':
@@ -69,6 +67,9 @@ if __name__ == '__main__':
     group.add_argument("--bitflyer", help="use bitflyer market (real trading)", action="store_true")
     parser.add_argument("-t", "--threshold", help="(deprecated) kept for compatibility", type=float, default=None)
     parser.add_argument("-w", "--wait", help="set sleep time (default 60 seconds)", type=int, default=60)
+    parser.add_argument("--align", help="wake just after each candle close instead of every --wait seconds", action="store_true")
+    parser.add_argument("--settle", help="seconds to wait after a candle close (with --align, default 5)", type=float, default=5.0)
+    parser.add_argument("--light", help="check stops every N seconds between candle closes (with --align, default off)", type=float, default=0)
     parser.add_argument("-v", "--verbosity", help="increase output verbosity", action="store_true")
     parser.add_argument("--dryrun", help="Do only check. Do NOT execute any buy/sell functions", action="store_true")
     args = parser.parse_args()
@@ -83,4 +84,5 @@ if __name__ == '__main__':
     with open(args.config, 'r') as f:
         config = json.load(f)
 
-    main(config, args.bitflyer, args.threshold, args.wait, args.dryrun)
+    main(config, args.bitflyer, args.threshold, args.wait, args.dryrun,
+         align=args.align, settle=args.settle, light=args.light)
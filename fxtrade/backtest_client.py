@@ -0,0 +1,63 @@
+import argparse
+import csv
+import json
+import sys
+from urllib import request, error
+
+
+# lib.history の INTERVAL_SECONDS・DEFAULT_START_MS と同じ値（テストで一致を確認している）
+# lib を import すると起動が遅くなるので、このファイルに写しを持つ
+INTERVALS = ['1m', '3m', '5m', '15m', '30m', '1h', '2h', '4h', '6h', '8h', '12h', '1d']
+DEFAULT_START_MS = 1502928000000  # 2017-08-17
+
+
+def main():
+    # backtest_runner.py と同じ引数で、常駐のバックテストサービスにジョブを送る
+    # （このクライアント自体は標準ライブラリだけを読み込み、すぐに終わる）
+    parser = argparse.ArgumentParser(description='Backtest Client')
+    parser.add_argument('--server', default='http://127.0.0.1:8766')
+    parser.add_argument('--product', choices=['btc', 'eth'], default='btc')
+    parser.add_argument('--interval', choices=INTERVALS, default='1h')
+    parser.add_argument('--initial', type=float, default=500000, help='initial JPY')
+    parser.add_argument('--config', help='trading config json file (optional)')
+    parser.add_argument('--start-ms', type=int, default=DEFAULT_START_MS)
+    parser.add_argument('--skip-quiescent', action='store_true')
+    parser.add_argument('--curve-out', help='write the equity curve csv')
+    parser.add_argument('--json', action='store_true', help='print the raw json result')
+    args = parser.parse_args()
+
+    job = {
+        'product': args.product,
+        'interval': args.interval,
+        'initial': args.initial,
+        'start_ms': args.start_ms,
+        'skip_quiescent': args.skip_quiescent,
+        'curve': bool(args.curve_out),
+    }
+    if args.config:
+        with open(args.config) as f:
+            job['config'] = json.load(f).get('trading')
+
+    req = request.Request(args.server.rstrip('/') + '/backtest', json.dumps(job).encode(),
+                          {'Content-Type': 'application/json'}, method='POST')
+    try:
+        with request.urlopen(req) as response:
+            result = json.loads(response.read())
+    except error.HTTPError as e:
+        print(f'error: {json.loads(e.read()).get("error")}', file=sys.stderr)
+        sys.exit(1)
+    except error.URLError as e:
+        # サーバが起動していない・アドレスが違うなど
+        print(f'error: cannot connect to {args.server}: {e.reason}', file=sys.stderr)
+        sys.exit(1)
+
+    if args.curve_out:
+        with open(args.curve_out, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(['time', 'equity'])
+            writer.writerows(result.pop('equity_curve'))
+    print(json.dumps(result) if args.json else result['summary'])
+
+
+if __name__ == '__main__':
+    main()
@@ -4,16 +4,67 @@ import logging
 
 
 from lib import get_module_logger
-from lib.history import load_or_fetch, INTERVAL_SECONDS
+from lib.history import load_or_fetch, load_packed, ensure_cached, INTERVAL_SECONDS, \
+    DEFAULT_START_MS
+from lib.candles import iter_candles_from_csv, iter_chunks
 from lib.exchange import PRODUCT_BTC_FX, PRODUCT_ETH_SPOT
-from lib.backtest import run_backtest
+from lib.backtest import run_backtest, run_backtest_streaming, run_backtest_segmented
+from lib.recost import recost_tape, replay_risk, COST_FIELDS
+from lib.sweep import expand_sweep, SweepCoordinator, run_node
+from lib.sensitivity import run_start_dates, start_indices, distribution
+from lib.scenarios import run_scenarios, format_table, write_table
+from lib.strategy import create_strategy
+from lib.ledger import Ledger
 
 
 logger = get_module_logger()
 
 
-# Binanceの上場日（これより前のデータはない）
-DEFAULT_START_MS = 1502928000000  # 2017-08-17
+def parse_cost_scenario(text):
+    # 'slippage=0.001,fee_rate=0.0' の形式のコストシナリオを辞書にする
+    scenario = {}
+    for item in text.split(','):
+        key, _, value = item.partition('=')
+        key = key.strip().replace('-', '_')
+        if key not in COST_FIELDS:
+            raise argparse.ArgumentTypeError(f'unknown cost field: {key} (use {COST_FIELDS})')
+        scenario[key] = float(value)
+    return scenario
+
+
+def parse_risk_variant(text):
+    # 'risk.risk-per-trade=0.02,rebalance-threshold=0.1' の形式のリスク設定を辞書にする
+    variant = {}
+    for item in text.split(','):
+        key, _, value = item.partition('=')
+        variant[key.strip()] = float(value)
+    return variant
+
+
+def parse_address(text):
+    # 'HOST:PORT' をタプルにする
+    host, _, port = text.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+def run_sweep(args):
+    # コーディネータ: スイープのセルをワーカーに配り、結果を表にして出力する
+    with open(args.sweep) as f:
+        cells = expand_sweep(json.load(f))
+    coordinator = SweepCoordinator(cells, address=parse_address(args.listen),
+                                   authkey=args.authkey,
+                                   heartbeat_timeout=args.heartbeat_timeout).start()
+    try:
+        results = coordinator.wait()
+    finally:
+        coordinator.close()
+    for cell, r in zip(cells, results):
+        label = f'{cell["product"]} {cell["interval"]} {json.dumps(cell["params"])}'
+        if 'error' in r:
+            print(f'{label}: error={r["error"]}')
+        else:
+            print(f'{label}: final={r["final_equity"]:,.0f} cagr={r["cagr"]:+.1%}/y '
+                  f'maxDD={r["max_drawdown"]:.1%} trades={r["trade_count"]}')
 
 
 def main():
@@ -24,11 +75,69 @@ def main():
     parser.add_argument('--cache-dir', default='docs/artifacts/data')
     parser.add_argument('--config', help='trading config json file (optional)')
     parser.add_argument('--start-ms', type=int, default=DEFAULT_START_MS)
+    parser.add_argument('--recost', type=parse_cost_scenario, action='append', default=[],
+                        help='re-cost the recorded trades under another cost model '
+                             '(e.g. slippage=0.001,fee_rate=0.0,swap_rate_daily=0.0008). repeatable')
+    parser.add_argument('--replay-risk', type=parse_risk_variant, action='append', default=[],
+                        help='replay the recorded signals under other risk settings '
+                             '(e.g. risk.risk-per-trade=0.02,risk.max-leverage=1.0). repeatable')
+    parser.add_argument('--skip-quiescent', action='store_true',
+                        help='jump over bars where no entry can happen (same result, faster)')
+    parser.add_argument('--fine-interval', choices=list(INTERVAL_SECONDS),
+                        help='fill trailing stops inside each bar using this finer interval '
+                             '(e.g. 1m). only bars that reach the stop read the fine data')
+    parser.add_argument('--start-count', type=int, default=0,
+                        help='run the same config from this many start dates and report '
+                             'the distribution of cagr and maxDD')
+    parser.add_argument('--start-every', type=float, default=7.0,
+                        help='days between start dates (with --start-count)')
+    parser.add_argument('--segments', type=int, default=0,
+                        help='split the history into this many segments and run them on '
+                             '--workers processes (same result as the serial run)')
+    parser.add_argument('--scenarios', help='scenario matrix json file '
+                             '(products x intervals x cost models). prints a comparison table')
+    parser.add_argument('--table-out', help='write the comparison table csv (with --scenarios)')
+    parser.add_argument('--stream', action='store_true',
+                        help='read the cache in chunks with constant memory')
+    parser.add_argument('--chunk-size', type=int, default=10000)
+    parser.add_argument('--equity-out', help='write the equity curve csv (with --stream)')
+    parser.add_argument('--trades-out', help='write the fills csv (with --stream)')
+    parser.add_argument('--ledger', help='record orders, fills, swaps and the equity curve '
+                                         'into this sqlite file')
+    parser.add_argument('--sweep', help='sweep definition json file. serve its cells to workers')
+    parser.add_argument('--listen', default='127.0.0.1:8765',
+                        help='coordinator address for --sweep (HOST:PORT)')
+    parser.add_argument('--worker', metavar='HOST:PORT',
+                        help='run sweep workers for the coordinator at HOST:PORT')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='number of worker processes on this node (default: cpu count)')
+    parser.add_argument('--authkey', default='', help='shared key between coordinator and workers')
+    parser.add_argument('--heartbeat-timeout', type=float, default=30.0,
+                        help='requeue cells of workers silent for this many seconds')
     parser.add_argument('-v', '--verbosity', action='store_true')
     args = parser.parse_args()
 
     if not args.verbosity:
         logger.setLevel(logging.INFO)
+    if args.ledger and (args.sweep or args.worker or args.scenarios or args.start_count > 0 or
+                        args.segments > 1):
+        parser.error('--ledger records a single run '
+                     '(not with --sweep / --worker / --scenarios / --start-count / --segments)')
+
+    if args.sweep:
+        run_sweep(args)
+        return
+    if args.worker:
+        run_node(parse_address(args.worker), authkey=args.authkey, workers=args.workers,
+                 cache_dir=args.cache_dir, start_ms=args.start_ms)
+        return
+    if args.scenarios:
+        with open(args.scenarios) as f:
+            rows = run_scenarios(json.load(f), cache_dir=args.cache_dir, workers=args.workers)
+        print(format_table(rows))
+        if args.table_out:
+            write_table(rows, args.table_out)
+        return
 
     config = None
     if args.config:
@@ -36,13 +145,76 @@ def main():
             config = json.load(f).get('trading')
 
     spec = PRODUCT_BTC_FX if args.product == 'btc' else PRODUCT_ETH_SPOT
+    ledger = None
+    if args.ledger:
+        ledger = Ledger(args.ledger, mode='backtest',
+                        note=f'{spec.code} {args.interval} initial={args.initial:.0f}')
+        logger.info(f'recording trades to {args.ledger} (run_id={ledger.run_id})')
+    try:
+        run_single(args, spec, config, ledger)
+    finally:
+        if ledger is not None:
+            ledger.close()
+
+
+def run_single(args, spec, config, ledger):
+    # 1つの銘柄・設定でバックテストを実行する（ledger に記録するのは通常と --stream の実行）
+    if args.stream:
+        path = ensure_cached(spec.symbol, args.interval, args.start_ms, args.cache_dir)
+        chunks = iter_chunks(iter_candles_from_csv(path), args.chunk_size)
+        result = run_backtest_streaming(spec, chunks, args.initial, config=config,
+                                        equity_path=args.equity_out,
+                                        trades_path=args.trades_out, ledger=ledger)
+        logger.info(f'[{spec.name}] {result.summary()}')
+        print(result.summary())
+        return
+
     candles = load_or_fetch(spec.symbol, args.interval, args.start_ms, args.cache_dir)
     logger.info(f'loaded {len(candles)} candles for {spec.symbol} {args.interval}')
 
-    result = run_backtest(spec, candles, args.initial, config=config)
+    if args.start_count > 0:
+        # 指標の準備期間より後から開始位置を選ぶ（手前の開始位置はすべて同じ結果になる）
+        warmup = create_strategy((config or {}).get('strategy')).min_history()
+        starts = start_indices(candles, args.start_every * 86400, args.start_count,
+                               warmup=warmup)
+        results = run_start_dates(spec, candles, args.initial, starts, config=config)
+        for r in results:
+            print(f'start={r.start_time}: {r.result.summary()}')
+        for name, key in (('cagr', lambda r: r.result.cagr),
+                          ('maxDD', lambda r: r.result.max_drawdown)):
+            d = distribution([key(r) for r in results])
+            print(f'{name}: ' + ' '.join(f'{k}={v:+.1%}' for k, v in d.items()))
+        return
+
+    if args.segments > 1:
+        result = run_backtest_segmented(spec, candles, args.initial, config=config,
+                                        segments=args.segments, workers=args.workers)
+        logger.info(f'[{spec.name}] {result.summary()}')
+        print(result.summary())
+        return
+
+    fine_candles = None
+    if args.fine_interval:
+        # 細かい足はメモリに展開せず、パック形式のファイルを直接参照する
+        fine_candles = load_packed(spec.symbol, args.fine_interval, args.start_ms, args.cache_dir)
+
+    result = run_backtest(spec, candles, args.initial, config=config,
+                          record_tape=bool(args.recost or args.replay_risk),
+                          skip_quiescent=args.skip_quiescent, fine_candles=fine_candles,
+                          ledger=ledger)
     logger.info(f'[{spec.name}] {result.summary()}')
     print(result.summary())
 
+    # 同じ売買判断を別のコスト条件で再計算する（戦略は再実行しない）
+    for r in recost_tape(spec, result.tape or [], args.initial, args.recost, config=config):
+        print(f'recost {r.scenario}: {r.result.summary()} flagged_bars={len(r.flagged)}')
+
+    # 同じシグナルを別のリスク設定で再生する（状態が変わった足だけ戦略を再計算する）
+    if args.replay_risk:
+        for r in replay_risk(spec, candles, result.tape, args.initial, args.replay_risk,
+                             config=config, workers=args.workers):
+            print(f'replay {r.variant}: {r.result.summary()} recomputed_bars={r.recomputed}')
+
 
 if __name__ == '__main__':
     main()
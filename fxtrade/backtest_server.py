@@ -0,0 +1,35 @@
+import argparse
+import logging
+
+
+from lib import get_module_logger
+from lib.service import BacktestService
+
+
+logger = get_module_logger()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Backtest Service')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8766)
+    parser.add_argument('--workers', type=int, default=2, help='warm worker processes')
+    parser.add_argument('--cache-size', type=int, default=8,
+                        help='datasets kept in memory per worker (LRU)')
+    parser.add_argument('--cache-dir', default='docs/artifacts/data')
+    parser.add_argument('-v', '--verbosity', action='store_true')
+    args = parser.parse_args()
+
+    if not args.verbosity:
+        logger.setLevel(logging.INFO)
+
+    service = BacktestService(host=args.host, port=args.port, workers=args.workers,
+                              cache_size=args.cache_size, cache_dir=args.cache_dir)
+    try:
+        service.serve_forever()
+    except KeyboardInterrupt:
+        logger.info('backtest service stopped')
+
+
+if __name__ == '__main__':
+    main()
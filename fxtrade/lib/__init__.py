@@ -2,6 +2,9 @@ from .utils import *
 from .exchange import ExchangeAdapter, ProductSpec, products_from_config, \
     PRODUCT_BTC_FX, PRODUCT_ETH_SPOT
 from .engine import TradingEngine
-from .strategy import TrendStrategy, PositionState, Signal
+from .runner import EngineRunner, CandleSchedule
+from .strategy import TrendStrategy, EnsembleStrategy, PositionState, Signal, \
+    create_strategy
+from .rules import RuleStrategy, compile_rules
 from .risk import RiskManager
 from .market import PaperExchange, BitFlyerExchange
@@ -1,9 +1,16 @@
-from dataclasses import dataclass, field
+import csv
+import itertools
+import os
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, replace
 
 
 from . import get_module_logger
 from .exchange import ExchangeAdapter, ProductSpec
 from .engine import TradingEngine
+from .strategy import Signal, TrendStrategy, PositionState, create_strategy
+from .indicators import breakout_bars
 
 
 logger = get_module_logger()
@@ -48,6 +55,14 @@ class SimulatedExchange(ExchangeAdapter):
             fee_rate = 0.0015 if spec.spot else 0.0
         self.fee_rate = fee_rate
         self.margin_call_count = 0
+        # 直近の注文（発注数量, 約定数量）。いずれも符号付き。テープ記録で参照する
+        self.last_fill = None
+        # 約定のたびに呼ばれるコールバック (index, side, size, fill_price, fee)
+        self.on_fill = None
+        # 注文・約定・スワップを記録する台帳（Ledger）。時刻は足の時刻
+        self.ledger = None
+        # 直近の advance で計上したスワップ（足の途中で決済したら決済後の分を払い戻す）
+        self.bar_swap = 0.0
 
     # --- バックテスト制御 ---
 
@@ -55,14 +70,15 @@ class SimulatedExchange(ExchangeAdapter):
         # 時刻を進める。足の経過時間に応じてスワップコストを計上する
         prev_index = self.index
         self.index = index
+        self.bar_swap = 0.0
         if not self.spec.spot and self.account.size != 0 and index > prev_index:
             bar_seconds = 0
             if index > 0:
                 bar_seconds = self.candles[index].time - self.candles[prev_index].time
             notional = abs(self.account.size) * self.price()
             swap = notional * self.swap_rate_daily * (bar_seconds / 86400.0)
-            self.account.cash -= swap
-            self.account.swap_paid += swap
+            self._charge_swap(swap, self.candles[index].time)
+            self.bar_swap = swap
 
         # 証拠金維持率のチェック（FXのみ）
         if not self.spec.spot and self.account.size != 0:
@@ -73,6 +89,13 @@ class SimulatedExchange(ExchangeAdapter):
                 logger.warning(f'MARGIN CALL at index {index}: equity={self.equity():.0f} '
                                f'required={required:.0f}')
 
+    def _charge_swap(self, swap, time):
+        # 負の値は払い戻し（台帳にも負の額で記録する）
+        self.account.cash -= swap
+        self.account.swap_paid += swap
+        if self.ledger is not None and swap != 0:
+            self.ledger.record_swap(self.spec.code, swap, time=time)
+
     def price(self):
         return self.candles[self.index].close
 
@@ -95,9 +118,22 @@ class SimulatedExchange(ExchangeAdapter):
         return self.account.size
 
     def market_order(self, spec, side, size):
+        return self._order(spec, side, size, self.price())
+
+    def _order(self, spec, side, size, price):
+        result = self._fill(spec, side, size, price)
+        if self.ledger is not None:
+            status = 'filled' if result == 1 else 'rejected'
+            self.ledger.record_order(spec.code, side, size, status, price=price,
+                                     time=self.candles[self.index].time)
+        return result
+
+    def _fill(self, spec, side, size, price):
+        # price を基準に（スリッページを加えて）約定させる
         acc = self.account
         direction = 1 if side == 'BUY' else -1
-        fill_price = self.price() * (1 + direction * self.slippage)
+        fill_price = price * (1 + direction * self.slippage)
+        self.last_fill = (direction * size, 0.0)
 
         if spec.spot:
             # 現物: 買いは現金の範囲内、売りは保有数量の範囲内
@@ -136,9 +172,191 @@ class SimulatedExchange(ExchangeAdapter):
             acc.entry_price = 0.0
         acc.size = new_size
         acc.trade_count += 1
+        self.last_fill = (self.last_fill[0], direction * size)
+        if self.on_fill is not None:
+            self.on_fill(self.index, side, size, fill_price, fee)
+        if self.ledger is not None:
+            self.ledger.record_fill(spec.code, side, size, fill_price, fee=fee, ref_price=price,
+                                    time=self.candles[self.index].time)
         return 1
 
 
+class SubBarExchange(SimulatedExchange):
+    # 細かい足（1分足など）で足の途中の約定を再現する取引所シミュレータ
+    #
+    # 戦略の評価と成行注文は粗い足（4時間足など）の終値で行い、ストップ注文だけを
+    # 足の途中で約定させる。粗い足の高値・安値がストップ水準に届いた足に限り、
+    # その足の期間の細かい足を二分探索で探し、最初に水準を跨いだ細かい足で約定させる
+    # （窓を開けて跨いだ場合はその足の始値）。届かない足では細かい足に一切触れない
+
+    def __init__(self, spec: ProductSpec, candles, fine_candles, initial_jpy, **kwargs):
+        super().__init__(spec, candles, initial_jpy, **kwargs)
+        self.fine_candles = fine_candles
+        self.fine_cursor = 0     # 細かい足の探索開始位置（時刻は単調に進む）
+        self.fine_lookups = 0    # 細かい足を参照した粗い足の本数
+        self.stop_count = 0
+
+    def check_stop(self, spec, direction, stop_price):
+        # 現在の足の中でストップ水準に届いていれば、direction 方向の保有ポジションを決済する
+        size = self.account.size
+        if size == 0 or stop_price <= 0 or (size > 0) != (direction > 0):
+            return False
+        candle = self.candles[self.index]
+        if (size > 0 and candle.low > stop_price) or (size < 0 and candle.high < stop_price):
+            return False
+
+        self.fine_lookups += 1
+        begin = candle.time
+        if self.index + 1 < len(self.candles):
+            end = self.candles[self.index + 1].time
+        else:
+            end = begin + (begin - self.candles[self.index - 1].time if self.index > 0 else 0)
+        fine = self.fine_candles
+        k = self._bisect_time(begin)
+        while k < len(fine) and fine[k].time < end:
+            c = fine[k]
+            if size > 0 and c.low <= stop_price:
+                price = min(stop_price, c.open)
+                break
+            if size < 0 and c.high >= stop_price:
+                price = max(stop_price, c.open)
+                break
+            k += 1
+        else:
+            # 細かい足が欠けている区間。粗い足の水準で約定したとみなす
+            price = stop_price
+        self.fine_cursor = k
+        logger.debug(f'stop filled at {price} (stop={stop_price}, bar={self.index})')
+        self.stop_count += 1
+        filled = self._order(spec, 'SELL' if size > 0 else 'BUY', abs(size), price) == 1
+        if filled and end > begin:
+            # この足のスワップは約定した時刻までの分だけにする
+            exit_time = fine[k].time if k < len(fine) and fine[k].time < end else end
+            self._charge_swap(-self.bar_swap * (end - exit_time) / (end - begin), exit_time)
+            self.bar_swap = 0.0
+        return True
+
+    def _bisect_time(self, t):
+        # 時刻 t 以降で最初の細かい足の位置
+        fine = self.fine_candles
+        lo, hi = self.fine_cursor, len(fine)
+        if lo > 0 and fine[lo - 1].time >= t:
+            lo = 0
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if fine[mid].time < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class RollingCandles:
+    # 直近 maxlen 本だけを保持するローソク足の列
+    # 添字は先頭からの通し番号のままで参照できる（SimulatedExchange からはリストに見える）
+
+    def __init__(self, maxlen):
+        self.items = deque(maxlen=maxlen)
+        self.offset = 0  # items[0] の通し番号
+
+    def resize(self, maxlen):
+        dropped = max(0, len(self.items) - maxlen)
+        self.items = deque(self.items, maxlen=maxlen)
+        self.offset += dropped
+
+    def append(self, candle):
+        if len(self.items) == self.items.maxlen:
+            self.offset += 1
+        self.items.append(candle)
+
+    def __len__(self):
+        return self.offset + len(self.items)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(len(self))
+            start = max(start, self.offset)
+            if stop <= start:
+                return []
+            return list(itertools.islice(self.items, start - self.offset, stop - self.offset))
+        if index < 0:
+            index += len(self)
+        if index < self.offset:
+            raise IndexError(f'candle {index} is no longer held (oldest={self.offset})')
+        return self.items[index - self.offset]
+
+
+@dataclass(frozen=True)
+class TapeBar:
+    # バックテストの1本分の判断の記録（取引・ポジションのテープ）
+    # コスト条件を変えた再計算（recost）や、リスク設定を変えた再生（replay）に使う
+    time: int
+    price: float        # 終値
+    signal: Signal      # 戦略が出したシグナル
+    state: tuple        # シグナル計算前のポジション状態 (direction, entry_price, extreme_price)
+                        # 資産がなくシグナルを計算しなかったサイクルは None
+    position: float     # 発注前のポジション数量
+    target: float       # 目標ポジション
+    ordered: float      # 発注数量（符号付き。発注なしは0）
+    filled: float       # 約定数量（符号付き）
+
+
+class _TapeRecorder:
+    # 戦略をラップして、シグナル計算前のポジション状態とシグナルを記録する
+
+    def __init__(self, strategy):
+        self.strategy = strategy
+        self.last = None
+
+    def __getattr__(self, name):
+        return getattr(self.strategy, name)
+
+    def evaluate(self, candles, position):
+        state = (position.direction, position.entry_price, position.extreme_price)
+        signal = self.strategy.evaluate(candles, position)
+        self.last = (state, signal)
+        return signal
+
+
+class TapeStrategy:
+    # 記録済みのテープからシグナルを返す戦略
+    #
+    # TrendStrategy のシグナルはローソク足とポジション状態 (direction, entry_price,
+    # extreme_price) だけで決まる。エンジンの状態が記録時と同じ足では記録したシグナルを
+    # そのまま返し、指標の計算を省く。リスク設定の違いで状態が記録からずれた足
+    # （最小数量を下回ってエントリーしなかった等）だけ、元の戦略で計算し直す。
+    # 状態が記録と再び一致すれば、その足からまた記録を使う
+
+    def __init__(self, tape, strategy: TrendStrategy):
+        self.strategy = strategy
+        self.bars = {bar.time: bar for bar in tape}
+        self.replayed = 0
+        self.recomputed = 0
+
+    @property
+    def allow_short(self):
+        return self.strategy.allow_short
+
+    @allow_short.setter
+    def allow_short(self, value):
+        self.strategy.allow_short = value
+
+    def min_history(self):
+        return self.strategy.min_history()
+
+    def evaluate(self, candles, position: PositionState):
+        price = candles[-1].close if candles else 0.0
+        bar = self.bars.get(candles[-1].time) if candles else None
+        state = (position.direction, position.entry_price, position.extreme_price)
+        if bar is not None and bar.state == state and bar.price == price:
+            # 元の戦略と同じく、保有中は最良値を更新してから返す
+            position.update_extreme(price)
+            self.replayed += 1
+            return replace(bar.signal)
+        self.recomputed += 1
+        return self.strategy.evaluate(candles, position)
+
+
 @dataclass
 class BacktestResult:
     initial_equity: float
@@ -150,6 +368,7 @@ class BacktestResult:
     margin_call_count: int
     years: float
     equity_curve: list = field(default_factory=list)
+    tape: list = None
 
     @property
     def total_return(self):
@@ -168,35 +387,115 @@ class BacktestResult:
                 f'fees={self.fees_paid:,.0f} swap={self.swap_paid:,.0f} '
                 f'margin_calls={self.margin_call_count}')
 
+    def to_dict(self, curve=False):
+        # JSONで受け渡すための要約（curve=True で資産推移も含める）
+        d = {
+            'initial_equity': self.initial_equity,
+            'final_equity': self.final_equity,
+            'total_return': self.total_return,
+            'cagr': self.cagr,
+            'max_drawdown': self.max_drawdown,
+            'trade_count': self.trade_count,
+            'fees_paid': self.fees_paid,
+            'swap_paid': self.swap_paid,
+            'margin_call_count': self.margin_call_count,
+            'years': self.years,
+        }
+        if curve:
+            d['equity_curve'] = [list(p) for p in self.equity_curve]
+        return d
+
 
 def run_backtest(spec: ProductSpec, candles, initial_jpy, config=None,
-                 fee_rate=None, slippage=0.0005, swap_rate_daily=0.0004):
+                 fee_rate=None, slippage=0.0005, swap_rate_daily=0.0004,
+                 record_tape=False, skip_quiescent=False, strategy=None, start=0,
+                 fine_candles=None, ledger=None):
     # 過去データに対して戦略を実行し、資産推移を検証する
-    sim = SimulatedExchange(spec, candles, initial_jpy,
-                            fee_rate=fee_rate, slippage=slippage,
-                            swap_rate_daily=swap_rate_daily)
-    engine = TradingEngine(sim, spec, config=config)
-
-    warmup = engine.strategy.min_history()
+    # record_tape=True のときは1本ごとの判断を BacktestResult.tape に記録する
+    # skip_quiescent=True のときは何も起こりえない足（ノーポジションでブレイクアウトもない足）を
+    # エンジンを呼ばずに読み飛ばす。結果は1本ずつ実行した場合と完全に一致する
+    # strategy を指定すると設定から作る代わりにその戦略を使う（テープの再生など）
+    # start を指定するとその位置の足から（ノーポジションで）実行を始める。それ以前の足は
+    # 指標の計算にだけ使われる
+    # fine_candles（同じ期間の細かい足）を渡すと、トレーリングストップを足の途中で
+    # 約定させる（SubBarExchange）。シグナルの評価は candles の終値で行う
+    # ledger（Ledger）を渡すと注文・約定・スワップと資産推移を記録する
+    if fine_candles is not None:
+        if record_tape:
+            raise ValueError('record_tape cannot be combined with fine_candles')
+        sim = SubBarExchange(spec, candles, fine_candles, initial_jpy,
+                             fee_rate=fee_rate, slippage=slippage,
+                             swap_rate_daily=swap_rate_daily)
+    else:
+        sim = SimulatedExchange(spec, candles, initial_jpy,
+                                fee_rate=fee_rate, slippage=slippage,
+                                swap_rate_daily=swap_rate_daily)
+    sim.ledger = ledger
+    engine = TradingEngine(sim, spec, strategy=strategy, config=config)
+    stop = (0, 0.0)
+    next_active = None
+    if skip_quiescent and not record_tape and isinstance(engine.strategy, TrendStrategy) and \
+            engine.strategy.band_mode == 'donchian':
+        # 分位点のチャネルは最高値・最安値より内側にあるので、読み飛ばせる足を判定できない
+        next_active = _next_entry_bars(candles, engine.strategy.donchian_span)
+    recorder = None
+    tape = None
+    if record_tape:
+        recorder = _TapeRecorder(engine.strategy)
+        engine.strategy = recorder
+        tape = []
+
+    warmup = max(engine.strategy.min_history(), start)
     if warmup >= len(candles):
         # データ不足の場合は取引なし（資産は初期値のまま）として返す
         logger.warning(f'not enough candles for backtest: {len(candles)} < {warmup}')
         return BacktestResult(initial_equity=initial_jpy, final_equity=initial_jpy,
                               max_drawdown=0.0, trade_count=0, fees_paid=0.0,
-                              swap_paid=0.0, margin_call_count=0, years=0.0)
+                              swap_paid=0.0, margin_call_count=0, years=0.0,
+                              tape=tape)
     equity_curve = []
     peak = initial_jpy
     max_dd = 0.0
 
-    for i in range(warmup, len(candles)):
+    i = warmup
+    while i < len(candles):
+        if next_active is not None and sim.account.size == 0 and \
+                engine.position_state.direction == 0:
+            # ノーポジションの間、新規エントリーはブレイクアウトした足でしか起こらない
+            # それまでの足は資産が一定（スワップも掛からない）なのでまとめて記録する
+            j = next_active[i]
+            if j > i:
+                eq = sim.equity()
+                peak = max(peak, eq)
+                if peak > 0:
+                    max_dd = max(max_dd, 1.0 - eq / peak)
+                equity_curve.extend((candles[k].time, eq) for k in range(i, j))
+                i = j
+                if i >= len(candles):
+                    break
         sim.advance(i)
-        engine.step()
+        if fine_candles is not None:
+            sim.check_stop(spec, *stop)
+        if recorder is not None:
+            position = sim.account.size
+            recorder.last = None
+            sim.last_fill = None
+            engine.step()
+            tape.append(_tape_bar(candles[i], recorder, engine, position, sim.last_fill))
+        else:
+            _, signal = engine.step()
+            # 次の足の途中で使うストップ水準（保有中のシグナルのみ）
+            if signal is not None:
+                stop = (signal.direction, signal.stop_price)
         eq = sim.equity()
         equity_curve.append((candles[i].time, eq))
         peak = max(peak, eq)
         if peak > 0:
             max_dd = max(max_dd, 1.0 - eq / peak)
+        i += 1
 
+    if ledger is not None:
+        ledger.record_equity_curve(spec.code, equity_curve)
     years = (candles[-1].time - candles[warmup].time) / (365.25 * 86400)
     return BacktestResult(
         initial_equity=initial_jpy,
@@ -208,4 +507,169 @@ def run_backtest(spec: ProductSpec, candles, initial_jpy, config=None,
         margin_call_count=sim.margin_call_count,
         years=years,
         equity_curve=equity_curve,
+        tape=tape,
     )
+
+
+def _next_entry_bars(candles, span):
+    # 各足について、その足以降で最初にブレイクアウトが起こる足の位置を返す（なければ足の本数）
+    active = breakout_bars([c.close for c in candles], span)
+    result = [len(candles)] * (len(candles) + 1)
+    for i in range(len(candles) - 1, -1, -1):
+        result[i] = i if active[i] else result[i + 1]
+    return result
+
+
+def _tape_bar(candle, recorder, engine, position, fill):
+    if recorder.last is None:
+        # 資産がなくシグナル計算まで進まなかったサイクル
+        state, signal = None, Signal(0, 0.0, 0.0, 0.0, candle.close)
+        target = position
+    else:
+        state, signal = recorder.last
+        target = engine.last_target
+    ordered, filled = fill or (0.0, 0.0)
+    return TapeBar(time=candle.time, price=candle.close, signal=signal, state=state,
+                   position=position, target=target, ordered=ordered, filled=filled)
+
+
+def run_backtest_segmented(spec: ProductSpec, candles, initial_jpy, config=None,
+                           fee_rate=None, slippage=0.0005, swap_rate_daily=0.0004,
+                           segments=4, workers=None):
+    # 長い期間のバックテストを時間で区切り、区間ごとに別プロセスで並列に実行する
+    #
+    # 1. 各区間を、直前の足（指標の計算に必要な本数）を含めて切り出し、区間の先頭から
+    #    ノーポジションで始めた場合のシグナルをテープに記録する（ここが並列に走る）
+    # 2. 全区間のテープをつないだ TapeStrategy で全期間を1本ずつ実行し直す。
+    #    区間の境界で実際のポジション状態が記録（ノーポジション）と一致していれば
+    #    記録したシグナルをそのまま使い、一致しない足だけ戦略を計算し直す
+    #    （状態が再びノーポジションで揃えば、そこからまた記録を使う）
+    # シグナルはローソク足とポジション状態だけで決まるため、結果は run_backtest と一致する。
+    # 2. は口座の計算だけなので、全体の時間はほぼ 1. の並列度で決まる
+    config = config or {}
+    strategy = create_strategy(config.get('strategy'))
+    if segments <= 1 or not isinstance(strategy, TrendStrategy):
+        return run_backtest(spec, candles, initial_jpy, config=config, fee_rate=fee_rate,
+                            slippage=slippage, swap_rate_daily=swap_rate_daily)
+
+    candle_limit = TradingEngine(None, spec, strategy=strategy, config=config).candle_limit
+    warmup = strategy.min_history()
+    if warmup >= len(candles):
+        return run_backtest(spec, candles, initial_jpy, config=config, fee_rate=fee_rate,
+                            slippage=slippage, swap_rate_daily=swap_rate_daily)
+    bounds = [warmup + (len(candles) - warmup) * k // segments for k in range(segments + 1)]
+    args = []
+    for begin, end in zip(bounds, bounds[1:]):
+        if end <= begin:
+            continue
+        # 区間の先頭の足でも、通しで実行した場合と同じ本数の足が見えるように切り出す
+        offset = max(0, begin + 1 - candle_limit)
+        args.append((spec, candles[offset:end], begin - offset, initial_jpy, config,
+                     fee_rate, slippage, swap_rate_daily))
+
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(args))) as pool:
+            tapes = list(pool.map(_segment_tape, *zip(*args)))
+    else:
+        tapes = [_segment_tape(*a) for a in args]
+
+    tape = TapeStrategy([bar for t in tapes for bar in t], strategy)
+    result = run_backtest(spec, candles, initial_jpy, config=config, fee_rate=fee_rate,
+                          slippage=slippage, swap_rate_daily=swap_rate_daily, strategy=tape)
+    logger.info(f'[{spec.name}] segmented backtest: {len(args)} segments, '
+                f'replayed={tape.replayed} recomputed={tape.recomputed}')
+    return result
+
+
+def _segment_tape(spec, candles, start, initial_jpy, config, fee_rate, slippage,
+                  swap_rate_daily):
+    result = run_backtest(spec, candles, initial_jpy, config=config, fee_rate=fee_rate,
+                          slippage=slippage, swap_rate_daily=swap_rate_daily,
+                          record_tape=True, start=start)
+    return result.tape
+
+
+def run_backtest_streaming(spec: ProductSpec, chunks, initial_jpy, config=None,
+                           fee_rate=None, slippage=0.0005, swap_rate_daily=0.0004,
+                           equity_path=None, trades_path=None, ledger=None):
+    # ローソク足をチャンク単位で受け取りながら実行する省メモリ版のバックテスト
+    # chunks: ローソク足のリストを順に返すイテラブル（candles.iter_chunks など）
+    #
+    # 保持するのは戦略が参照する直近の足だけで、資産推移と約定は
+    # equity_path / trades_path のCSVへ逐次書き出す（BacktestResult.equity_curve は空）。
+    # チャンクの境界をまたいでも、エンジン・口座・直近の足はそのまま引き継ぐため
+    # 結果は run_backtest と一致する
+    # ledger（Ledger）を渡すと注文・約定・スワップと資産推移を逐次記録する
+    window = RollingCandles(maxlen=1)
+    sim = SimulatedExchange(spec, window, initial_jpy,
+                            fee_rate=fee_rate, slippage=slippage,
+                            swap_rate_daily=swap_rate_daily)
+    sim.ledger = ledger
+    engine = TradingEngine(sim, spec, config=config)
+    window.resize(engine.candle_limit + 1)
+    warmup = engine.strategy.min_history()
+
+    equity_file = _open_csv(equity_path, ['time', 'equity'])
+    trades_file = _open_csv(trades_path, ['time', 'side', 'size', 'price', 'fee'])
+    if trades_file is not None:
+        sim.on_fill = lambda index, side, size, price, fee: trades_file[1].writerow(
+            [window[index].time, side, size, price, fee])
+
+    peak = initial_jpy
+    max_dd = 0.0
+    start_time = None
+    last_time = None
+    index = -1
+    try:
+        for chunk in chunks:
+            for candle in chunk:
+                index += 1
+                window.append(candle)
+                if index < warmup:
+                    continue
+                if start_time is None:
+                    start_time = candle.time
+                sim.advance(index)
+                engine.step()
+                eq = sim.equity()
+                if equity_file is not None:
+                    equity_file[1].writerow([candle.time, eq])
+                if ledger is not None:
+                    ledger.record_equity(spec.code, eq, sim.account.size, time=candle.time)
+                peak = max(peak, eq)
+                if peak > 0:
+                    max_dd = max(max_dd, 1.0 - eq / peak)
+                last_time = candle.time
+    finally:
+        for f in (equity_file, trades_file):
+            if f is not None:
+                f[0].close()
+
+    if start_time is None:
+        logger.warning(f'not enough candles for backtest: {index + 1} < {warmup}')
+        return BacktestResult(initial_equity=initial_jpy, final_equity=initial_jpy,
+                              max_drawdown=0.0, trade_count=0, fees_paid=0.0,
+                              swap_paid=0.0, margin_call_count=0, years=0.0)
+
+    return BacktestResult(
+        initial_equity=initial_jpy,
+        final_equity=sim.equity(),
+        max_drawdown=max_dd,
+        trade_count=sim.account.trade_count,
+        fees_paid=sim.account.fees_paid,
+        swap_paid=sim.account.swap_paid,
+        margin_call_count=sim.margin_call_count,
+        years=(last_time - start_time) / (365.25 * 86400),
+    )
+
+
+def _open_csv(path, header):
+    if path is None:
+        return None
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    f = open(path, 'w', newline='')
+    writer = csv.writer(f)
+    writer.writerow(header)
+    return (f, writer)
@@ -1,5 +1,9 @@
 import csv
+import mmap
 import os
+import threading
+from array import array
+from collections.abc import Sequence
 from dataclasses import dataclass
 
 
@@ -27,16 +31,89 @@ def candles_to_csv(candles, path):
 
 def candles_from_csv(path):
     # CSVからローソク足のリストを読み込む
-    candles = []
+    return list(iter_candles_from_csv(path))
+
+
+def iter_candles_from_csv(path):
+    # CSVからローソク足を1本ずつ読み込む（ファイル全体をメモリに載せない）
     with open(path, newline='') as f:
         reader = csv.DictReader(f)
         for row in reader:
-            candles.append(Candle(
+            yield Candle(
                 time=int(row['time']),
                 open=float(row['open']),
                 high=float(row['high']),
                 low=float(row['low']),
                 close=float(row['close']),
                 volume=float(row['volume']),
-            ))
-    return candles
+            )
+
+
+def iter_chunks(candles, size):
+    # ローソク足の列を size 本ずつのリストに区切って返す
+    chunk = []
+    for c in candles:
+        chunk.append(c)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+# パック形式の1本あたりの列数（time, open, high, low, close, volume）
+PACKED_FIELDS = 6
+
+
+def pack_candles(candles, path):
+    # ローソク足を倍精度の固定長バイナリ（1本48バイト）で保存する
+    # mmapで開くと、同じマシンの複数プロセスが1つのページキャッシュを共有して読める
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    data = array('d')
+    for c in candles:
+        data.extend((c.time, c.open, c.high, c.low, c.close, c.volume))
+    # 同じファイルを複数のワーカーが同時に作ることがあるので、一時ファイルは書き手ごとに分ける
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        data.tofile(f)
+    os.replace(tmp_path, path)
+
+
+class PackedCandles(Sequence):
+    # パック形式のバッファ（mmap等）をローソク足のリストとして読むビュー
+    # 足は参照されたときに Candle として組み立てる（全件をオブジェクト化しない）
+
+    def __init__(self, buffer):
+        self._buffer = buffer
+        self._view = memoryview(buffer).cast('B').cast('d')
+        self._len = len(self._view) // PACKED_FIELDS
+
+    @classmethod
+    def open(cls, path):
+        # パック形式のファイルを読み取り専用でmmapする
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return cls(b'')
+            return cls(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+
+    def __len__(self):
+        return self._len
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(self._len)
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            if stop <= start:
+                return []
+            values = self._view[start * PACKED_FIELDS:stop * PACKED_FIELDS].tolist()
+            return [Candle(int(values[k]), values[k + 1], values[k + 2], values[k + 3],
+                           values[k + 4], values[k + 5])
+                    for k in range(0, len(values), PACKED_FIELDS)]
+        if index < 0:
+            index += self._len
+        if not 0 <= index < self._len:
+            raise IndexError('candle index out of range')
+        k = index * PACKED_FIELDS
+        v = self._view
+        return Candle(int(v[k]), v[k + 1], v[k + 2], v[k + 3], v[k + 4], v[k + 5])
@@ -1,5 +1,8 @@
+from dataclasses import replace
+
+
 from . import get_module_logger
-from .strategy import TrendStrategy, PositionState
+from .strategy import TrendStrategy, PositionState, create_strategy
 from .risk import RiskManager
 from .exchange import ProductSpec, ExchangeAdapter
 
@@ -7,6 +10,27 @@ from .exchange import ProductSpec, ExchangeAdapter
 logger = get_module_logger()
 
 
+def order_delta(spec: ProductSpec, current, target, rebalance_threshold):
+    # 現在ポジションと目標ポジションから発注すべき数量（符号付き）を返す
+    # 発注しない場合は0.0（差分が最小取引数量未満、またはリバランスが小さすぎる）
+    delta = target - current
+
+    if abs(delta) < spec.min_size:
+        logger.debug(f'[{spec.name}] delta {delta} below min size. no order')
+        return 0.0
+
+    # 方向転換・決済以外の単なるサイズ調整は、乖離が大きいときだけ行う（取引コスト節約）
+    same_direction = (current > 0 and target > 0) or (current < 0 and target < 0)
+    if same_direction:
+        base = max(abs(current), abs(target))
+        if base > 0 and abs(delta) / base < rebalance_threshold:
+            logger.debug(f'[{spec.name}] rebalance too small '
+                         f'({abs(delta)/base:.2%} < {rebalance_threshold:.0%}). no order')
+            return 0.0
+
+    return delta
+
+
 class TradingEngine:
     # 1銘柄の取引を管理するエンジン
     # 毎サイクル step() を呼ぶと、シグナル計算 → 目標ポジション算出 → 発注 を行う
@@ -17,7 +41,7 @@ class TradingEngine:
         config = config or {}
         self.exchange = exchange
         self.spec = spec
-        self.strategy = strategy or TrendStrategy(config.get('strategy'))
+        self.strategy = strategy or create_strategy(config.get('strategy'))
         if spec.spot:
             # 現物はショートできないため設定に関わらず禁止する
             self.strategy.allow_short = False
@@ -27,6 +51,13 @@ class TradingEngine:
         self.candle_limit = max(self.strategy.min_history() + 10,
                                 int(config.get('candle-limit', 200)))
         self.position_state = PositionState()
+        # 直近サイクルの目標ポジション（バックテストのテープ記録などで参照する）
+        self.last_target = 0.0
+        # 直近に評価した確定足の時刻とシグナル（新しい足がなければ評価を省く）
+        self.last_bar_time = None
+        self.last_signal = None
+        # 直近の発注が失敗したか（失敗した足は次のサイクルで評価し直して再発注する）
+        self.order_failed = False
 
     def step(self):
         # 1サイクル分の取引判断と執行を行う
@@ -34,6 +65,12 @@ class TradingEngine:
         spec = self.spec
         logger.debug(f'[{spec.name}] engine step')
 
+        # 新しい足が確定していなければシグナルは前回と変わらないので、ローソク足の取得と
+        # 戦略の評価を省き、保有中なら現在価格でストップだけを確認する
+        bar_time = self.exchange.latest_candle_time(spec)
+        if bar_time is not None and bar_time == self.last_bar_time:
+            return self._check_stop()
+
         candles = self.exchange.get_candles(spec, self.candle_limit)
         if not candles:
             logger.warning(f'[{spec.name}] no candle data. skip this cycle')
@@ -52,6 +89,8 @@ class TradingEngine:
         self._sync_position_state(current, candles[-1].close)
 
         signal = self.strategy.evaluate(candles, self.position_state)
+        self.last_bar_time = candles[-1].time
+        self.last_signal = signal
         logger.debug(f'[{spec.name}] signal: direction={signal.direction} '
                      f'strength={signal.strength:.3f} stop={signal.stop_price:.1f} '
                      f'price={signal.price:.1f}')
@@ -59,10 +98,35 @@ class TradingEngine:
         target = self.risk.position_size(equity, signal.price, signal,
                                          spot=spec.spot, min_size=spec.min_size)
         logger.debug(f'[{spec.name}] target position: {target}')
+        self.last_target = target
 
         traded = self._execute(current, target, signal)
+        if self.order_failed:
+            # 足を評価済みにすると、この足の間は発注をやり直さなくなる
+            self.last_bar_time = None
         return (traded, signal)
 
+    def _check_stop(self):
+        # 足の途中で現在価格が直近のストップを越えたら決済する
+        spec = self.spec
+        state = self.position_state
+        signal = self.last_signal
+        if state.direction == 0 or signal is None or signal.stop_price <= 0:
+            return (False, None)
+        price = self.exchange.get_price(spec)
+        if price <= 0:
+            return (False, None)
+        if (state.direction > 0 and price > signal.stop_price) or \
+                (state.direction < 0 and price < signal.stop_price):
+            return (False, None)
+        current = self.exchange.get_position(spec)
+        logger.info(f'[{spec.name}] stop hit inside the bar: price={price} '
+                    f'stop={signal.stop_price}')
+        exit_signal = replace(signal, direction=0, strength=0.0, price=price)
+        self.last_target = 0.0
+        traded = self._execute(current, 0.0, exit_signal)
+        return (traded, exit_signal)
+
     def _sync_position_state(self, current, price):
         state = self.position_state
         if abs(current) < self.spec.min_size / 2:
@@ -82,21 +146,12 @@ class TradingEngine:
     def _execute(self, current, target, signal):
         # 現在ポジションと目標ポジションの差分を発注する
         spec = self.spec
-        delta = target - current
-
-        if abs(delta) < spec.min_size:
-            logger.debug(f'[{spec.name}] delta {delta} below min size. no order')
+        self.order_failed = False
+        delta = order_delta(spec, current, target, self.rebalance_threshold)
+        if delta == 0.0:
             return False
 
-        # 方向転換・決済以外の単なるサイズ調整は、乖離が大きいときだけ行う（取引コスト節約）
         same_direction = (current > 0 and target > 0) or (current < 0 and target < 0)
-        if same_direction:
-            base = max(abs(current), abs(target))
-            if base > 0 and abs(delta) / base < self.rebalance_threshold:
-                logger.debug(f'[{spec.name}] rebalance too small '
-                             f'({abs(delta)/base:.2%} < {self.rebalance_threshold:.0%}). no order')
-                return False
-
         side = 'BUY' if delta > 0 else 'SELL'
         size = round(abs(delta), 8)
         logger.info(f'[{spec.name}] order: {side} {size} '
@@ -117,4 +172,5 @@ class TradingEngine:
             return True
         else:
             logger.warning(f'[{spec.name}] order failed')
+            self.order_failed = True
             return False
@@ -1,3 +1,5 @@
+import threading
+import time
 from abc import ABCMeta, abstractmethod
 from dataclasses import dataclass
 
@@ -42,6 +44,11 @@ class ExchangeAdapter(metaclass=ABCMeta):
         # 確定済みローソク足を古い順に返す
         pass
 
+    def latest_candle_time(self, spec: ProductSpec):
+        # 最新の確定足の時刻を返す（新しい足が確定したかをエンジンが確認するため）
+        # 安く確認できない取引所は None を返し、エンジンは毎サイクル get_candles で判断する
+        return None
+
     @abstractmethod
     def get_price(self, spec: ProductSpec):
         # 現在価格を返す（取得できなければ0）
@@ -63,3 +70,65 @@ class ExchangeAdapter(metaclass=ABCMeta):
         # 成行注文を出す。side: 'BUY' or 'SELL'
         # 1: 成功, -1: 失敗, 0: 実行しなかった（dryrun等）
         pass
+
+    def close(self):
+        # 終了時に呼ばれる（保存しきれていない状態を書き出すなど）
+        pass
+
+
+class SnapshotCache:
+    # 口座情報や相場の取得結果を短時間（ttl秒）だけ保持するキャッシュ（スレッドセーフ）
+    #
+    # 1サイクルの中で同じAPI（残高・証拠金・建玉・ティッカー）を何度も呼ばないように、
+    # 取引所アダプタが取得結果をここに置いて使い回す。アダプタを共有するエンジン同士
+    # （同じ口座）でも共有される。発注したら invalidate() で口座情報を捨てる。
+    # 同じキーを同時に取得しようとしたときは1回だけAPIを呼ぶ。ttl=0 なら保持しない
+
+    def __init__(self, ttl=5.0, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.entries = {}       # キー -> (取得時刻, 値)
+        self.key_locks = {}
+        self.generation = 0     # invalidate() のたびに増える
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, fetch):
+        # キャッシュの値を返す。なければ（古ければ） fetch() で取得して保持する
+        with self.lock:
+            value = self._fresh(key)
+            if value is not None:
+                self.hits += 1
+                return value
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                value = self._fresh(key)
+                if value is not None:
+                    self.hits += 1
+                    return value
+                generation = self.generation
+            value = fetch()
+            with self.lock:
+                self.misses += 1
+                # 取得中に invalidate() されていたら、発注前の値なので保持しない
+                if self.ttl > 0 and generation == self.generation:
+                    self.entries[key] = (self.clock(), value)
+            return value
+
+    def _fresh(self, key):
+        entry = self.entries.get(key)
+        if entry is not None and self.clock() - entry[0] < self.ttl:
+            return entry[1]
+        return None
+
+    def invalidate(self, keep=None):
+        # キャッシュを捨てる。keep(key) が真のキーは残す（発注後もティッカーは有効など）
+        with self.lock:
+            self.generation += 1
+            self.entries = {k: v for k, v in self.entries.items() if keep and keep(k)}
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries)}
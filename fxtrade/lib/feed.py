@@ -0,0 +1,81 @@
+import time
+from collections import deque
+
+
+from . import get_module_logger
+from .candles import Candle
+from .history import fetch_recent_binance_klines
+
+
+logger = get_module_logger()
+
+
+# Binanceの1回のリクエストで取得できる最大本数
+MAX_KLINES = 1000
+
+
+class CandleFeed:
+    # 1銘柄の確定足をメモリに保持し、前回以降に確定した足だけを取得するフィード
+    #
+    # 最初の update() で limit 本を取得し、以降は最後の確定足より新しい足だけを
+    # 取得する（通常は確定した1本と未確定の1本だけ）。最後の1本は未確定足なので捨てる。
+    # 取得できなかった期間が長すぎる（MAX_KLINES 本以上）ときは全体を取り直す。
+    # min_refresh 秒以内の update() は取得しない（同じサイクルでの二重取得を防ぐ）
+
+    def __init__(self, symbol, interval, limit, fetch=fetch_recent_binance_klines,
+                 min_refresh=1.0, clock=time.monotonic):
+        self.symbol = symbol
+        self.interval = interval
+        self.limit = limit
+        self.fetch = fetch
+        self.min_refresh = min_refresh
+        self.clock = clock
+        self.candles = deque(maxlen=limit)
+        self.fetched_at = None
+        self.requests = 0
+
+    def update(self):
+        # 新しく確定した足を取り込み、その本数を返す
+        now = self.clock()
+        if self.fetched_at is not None and now - self.fetched_at < self.min_refresh:
+            return 0
+        if not self.candles:
+            new = self._seed()
+        else:
+            last = self.candles[-1].time
+            rows = self.fetch(self.symbol, self.interval, limit=MAX_KLINES,
+                              start_ms=(last + 1) * 1000)
+            self.requests += 1
+            if len(rows) >= MAX_KLINES:
+                logger.info(f'{self.symbol} {self.interval}: too many missed candles. reload')
+                new = self._seed()
+            else:
+                new = [c for c in rows[:-1] if c.time > last]
+                self.candles.extend(new)
+        self.fetched_at = now
+        if new:
+            logger.debug(f'{self.symbol} {self.interval}: {len(new)} new candles '
+                         f'(last={self.candles[-1].time})')
+        return len(new)
+
+    def _seed(self):
+        rows = self.fetch(self.symbol, self.interval, limit=min(self.limit + 1, MAX_KLINES))
+        self.requests += 1
+        self.candles.clear()
+        self.candles.extend(rows[:-1])
+        return list(self.candles)
+
+    def last_time(self):
+        return self.candles[-1].time if self.candles else None
+
+
+def scale_candles(candles, price):
+    # 最後の終値が price になる比率で全ての足をスケーリングする（Binance → bitFlyerのJPY相当）
+    # 戦略はスケール不変なので方向・ATR比率は保たれる
+    if price > 0 and candles[-1].close > 0:
+        rate = price / candles[-1].close
+    else:
+        rate = 1.0
+    return [Candle(time=c.time, open=c.open * rate, high=c.high * rate,
+                   low=c.low * rate, close=c.close * rate,
+                   volume=c.volume) for c in candles]
@@ -1,32 +1,45 @@
-import json
 import os
 import time
-from urllib import request, parse
+from urllib import parse
 
 
 from . import get_module_logger
-from .candles import Candle, candles_to_csv, candles_from_csv
+from .candles import Candle, candles_to_csv, candles_from_csv, pack_candles, PackedCandles
+from .httpclient import shared_pool
 
 
 logger = get_module_logger()
 
 
 BINANCE_KLINES_URL = 'https://api.binance.com/api/v3/klines'
+BINANCE_EXCHANGE_INFO_URL = 'https://api.binance.com/api/v3/exchangeInfo'
+
+# Binanceの上場日（これより前のデータはない）
+DEFAULT_START_MS = 1502928000000  # 2017-08-17
 
 # Binanceのintervalと秒数の対応
+# （足の区切りがエポック秒の倍数になる1日以下の間隔だけ。3d / 1w / 1M は扱わない）
 INTERVAL_SECONDS = {
     '1m': 60,
+    '3m': 180,
     '5m': 300,
     '15m': 900,
+    '30m': 1800,
     '1h': 3600,
+    '2h': 7200,
     '4h': 14400,
+    '6h': 21600,
+    '8h': 28800,
+    '12h': 43200,
     '1d': 86400,
 }
 
 
-def fetch_binance_klines(symbol, interval, start_ms, end_ms=None, request_wait=0.2):
+def fetch_binance_klines(symbol, interval, start_ms, end_ms=None, request_wait=0.0):
     # Binanceの公開APIからローソク足を取得する（認証不要）
     # start_ms から end_ms（省略時は現在）までページングしながら全件取得する
+    # レート制限は共有の接続プールの RateLimiter がウェイトの予算で管理する
+    # （request_wait はページごとの追加の待機）
     candles = []
     cursor = start_ms
     if end_ms is None:
@@ -42,8 +55,7 @@ def fetch_binance_klines(symbol, interval, start_ms, end_ms=None, request_wait=0
         })
         url = f'{BINANCE_KLINES_URL}?{params}'
         logger.debug(f'call api: {url}')
-        with request.urlopen(url, timeout=30) as response:
-            rows = json.loads(response.read())
+        rows = shared_pool().get_json(url, timeout=30)
         if not rows:
             break
         for row in rows:
@@ -59,7 +71,8 @@ def fetch_binance_klines(symbol, interval, start_ms, end_ms=None, request_wait=0
         cursor = rows[-1][0] + 1
         if len(rows) < 1000:
             break
-        time.sleep(request_wait)  # レート制限対策
+        if request_wait > 0:
+            time.sleep(request_wait)
 
     return candles
 
@@ -78,18 +91,44 @@ def load_or_fetch(symbol, interval, start_ms, cache_dir, refresh=False):
     return candles
 
 
-def fetch_recent_binance_klines(symbol, interval, limit=500):
+def ensure_cached(symbol, interval, start_ms, cache_dir, refresh=False):
+    # キャッシュのCSVがなければBinanceから取得して保存し、そのパスを返す
+    # （キャッシュがあれば読み込まない。ストリーミング処理の入り口に使う）
+    path = os.path.join(cache_dir, f'{symbol}_{interval}.csv')
+    if refresh or not os.path.exists(path):
+        load_or_fetch(symbol, interval, start_ms, cache_dir, refresh=True)
+    return path
+
+
+def load_packed(symbol, interval, start_ms, cache_dir, refresh=False):
+    # CSVキャッシュをパック形式に変換し、mmapしたビューを返す
+    # 同じマシンの複数プロセスで開いても、データはページキャッシュ上の1つだけになる
+    csv_path = os.path.join(cache_dir, f'{symbol}_{interval}.csv')
+    path = os.path.join(cache_dir, f'{symbol}_{interval}.f64')
+    stale = not os.path.exists(path) or \
+        (os.path.exists(csv_path) and os.path.getmtime(csv_path) > os.path.getmtime(path))
+    if refresh or stale:
+        candles = load_or_fetch(symbol, interval, start_ms, cache_dir, refresh=refresh)
+        pack_candles(candles, path)
+        logger.debug(f'packed {len(candles)} candles to {path}')
+    return PackedCandles.open(path)
+
+
+def fetch_recent_binance_klines(symbol, interval, limit=500, start_ms=None):
     # 直近のローソク足を取得する（リアルタイムのシグナル計算用）
+    # start_ms を指定するとその時刻以降の足だけを取得する
     # 最後の1本は未確定足なので注意
-    params = parse.urlencode({
+    query = {
         'symbol': symbol,
         'interval': interval,
         'limit': limit,
-    })
+    }
+    if start_ms is not None:
+        query['startTime'] = start_ms
+    params = parse.urlencode(query)
     url = f'{BINANCE_KLINES_URL}?{params}'
     logger.debug(f'call api: {url}')
-    with request.urlopen(url, timeout=30) as response:
-        rows = json.loads(response.read())
+    rows = shared_pool().get_json(url, timeout=30)
     return [Candle(
         time=int(row[0] // 1000),
         open=float(row[1]),
@@ -98,3 +137,11 @@ def fetch_recent_binance_klines(symbol, interval, limit=500):
         close=float(row[4]),
         volume=float(row[5]),
     ) for row in rows]
+
+
+def fetch_binance_symbols(quote='USDT'):
+    # Binanceで取引中の、指定した決済通貨（例: USDT）建てのシンボル一覧を取得する
+    logger.debug(f'call api: {BINANCE_EXCHANGE_INFO_URL}')
+    info = shared_pool().get_json(BINANCE_EXCHANGE_INFO_URL, timeout=30)
+    return sorted(s['symbol'] for s in info.get('symbols', [])
+                  if s.get('quoteAsset') == quote and s.get('status') == 'TRADING')
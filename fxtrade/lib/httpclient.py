@@ -0,0 +1,222 @@
+import http.client
+import json
+import ssl
+import threading
+import time
+from collections import deque
+from urllib import parse
+
+
+from . import get_module_logger
+from .ratelimit import RateLimiter
+
+
+logger = get_module_logger()
+
+
+class HttpError(Exception):
+    # 2xx以外のレスポンス
+
+    def __init__(self, status, reason, body=b''):
+        super().__init__(f'HTTP {status} {reason}: {body[:200]!r}')
+        self.status = status
+        self.reason = reason
+        self.body = body
+
+
+# 再利用した接続がサーバー側で閉じられていたときに出る例外（リクエストは届いていない）
+STALE_ERRORS = (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError,
+                http.client.BadStatusLine)
+
+
+class _HostPool:
+    # 1つの接続先（scheme, host, port）の接続と統計
+
+    def __init__(self, size):
+        self.idle = []                             # (接続, 返却時刻) のリスト（末尾が最新）
+        self.slots = threading.BoundedSemaphore(size)
+        self.requests = 0
+        self.connects = 0
+        self.errors = 0
+        self.latencies = deque(maxlen=256)        # 直近のリクエストの所要時間（秒）
+
+
+class HttpPool:
+    # 接続先ごとに keep-alive の接続を保持して使い回すHTTPクライアント（スレッドセーフ）
+    #
+    # urlopen は呼ぶたびにTCP/TLSの接続を張り直すため、1ステップで何度もAPIを呼ぶと
+    # ハンドシェイクの時間が積み重なる。ここでは接続先ごとに最大 max_per_host 本の
+    # 接続を保持し、空いている接続があれば再利用する（足りなければ空くまで待つ）。
+    # max_idle 秒以上使っていない接続はサーバー側で閉じられている可能性が高いので捨てる。
+    # limiter を渡すと全てのリクエストがその予算に従う
+
+    def __init__(self, max_per_host=4, timeout=30.0, max_idle=30.0, context=None,
+                 limiter=None, retries=3, max_wait=60.0):
+        self.max_per_host = max_per_host
+        self.timeout = timeout
+        self.max_idle = max_idle
+        # レート制限（RateLimiter）。max_wait 秒待っても予算が戻らなければ RateLimitTimeout
+        self.limiter = limiter
+        self.retries = retries
+        self.max_wait = max_wait
+        self.context = context or ssl.create_default_context()
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def _host(self, key):
+        with self.lock:
+            if key not in self.hosts:
+                self.hosts[key] = _HostPool(self.max_per_host)
+            return self.hosts[key]
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=timeout,
+                                               context=self.context)
+        return http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def _checkout(self, pool, key, timeout):
+        # 空いている接続を取り出す（なければ新しく作る）。再利用かどうかも返す
+        now = time.monotonic()
+        with self.lock:
+            while pool.idle:
+                conn, returned = pool.idle.pop()
+                if now - returned <= self.max_idle:
+                    conn.timeout = timeout
+                    if conn.sock is not None:
+                        conn.sock.settimeout(timeout)
+                    return conn, True
+                conn.close()
+            pool.connects += 1
+        return self._connect(key, timeout), False
+
+    def _checkin(self, pool, conn):
+        with self.lock:
+            pool.idle.append((conn, time.monotonic()))
+
+    def request(self, method, url, body=None, headers=None, timeout=None):
+        # リクエストを送り、レスポンスの本文を返す（2xx以外は HttpError）
+        #
+        # limiter があれば送る前に予算を使い、429/5xx ならバックオフを記録する。
+        # GETはバックオフのあと retries 回までやり直す（発注などは二重に送らない）
+        budget, cost, priority = self.limiter.classify(method, url) \
+            if self.limiter is not None else (None, 0, None)
+        attempt = 0
+        while True:
+            if budget is not None:
+                self.limiter.acquire(budget, cost, priority, timeout=self.max_wait)
+            status, reason, data, retry_after = self._request_once(method, url, body, headers,
+                                                                   timeout)
+            if 200 <= status < 300:
+                if budget is not None:
+                    self.limiter.success(budget)
+                return data
+            if budget is not None and (status == 429 or status >= 500):
+                self.limiter.penalize(budget, retry_after)
+                if method == 'GET' and attempt < self.retries:
+                    attempt += 1
+                    continue
+            raise HttpError(status, reason, data)
+
+    def _request_once(self, method, url, body, headers, timeout):
+        # 1回だけ送り、(ステータス, 理由, 本文, Retry-After秒) を返す
+        parts = parse.urlsplit(url)
+        scheme = parts.scheme or 'http'
+        if scheme not in ('http', 'https'):
+            raise ValueError(f'unsupported scheme: {scheme}')
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        timeout = self.timeout if timeout is None else timeout
+
+        pool = self._host(key)
+        if not pool.slots.acquire(timeout=timeout):
+            raise TimeoutError(f'no free connection to {parts.hostname}:{port} '
+                               f'within {timeout}s')
+        try:
+            start = time.perf_counter()
+            conn, reused = self._checkout(pool, key, timeout)
+            try:
+                try:
+                    response = self._send(conn, method, target, body, headers)
+                except STALE_ERRORS:
+                    # 再利用した接続が閉じられていた。GETなら新しい接続でやり直す
+                    # （発注などのPOSTは二重に送らないよう、そのままエラーにする）
+                    conn.close()
+                    if not reused or method != 'GET':
+                        raise
+                    logger.debug(f'stale connection to {parts.hostname}. reconnect')
+                    with self.lock:
+                        pool.connects += 1
+                    conn = self._connect(key, timeout)
+                    response = self._send(conn, method, target, body, headers)
+                data = response.read()
+            except Exception:
+                conn.close()
+                with self.lock:
+                    pool.errors += 1
+                raise
+            if response.will_close:
+                conn.close()
+            else:
+                self._checkin(pool, conn)
+            with self.lock:
+                pool.requests += 1
+                pool.latencies.append(time.perf_counter() - start)
+        finally:
+            pool.slots.release()
+
+        retry_after = response.getheader('Retry-After')
+        retry_after = float(retry_after) if retry_after and retry_after.isdigit() else None
+        return response.status, response.reason, data, retry_after
+
+    @staticmethod
+    def _send(conn, method, target, body, headers):
+        conn.request(method, target, body=body, headers=headers or {})
+        return conn.getresponse()
+
+    def get_json(self, url, timeout=None):
+        return json.loads(self.request('GET', url, timeout=timeout))
+
+    def request_json(self, method, url, body=None, headers=None, timeout=None):
+        return json.loads(self.request(method, url, body=body, headers=headers,
+                                       timeout=timeout))
+
+    def stats(self):
+        # 接続先ごとのリクエスト数・接続数・エラー数とレイテンシ（ミリ秒）
+        with self.lock:
+            result = {}
+            for (scheme, host, port), pool in self.hosts.items():
+                latencies = sorted(pool.latencies)
+                entry = {'requests': pool.requests, 'connects': pool.connects,
+                         'errors': pool.errors, 'idle': len(pool.idle)}
+                if latencies:
+                    entry['mean_ms'] = sum(latencies) / len(latencies) * 1000
+                    entry['p50_ms'] = latencies[len(latencies) // 2] * 1000
+                    entry['p95_ms'] = latencies[min(len(latencies) - 1,
+                                                    int(len(latencies) * 0.95))] * 1000
+                result[f'{scheme}://{host}:{port}'] = entry
+            return result
+
+    def close(self):
+        with self.lock:
+            for pool in self.hosts.values():
+                for conn, _ in pool.idle:
+                    conn.close()
+                pool.idle.clear()
+
+
+_shared = None
+_shared_lock = threading.Lock()
+
+
+def shared_pool():
+    # プロセス内の全アダプタで共有する接続プール（レート制限の予算も共有する）
+    global _shared
+    with _shared_lock:
+        if _shared is None:
+            _shared = HttpPool(limiter=RateLimiter())
+        return _shared
@@ -1,4 +1,8 @@
 import math
+import random
+from array import array
+from bisect import bisect_left
+from collections import deque
 
 
 def ema(values, span):
@@ -28,9 +32,8 @@ def sma(values, span):
     return result
 
 
-def atr(candles, span=14):
-    # ATR（Average True Range）を計算する
-    # 返り値は candles と同じ長さのリスト
+def true_ranges(candles):
+    # 各足のTrue Range（前の足の終値を考慮した値幅）を返す
     if not candles:
         return []
     trs = [candles[0].high - candles[0].low]
@@ -39,7 +42,13 @@ def atr(candles, span=14):
         prev_close = candles[i - 1].close
         tr = max(c.high - c.low, abs(c.high - prev_close), abs(c.low - prev_close))
         trs.append(tr)
-    return ema(trs, span)
+    return trs
+
+
+def atr(candles, span=14):
+    # ATR（Average True Range）を計算する
+    # 返り値は candles と同じ長さのリスト
+    return ema(true_ranges(candles), span)
 
 
 def realized_volatility(closes, span=24):
@@ -64,3 +73,491 @@ def donchian(candles, span):
         return (0.0, 0.0)
     window = candles[-span:]
     return (max(c.high for c in window), min(c.low for c in window))
+
+
+def breakout_bars(values, span):
+    # 各足の値が、その足を除いた直近span本の最大値を上回るか最小値を下回るかを返す
+    # （ドンチャンブレイクアウトが起こりうる足の判定。単調キューで全体をO(n)で求める）
+    result = [False] * len(values)
+    maxq = deque()  # 値が減少順になるように添字を保持する
+    minq = deque()  # 値が増加順になるように添字を保持する
+    for i, v in enumerate(values):
+        while maxq and maxq[0] < i - span:
+            maxq.popleft()
+        while minq and minq[0] < i - span:
+            minq.popleft()
+        if maxq:
+            result[i] = v > values[maxq[0]] or v < values[minq[0]]
+        while maxq and values[maxq[-1]] <= v:
+            maxq.pop()
+        maxq.append(i)
+        while minq and values[minq[-1]] >= v:
+            minq.pop()
+        minq.append(i)
+    return result
+
+
+def ema_many(values, spans):
+    # 複数の期間のEMAをまとめて計算する（値は ema() と完全に一致する）
+    # 同じ期間は1回だけ計算する。返り値は {期間: EMAのリスト}
+    return {span: ema(values, span) for span in sorted(set(spans))}
+
+
+def prior_bands(values, spans):
+    # 最後の値を除いた直近span本の最大値・最小値を、複数の期間についてまとめて求める
+    # 末尾から1回さかのぼるだけで全期間の値が決まる
+    # 返り値は {期間: (最大値, 最小値)}
+    spans = sorted(set(spans))
+    bands = {}
+    if len(values) < 2:
+        return {span: (0.0, 0.0) for span in spans}
+    high = low = values[-2]
+    k = 1
+    for span in spans:
+        while k < span and k < len(values) - 1:
+            k += 1
+            v = values[-1 - k]
+            if v > high:
+                high = v
+            if v < low:
+                low = v
+        bands[span] = (high, low)
+    return bands
+
+
+class SparseTable:
+    # 値の列の任意の区間の最大値・最小値を O(1) で答える索引（スパーステーブル）
+    # 構築は O(n log n)。level[k][i] は values[i:i + 2**k] の最大値（最小値）で、
+    # 区間 [lo, hi) は長さ 2**k の2つの区間の重なりで覆えるため2回の参照で求まる。
+    # 各段は array('d') に持つため、fork したワーカープロセスからコピーなしで読める。
+    # ドンチャンの期間をいくつ試しても、同じ系列なら1つの索引を共有できる
+
+    def __init__(self, values, times=None):
+        self.times = array('q', times) if times is not None else None
+        self.highs = [array('d', values)]
+        self.lows = [self.highs[0]]
+        n = len(values)
+        k = 1
+        while (1 << k) <= n:
+            half = 1 << (k - 1)
+            prev_high, prev_low = self.highs[-1], self.lows[-1]
+            size = n - (1 << k) + 1
+            self.highs.append(array('d', (max(prev_high[i], prev_high[i + half])
+                                          for i in range(size))))
+            self.lows.append(array('d', (min(prev_low[i], prev_low[i + half])
+                                         for i in range(size))))
+            k += 1
+
+    @classmethod
+    def from_candles(cls, candles):
+        # 終値の索引（時刻で位置を引けるようにする）
+        return cls([c.close for c in candles], [c.time for c in candles])
+
+    def __len__(self):
+        return len(self.highs[0])
+
+    def query(self, lo, hi):
+        # values[lo:hi] の (最大値, 最小値)
+        k = (hi - lo).bit_length() - 1
+        if k < 0:
+            raise ValueError(f'empty range: [{lo}, {hi})')
+        j = hi - (1 << k)
+        return (max(self.highs[k][lo], self.highs[k][j]),
+                min(self.lows[k][lo], self.lows[k][j]))
+
+    def prior_bands(self, index, span):
+        # index の値を除いた直近span本の (最大値, 最小値)（prior_bands と同じ定義）
+        if index < 1:
+            return (0.0, 0.0)
+        return self.query(max(0, index - span), index)
+
+    def bands_at(self, time, span):
+        # 時刻 time の足について prior_bands を返す（索引にない時刻なら None）
+        if self.times is None:
+            return None
+        index = bisect_left(self.times, time)
+        if index >= len(self.times) or self.times[index] != time:
+            return None
+        return self.prior_bands(index, span)
+
+
+class IndicatorBank:
+    # 1つのローソク足の列に対して、複数の期間のEMA・ATR・ブレイクアウト帯をまとめて計算し共有する
+    # 同じ期間を使う戦略同士では計算が1回で済む（期間の重複する複数戦略の評価用）
+
+    def __init__(self, candles, ema_spans=(), atr_spans=(), band_spans=()):
+        self.candles = candles
+        self.closes = [c.close for c in candles]
+        self._emas = ema_many(self.closes, ema_spans)
+        self._trs = None
+        self._atrs = {}
+        if atr_spans:
+            self._trs = true_ranges(candles)
+            self._atrs = ema_many(self._trs, atr_spans)
+        self._bands = prior_bands(self.closes, band_spans)
+
+    def ema(self, span):
+        # 終値のEMA（事前に指定していない期間はその場で計算して保持する）
+        if span not in self._emas:
+            self._emas[span] = ema(self.closes, span)
+        return self._emas[span]
+
+    def atr(self, span):
+        if span not in self._atrs:
+            if self._trs is None:
+                self._trs = true_ranges(self.candles)
+            self._atrs[span] = ema(self._trs, span)
+        return self._atrs[span]
+
+    def bands(self, span):
+        # 現在の足を除いた直近span本の終値の (最高値, 最安値)
+        if span not in self._bands:
+            self._bands.update(prior_bands(self.closes, [span]))
+        return self._bands[span]
+
+
+# --- 逐次更新型の指標 ---
+#
+# 各クラスは update() に1本分の値を渡すと、その時点の指標値を O(1) で返す（ライブの逐次計算用）。
+# 同名の関数はリスト全体に対して同じクラスを順に適用したもの（バックテストの一括計算用）で、
+# 両者の値は常に一致する。
+
+
+class EMA:
+    # 逐次更新版のEMA（値は ema() と一致する）
+
+    def __init__(self, span):
+        self.alpha = 2.0 / (span + 1)
+        self.value = None
+
+    def update(self, v):
+        if self.value is None:
+            self.value = v
+        else:
+            self.value = self.alpha * v + (1 - self.alpha) * self.value
+        return self.value
+
+
+class _Wilder(EMA):
+    # ワイルダーの平滑化（alpha = 1/span の指数平滑。RSI・ADXで使う）
+
+    def __init__(self, span):
+        super().__init__(span)
+        self.alpha = 1.0 / span
+
+
+class ATR:
+    # 逐次更新版のATR（値は atr() と一致する）
+
+    def __init__(self, span=14):
+        self.ema = EMA(span)
+        self.prev_close = None
+        self.value = 0.0
+
+    def update(self, candle):
+        if self.prev_close is None:
+            tr = candle.high - candle.low
+        else:
+            pc = self.prev_close
+            tr = max(candle.high - candle.low, abs(candle.high - pc), abs(candle.low - pc))
+        self.prev_close = candle.close
+        self.value = self.ema.update(tr)
+        return self.value
+
+
+class RollingStats:
+    # 直近span個の値の平均と標準偏差（母標準偏差）を合計・二乗和の差分更新で求める
+
+    def __init__(self, span):
+        self.span = span
+        self.window = deque()
+        self.total = 0.0
+        self.total_sq = 0.0
+
+    def update(self, v):
+        self.window.append(v)
+        self.total += v
+        self.total_sq += v * v
+        if len(self.window) > self.span:
+            old = self.window.popleft()
+            self.total -= old
+            self.total_sq -= old * old
+        return self.mean()
+
+    def mean(self):
+        return self.total / len(self.window) if self.window else 0.0
+
+    def std(self):
+        n = len(self.window)
+        if n < 2:
+            return 0.0
+        mean = self.total / n
+        # 差分更新の丸め誤差で負にならないようにする
+        return math.sqrt(max(self.total_sq / n - mean * mean, 0.0))
+
+
+class RSI:
+    # RSI（相対力指数）。上昇幅・下落幅をワイルダーの平滑化で平均する（0〜100）
+
+    def __init__(self, span=14):
+        self.gain = _Wilder(span)
+        self.loss = _Wilder(span)
+        self.prev = None
+        self.value = 50.0
+
+    def update(self, v):
+        if self.prev is not None:
+            change = v - self.prev
+            gain = self.gain.update(max(change, 0.0))
+            loss = self.loss.update(max(-change, 0.0))
+            if loss > 0:
+                self.value = 100.0 - 100.0 / (1.0 + gain / loss)
+            else:
+                self.value = 100.0 if gain > 0 else 50.0
+        self.prev = v
+        return self.value
+
+
+class BollingerWidth:
+    # ボリンジャーバンドの幅（(上限 - 下限) / 中心線）
+
+    def __init__(self, span=20, mult=2.0):
+        self.stats = RollingStats(span)
+        self.mult = mult
+
+    def update(self, v):
+        mean = self.stats.update(v)
+        if mean == 0:
+            return 0.0
+        return 2.0 * self.mult * self.stats.std() / mean
+
+
+class Keltner:
+    # ケルトナーチャネル（中心線: 終値のEMA、幅: ATR×係数）。(中心線, 上限, 下限) を返す
+
+    def __init__(self, span=20, mult=2.0, atr_span=None):
+        self.ema = EMA(span)
+        self.atr = ATR(atr_span or span)
+        self.mult = mult
+
+    def update(self, candle):
+        middle = self.ema.update(candle.close)
+        width = self.mult * self.atr.update(candle)
+        return (middle, middle + width, middle - width)
+
+
+class ADX:
+    # ADX（トレンドの強さ。方向は問わない 0〜100）
+    # +DI / -DI は plus_di / minus_di で参照できる
+
+    def __init__(self, span=14):
+        self.tr = _Wilder(span)
+        self.plus_dm = _Wilder(span)
+        self.minus_dm = _Wilder(span)
+        self.dx = _Wilder(span)
+        self.prev = None
+        self.plus_di = 0.0
+        self.minus_di = 0.0
+        self.value = 0.0
+
+    def update(self, candle):
+        prev = self.prev
+        self.prev = candle
+        if prev is None:
+            return self.value
+        up = candle.high - prev.high
+        down = prev.low - candle.low
+        tr = max(candle.high - candle.low, abs(candle.high - prev.close),
+                 abs(candle.low - prev.close))
+        tr_avg = self.tr.update(tr)
+        plus = self.plus_dm.update(up if up > down and up > 0 else 0.0)
+        minus = self.minus_dm.update(down if down > up and down > 0 else 0.0)
+        if tr_avg > 0:
+            self.plus_di = 100.0 * plus / tr_avg
+            self.minus_di = 100.0 * minus / tr_avg
+        di_sum = self.plus_di + self.minus_di
+        dx = 100.0 * abs(self.plus_di - self.minus_di) / di_sum if di_sum > 0 else 0.0
+        self.value = self.dx.update(dx)
+        return self.value
+
+
+class ZScore:
+    # 直近span個の平均からの乖離を標準偏差で割った値
+
+    def __init__(self, span=20):
+        self.stats = RollingStats(span)
+
+    def update(self, v):
+        mean = self.stats.update(v)
+        std = self.stats.std()
+        return (v - mean) / std if std > 0 else 0.0
+
+
+def rsi(values, span=14):
+    ind = RSI(span)
+    return [ind.update(v) for v in values]
+
+
+def bollinger_width(values, span=20, mult=2.0):
+    ind = BollingerWidth(span, mult)
+    return [ind.update(v) for v in values]
+
+
+def keltner(candles, span=20, mult=2.0, atr_span=None):
+    ind = Keltner(span, mult, atr_span)
+    return [ind.update(c) for c in candles]
+
+
+def adx(candles, span=14):
+    ind = ADX(span)
+    return [ind.update(c) for c in candles]
+
+
+def zscore(values, span=20):
+    ind = ZScore(span)
+    return [ind.update(v) for v in values]
+
+
+# --- 順序統計量（中央値・分位点） ---
+
+class IndexableSkiplist:
+    # 順位で要素を引ける整列済みの列（インデックス付きスキップリスト）
+    # 挿入・削除・順位による参照がいずれも O(log n)。各リンクは飛び越す要素数（幅）を持つ
+
+    MAX_LEVELS = 24
+
+    def __init__(self, seed=0):
+        # ノードは [値, 次のノードのリスト, 幅のリスト]。末尾の番兵は値が無限大
+        self.nil = [math.inf, [], []]
+        self.head = [None, [self.nil] * self.MAX_LEVELS, [1] * self.MAX_LEVELS]
+        self.size = 0
+        self.rng = random.Random(seed)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError(i)
+        node = self.head
+        i += 1
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node[2][level] <= i:
+                i -= node[2][level]
+                node = node[1][level]
+        return node[0]
+
+    def insert(self, value):
+        levels = 1
+        while levels < self.MAX_LEVELS and self.rng.random() < 0.5:
+            levels += 1
+        # 各段で挿入位置の直前のノードと、先頭からの距離を求める
+        chain = [None] * self.MAX_LEVELS
+        steps = [0] * self.MAX_LEVELS
+        node = self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node[1][level][0] <= value:
+                steps[level] += node[2][level]
+                node = node[1][level]
+            chain[level] = node
+        new = [value, [None] * levels, [0] * levels]
+        distance = 0
+        for level in range(levels):
+            prev = chain[level]
+            new[1][level] = prev[1][level]
+            prev[1][level] = new
+            new[2][level] = prev[2][level] - distance
+            prev[2][level] = distance + 1
+            distance += steps[level]
+        for level in range(levels, self.MAX_LEVELS):
+            chain[level][2][level] += 1
+        self.size += 1
+
+    def remove(self, value):
+        chain = [None] * self.MAX_LEVELS
+        node = self.head
+        for level in reversed(range(self.MAX_LEVELS)):
+            while node[1][level][0] < value:
+                node = node[1][level]
+            chain[level] = node
+        target = chain[0][1][0]
+        if target is self.nil or target[0] != value:
+            raise KeyError(value)
+        for level in range(len(target[1])):
+            prev = chain[level]
+            prev[2][level] += target[2][level] - 1
+            prev[1][level] = target[1][level]
+        for level in range(len(target[1]), self.MAX_LEVELS):
+            chain[level][2][level] -= 1
+        self.size -= 1
+
+
+class RollingQuantile:
+    # 直近span個の値の分位点。update は O(log span)（窓ごとに並べ直さない）
+    # update() は分位点 q の値を返す。他の分位点は quantile() で引ける
+
+    def __init__(self, span, q=0.5):
+        self.span = span
+        self.q = q
+        self.window = deque()
+        self.sorted = IndexableSkiplist()
+
+    def update(self, v):
+        self.window.append(v)
+        self.sorted.insert(v)
+        if len(self.window) > self.span:
+            self.sorted.remove(self.window.popleft())
+        return self.quantile(self.q)
+
+    def quantile(self, q):
+        # 順位の線形補間による分位点（q=0で最小値、q=1で最大値）
+        n = len(self.sorted)
+        if n == 0:
+            return 0.0
+        pos = q * (n - 1)
+        lo = int(pos)
+        low = self.sorted[lo]
+        if lo + 1 >= n or pos == lo:
+            return low
+        return low + (self.sorted[lo + 1] - low) * (pos - lo)
+
+
+class MedianTrueRange:
+    # 直近span本の真の値幅（TR）の中央値。急変した1本に引きずられにくいATRの代替
+
+    def __init__(self, span):
+        self.median = RollingQuantile(span, 0.5)
+        self.prev_close = None
+
+    def update(self, candle):
+        if self.prev_close is None:
+            tr = candle.high - candle.low
+        else:
+            pc = self.prev_close
+            tr = max(candle.high - candle.low, abs(candle.high - pc), abs(candle.low - pc))
+        self.prev_close = candle.close
+        return self.median.update(tr)
+
+
+def rolling_quantile(values, span, q=0.5):
+    ind = RollingQuantile(span, q)
+    return [ind.update(v) for v in values]
+
+
+def rolling_median(values, span):
+    return rolling_quantile(values, span, 0.5)
+
+
+def median_true_range(candles, span=14):
+    ind = MedianTrueRange(span)
+    return [ind.update(c) for c in candles]
+
+
+def quantile_bands(values, span, q):
+    # 最後の値を除いた直近span本の (1-q 分位点, q 分位点)。q=0 で prior_bands と同じ
+    ind = RollingQuantile(span)
+    for v in values[-span - 1:-1]:
+        ind.update(v)
+    return (ind.quantile(1.0 - q), ind.quantile(q))
@@ -0,0 +1,151 @@
+import json
+import os
+import threading
+import time
+
+
+from . import get_module_logger
+
+
+logger = get_module_logger()
+
+
+class StateJournal:
+    # 口座状態（product_code -> 口座の辞書）を、スナップショット + 追記専用のジャーナルで
+    # 永続化する
+    #
+    # - 変更は record() で「変わった項目だけ」をジャーナル（path + '.journal'、JSON Lines）に
+    #   追記する。1件あたりO(1)で、状態全体は書き直さない
+    # - fsync はまとめて行う（fsync_every 件ごと、または fsync_interval 秒ごと）。
+    #   約定など失いたくない変更は sync=True ですぐに fsync する
+    # - ジャーナルが compact_every 件を超えたら、状態全体をスナップショット（path）に
+    #   書き出してジャーナルを空にする。スナップショットは一時ファイルに書いてから
+    #   置き換えるので、途中で落ちても壊れない
+    # - 起動時はスナップショットを読み、それより新しいジャーナルを順に適用する。
+    #   書きかけで途切れた最後の行は捨てる
+
+    def __init__(self, path, fsync_every=32, fsync_interval=1.0, compact_every=1000):
+        self.path = path
+        self.journal_path = path + '.journal'
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.state = {}
+        self.seq = 0            # 最後に記録した変更の番号
+        self.records = 0        # ジャーナルに残っている件数
+        self.pending = 0        # まだ fsync していない件数
+        self.last_sync = time.monotonic()
+        self.file = None
+        self.lock = threading.RLock()
+
+    def load(self):
+        # スナップショットとジャーナルから状態を復元して返す（以降この辞書を更新していく）
+        with self.lock:
+            state, seq = {}, 0
+            if os.path.exists(self.path):
+                with open(self.path) as f:
+                    snapshot = json.load(f)
+                if 'accounts' in snapshot:
+                    state, seq = snapshot['accounts'], int(snapshot.get('seq', 0))
+                else:
+                    # 旧形式（状態の辞書をそのまま書いたファイル）
+                    state = snapshot
+            replayed = 0
+            if os.path.exists(self.journal_path):
+                with open(self.journal_path, 'rb+') as f:
+                    good = 0  # 正しく読めた最後の行の終わり
+                    for line in f:
+                        try:
+                            if not line.endswith(b'\n'):
+                                raise ValueError('no newline')
+                            entry = json.loads(line)
+                            entry_seq, code, changes = entry['seq'], entry['code'], entry['set']
+                            if not isinstance(entry_seq, int) or not isinstance(code, str) or \
+                                    not isinstance(changes, dict):
+                                raise TypeError('unexpected field types')
+                        except (ValueError, KeyError, TypeError) as e:
+                            # 書きかけ・壊れた行から後ろは捨てる（後ろに追記しても読めるよう切り詰める）
+                            logger.warning(f'ignore a broken journal record in {self.journal_path}: '
+                                           f'{e!r}')
+                            f.truncate(good)
+                            break
+                        good += len(line)
+                        if entry_seq <= seq:
+                            continue  # スナップショットに含まれている
+                        state.setdefault(code, {}).update(changes)
+                        seq = entry_seq
+                        replayed += 1
+            self.state = state
+            self.seq = seq
+            self.records = replayed
+            if replayed:
+                logger.debug(f'replayed {replayed} journal records from {self.journal_path}')
+            return state
+
+    def record(self, code, changes, sync=False):
+        # 口座 code の変更（項目 -> 新しい値）を追記する
+        with self.lock:
+            if self.file is None:
+                os.makedirs(os.path.dirname(self.journal_path) or '.', exist_ok=True)
+                self.file = open(self.journal_path, 'a')
+            self.seq += 1
+            self.file.write(json.dumps({'seq': self.seq, 'code': code, 'set': changes},
+                                       separators=(',', ':')) + '\n')
+            self.file.flush()
+            self.records += 1
+            self.pending += 1
+            if sync or self.pending >= self.fsync_every or \
+                    time.monotonic() - self.last_sync >= self.fsync_interval:
+                self.sync()
+            if self.records >= self.compact_every:
+                self.compact()
+
+    def sync(self):
+        with self.lock:
+            if self.file is not None and self.pending:
+                os.fsync(self.file.fileno())
+            self.pending = 0
+            self.last_sync = time.monotonic()
+
+    def compact(self):
+        # 状態全体をスナップショットに書き出し、ジャーナルを空にする
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp = self.path + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'seq': self.seq, 'accounts': self.state}, f, indent=2)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp, self.path)
+            _fsync_dir(os.path.dirname(self.path) or '.')
+            # ここで落ちてもスナップショットの seq 以前の記録は読み飛ばされる
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            with open(self.journal_path, 'w'):
+                pass
+            self.records = 0
+            self.pending = 0
+            logger.debug(f'compacted paper state into {self.path} (seq={self.seq})')
+
+    def close(self):
+        with self.lock:
+            if self.records:
+                self.compact()
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+def _fsync_dir(path):
+    # 置き換えたファイル名をディスクに確定させる（対応していない環境では何もしない）
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
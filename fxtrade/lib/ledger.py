@@ -0,0 +1,187 @@
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+
+from . import get_module_logger
+
+
+logger = get_module_logger()
+
+
+DEFAULT_LEDGER_PATH = 'docs/artifacts/ledger.sqlite3'
+
+# 時刻はすべてエポック秒（バックテストは足の時刻、ペーパー・本番は記録した時刻）
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY, mode TEXT NOT NULL, started REAL NOT NULL, note TEXT);
+CREATE TABLE IF NOT EXISTS orders (
+    run_id TEXT NOT NULL, product TEXT NOT NULL, time REAL NOT NULL, side TEXT NOT NULL,
+    size REAL NOT NULL, price REAL, status TEXT NOT NULL, order_id TEXT);
+CREATE TABLE IF NOT EXISTS fills (
+    run_id TEXT NOT NULL, product TEXT NOT NULL, time REAL NOT NULL, side TEXT NOT NULL,
+    size REAL NOT NULL, price REAL NOT NULL, ref_price REAL, slippage REAL,
+    fee REAL NOT NULL, order_id TEXT);
+CREATE TABLE IF NOT EXISTS swaps (
+    run_id TEXT NOT NULL, product TEXT NOT NULL, time REAL NOT NULL, amount REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS equity (
+    run_id TEXT NOT NULL, product TEXT NOT NULL, time REAL NOT NULL, equity REAL NOT NULL,
+    position REAL);
+'''
+
+COLUMNS = {
+    'orders': ('run_id', 'product', 'time', 'side', 'size', 'price', 'status', 'order_id'),
+    'fills': ('run_id', 'product', 'time', 'side', 'size', 'price', 'ref_price', 'slippage',
+              'fee', 'order_id'),
+    'swaps': ('run_id', 'product', 'time', 'amount'),
+    'equity': ('run_id', 'product', 'time', 'equity', 'position'),
+}
+
+
+def _indexes():
+    # 銘柄 + 時刻（期間の絞り込み）、実行ID、時刻だけの索引を各テーブルに張る
+    for table in COLUMNS:
+        yield f'CREATE INDEX IF NOT EXISTS {table}_product_time ON {table} (product, time)'
+        yield f'CREATE INDEX IF NOT EXISTS {table}_run ON {table} (run_id, time)'
+        yield f'CREATE INDEX IF NOT EXISTS {table}_time ON {table} (time)'
+
+
+class Ledger:
+    # 注文・約定・手数料・スワップ・資産評価額を記録するSQLiteの台帳（スレッドセーフ）
+    #
+    # バックテスト・ペーパートレード・本番のいずれも同じテーブルに書き、run_id（実行ごとの
+    # ID）と mode で区別する。WALモードで開くので、書き込み中でも別プロセスから集計できる。
+    # 記録はメモリに溜めて batch 件ごとにまとめて INSERT する（記録した時点で前回の書き込みから
+    # flush_interval 秒以上経っていればその時点で書く。タイマーは持たないので、記録の間隔が
+    # 空くペーパー・本番では batch=1 で1件ずつ書く）。
+    # 約定のスリッページは基準価格に対して不利な方向を正とした比率（0.001 = 0.1%）で持つ
+    # スワップの負の額は払い戻し（バックテストで足の途中にストップで決済した場合）
+
+    def __init__(self, path=DEFAULT_LEDGER_PATH, mode='', run_id=None, note=None,
+                 batch=500, flush_interval=1.0, clock=time.time):
+        self.path = path
+        self.mode = mode
+        self.run_id = run_id or f'{mode or "run"}-{time.strftime("%Y%m%d-%H%M%S")}-' \
+                                f'{uuid.uuid4().hex[:6]}'
+        self.batch = batch
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.pending = {table: [] for table in COLUMNS}
+        self.count = 0
+        self.last_flush = time.monotonic()
+        self.lock = threading.RLock()
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        # 複数のプロセス（並列バックテストなど）が同時に書いても待つように timeout を長めにする
+        self.conn = sqlite3.connect(path, timeout=30.0, check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        with self.conn:
+            self.conn.executescript(SCHEMA)
+            for sql in _indexes():
+                self.conn.execute(sql)
+            self.conn.execute('INSERT OR IGNORE INTO runs VALUES (?, ?, ?, ?)',
+                              (self.run_id, mode, self.clock(), note))
+
+    # --- 記録 ---
+
+    def record_order(self, product, side, size, status, price=None, order_id=None, time=None):
+        # status: 'filled' / 'rejected' / 'accepted'（本番で約定待ち） / 'failed' / 'dryrun'
+        self._add('orders', (product, self._time(time), side, size, price, status, order_id))
+
+    def record_fill(self, product, side, size, price, fee=0.0, ref_price=None, order_id=None,
+                    time=None):
+        slippage = None
+        if ref_price:
+            slippage = (price - ref_price) / ref_price * (1 if side == 'BUY' else -1)
+        self._add('fills', (product, self._time(time), side, size, price, ref_price,
+                            slippage, fee, order_id))
+
+    def record_swap(self, product, amount, time=None):
+        self._add('swaps', (product, self._time(time), amount))
+
+    def record_equity(self, product, equity, position=None, time=None):
+        self._add('equity', (product, self._time(time), equity, position))
+
+    def record_equity_curve(self, product, curve):
+        # バックテストの資産推移 [(時刻, 資産), ...] をまとめて記録する
+        with self.lock:
+            self.pending['equity'].extend((product, t, eq, None) for t, eq in curve)
+            self.count += len(curve)
+            self.flush()
+
+    def _time(self, t):
+        return self.clock() if t is None else t
+
+    def _add(self, table, row):
+        with self.lock:
+            self.pending[table].append(row)
+            self.count += 1
+            if self.count >= self.batch or \
+                    time.monotonic() - self.last_flush >= self.flush_interval:
+                self.flush()
+
+    def flush(self):
+        # 溜めている記録を1つのトランザクションで書き込む
+        with self.lock:
+            if self.count:
+                with self.conn:
+                    for table, rows in self.pending.items():
+                        if not rows:
+                            continue
+                        columns = COLUMNS[table]
+                        sql = f'INSERT INTO {table} ({", ".join(columns)}) ' \
+                              f'VALUES ({", ".join("?" * len(columns))})'
+                        self.conn.executemany(sql, [(self.run_id,) + row for row in rows])
+                        rows.clear()
+                self.count = 0
+            self.last_flush = time.monotonic()
+
+    def close(self):
+        with self.lock:
+            if self.conn is None:
+                return
+            self.flush()
+            self.conn.close()
+            self.conn = None
+
+    # --- 集計 ---
+
+    def query(self, sql, params=()):
+        # 任意のSQLで集計する（溜めている記録は先に書き込む）。行は辞書で返す
+        with self.lock:
+            self.flush()
+            cursor = self.conn.execute(sql, params)
+            names = [d[0] for d in cursor.description]
+            return [dict(zip(names, row)) for row in cursor.fetchall()]
+
+    def fills(self, product=None, start=None, end=None, run_id=None, min_slippage=None):
+        # 約定を時刻順に返す（例: 3月の FX_BTC_JPY でスリッページが0.1%を超えた約定）
+        where, params = [], []
+        for clause, value in (('product = ?', product), ('time >= ?', start),
+                              ('time < ?', end), ('run_id = ?', run_id),
+                              ('slippage > ?', min_slippage)):
+            if value is not None:
+                where.append(clause)
+                params.append(value)
+        sql = 'SELECT * FROM fills'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        return self.query(sql + ' ORDER BY time', params)
+
+
+def ledger_from_config(setting, mode):
+    # 設定値（true / ファイルのパス / 未設定）から台帳を開く。未設定なら None
+    if not setting:
+        return None
+    path = setting if isinstance(setting, str) else DEFAULT_LEDGER_PATH
+    try:
+        # 1サイクルに数件しか記録しないので、溜めずにすぐ書き込む（次の記録が数時間後でも残る）
+        ledger = Ledger(path, mode=mode, batch=1)
+    except sqlite3.Error as e:
+        logger.warning(f'failed to open ledger {path}: {e}. trades are not recorded')
+        return None
+    logger.info(f'recording trades to {path} (run_id={ledger.run_id})')
+    return ledger
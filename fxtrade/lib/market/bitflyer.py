@@ -1,14 +1,17 @@
 import hashlib
 import hmac
 import json
+import threading
 import time
-from urllib import request
+from datetime import datetime, timezone
 
 
 from .. import get_module_logger, anonymization
-from ..exchange import ExchangeAdapter, ProductSpec
-from ..history import fetch_recent_binance_klines
-from ..candles import Candle
+from ..exchange import ExchangeAdapter, ProductSpec, SnapshotCache
+from ..feed import CandleFeed, scale_candles
+from ..httpclient import shared_pool
+from ..ledger import ledger_from_config
+from ..realtime import realtime_from_config
 
 
 logger = get_module_logger()
@@ -35,6 +38,20 @@ class BitFlyerExchange(ExchangeAdapter):
         # 例: {"ETH": 0.6875} → 既存保有の0.6875 ETHには手を触れない
         self.spot_reserves = self.config.get('spot-reserves') or {}
         self._price_cache = {}
+        self.feeds = {}  # product_code -> CandleFeed
+        # realtime を有効にすると価格はWebSocketで受信した最新値を使う（古ければポーリング）
+        self.realtime = realtime_from_config(self.config.get('realtime'))
+        # APIの呼び出しはプロセス共有の接続プールを通す（keep-aliveで接続を使い回す）
+        self.http = shared_pool()
+        # 残高・証拠金・建玉・ティッカーは snapshot-ttl 秒だけ使い回す（発注すると捨てる）
+        # 1サイクルの中で get_position / get_equity / 発注前の確認が同じAPIを呼ぶため
+        self.snapshot = SnapshotCache(ttl=float(self.config.get('snapshot-ttl', 5.0)))
+        # ledger を指定すると注文・約定・資産評価額をSQLiteの台帳に記録する。
+        # 成行注文の約定は発注の応答に含まれないので、次に口座を確認するときに
+        # 受付IDで約定履歴を取得して記録する
+        self.ledger = ledger_from_config(self.config.get('ledger'), 'live')
+        self._unsettled = {}  # 受付ID -> [spec, side, size, 発注時の価格, 確認した回数]
+        self._unsettled_lock = threading.Lock()
         logger.debug(f'BitFlyerExchange initialized. key={anonymization(self.key)} '
                      f'dryrun={self.is_dryrun}')
 
@@ -53,42 +70,65 @@ class BitFlyerExchange(ExchangeAdapter):
         }
         if body is not None:
             headers['Content-Type'] = 'application/json'
-        data = body_str.encode() if body is not None else b''
+        data = body_str.encode() if body is not None else None
         logger.debug(f'call api: {method} {self.url + path}')
-        req = request.Request(self.url + path, data, headers, method=method)
-        with request.urlopen(req, timeout=30) as response:
-            return json.loads(response.read())
+        return self.http.request_json(method, self.url + path, body=data,
+                                      headers=headers, timeout=30)
 
     def _public_request(self, path):
         logger.debug(f'call api: GET {self.url + path}')
-        with request.urlopen(self.url + path, timeout=30) as response:
-            return json.loads(response.read())
+        return self.http.get_json(self.url + path, timeout=30)
+
+    def _snapshot(self, key, path, public=False):
+        # GETの結果をスナップショットから返す（なければ取得する）
+        if public:
+            return self.snapshot.get(key, lambda: self._public_request(path))
+        return self.snapshot.get(key, lambda: self._private_request('GET', path))
 
     # --- 市場データ ---
 
     def get_candles(self, spec, limit):
+        feed = self._feed(spec, limit)
         try:
-            candles = fetch_recent_binance_klines(spec.symbol, self.candle_interval,
-                                                  limit=min(limit + 1, 1000))
+            feed.update()
         except Exception as e:
             logger.warning(f'failed to fetch candles: {e}')
             return []
-        if not candles:
+        if not feed.candles:
             return []
-        candles = candles[:-1]  # 最後の1本は未確定足なので除外する
+        # bitFlyerの現在価格との比率でJPY相当にスケーリングする
+        return scale_candles(list(feed.candles)[-limit:], self.get_price(spec))
+
+    def latest_candle_time(self, spec):
+        # 前回以降に確定した足だけを取得し、最新の確定足の時刻を返す
+        feed = self.feeds.get(spec.code)
+        if feed is None:
+            return None
+        try:
+            feed.update()
+        except Exception as e:
+            logger.warning(f'failed to fetch candles: {e}')
+            return None
+        return feed.last_time()
 
-        bf_price = self.get_price(spec)
-        if bf_price > 0 and candles[-1].close > 0:
-            rate = bf_price / candles[-1].close
-        else:
-            rate = 1.0
-        return [Candle(time=c.time, open=c.open * rate, high=c.high * rate,
-                       low=c.low * rate, close=c.close * rate,
-                       volume=c.volume) for c in candles]
+    def _feed(self, spec, limit):
+        # 銘柄ごとの確定足のフィード（必要な本数が増えたら作り直す）
+        feed = self.feeds.get(spec.code)
+        if feed is None or feed.limit < limit:
+            feed = CandleFeed(spec.symbol, self.candle_interval, limit)
+            self.feeds[spec.code] = feed
+        return feed
 
     def get_price(self, spec):
+        if self.realtime is not None:
+            self.realtime.watch(spec.code)
+            price = self.realtime.price(spec.code)
+            if price:
+                self._price_cache[spec.code] = price
+                return price
         try:
-            ticker = self._public_request(f'/v1/getticker?product_code={spec.code}')
+            ticker = self._snapshot(('ticker', spec.code),
+                                    f'/v1/getticker?product_code={spec.code}', public=True)
             price = float(ticker.get('ltp', 0))
             if price > 0:
                 self._price_cache[spec.code] = price
@@ -100,10 +140,11 @@ class BitFlyerExchange(ExchangeAdapter):
     # --- 口座情報 ---
 
     def get_equity(self, spec):
+        self._settle_fills()
         try:
             if spec.spot:
                 # 現物: 日本円残高 + 運用対象の保有数量（予約残高を除く）の評価額
-                balances = self._private_request('GET', '/v1/me/getbalance')
+                balances = self._snapshot(('balance',), '/v1/me/getbalance')
                 jpy = 0.0
                 coin = 0.0
                 currency = spec.code.split('_')[0]  # 'ETH_JPY' -> 'ETH'
@@ -119,16 +160,18 @@ class BitFlyerExchange(ExchangeAdapter):
                 logger.info(f'equity [{spec.name}]: {equity:,.0f} JPY '
                             f'(JPY={jpy:,.0f}, {currency}={coin}, '
                             f'reserved={reserve}, tradable={tradable})')
+                self._ledger('record_equity', spec.code, equity, tradable)
                 return equity
             else:
                 # FX: 証拠金 + 評価損益
-                collateral = self._private_request('GET', '/v1/me/getcollateral')
+                collateral = self._snapshot(('collateral',), '/v1/me/getcollateral')
                 equity = float(collateral.get('collateral', 0)) + \
                     float(collateral.get('open_position_pnl', 0))
                 logger.info(f'equity [{spec.name}]: {equity:,.0f} JPY '
                             f'(collateral={collateral.get("collateral")}, '
                             f'pnl={collateral.get("open_position_pnl")}, '
                             f'keep_rate={collateral.get("keep_rate")})')
+                self._ledger('record_equity', spec.code, equity)
                 return equity
         except Exception as e:
             logger.warning(f'failed to get equity: {e}')
@@ -137,7 +180,7 @@ class BitFlyerExchange(ExchangeAdapter):
     def get_position(self, spec):
         try:
             if spec.spot:
-                balances = self._private_request('GET', '/v1/me/getbalance')
+                balances = self._snapshot(('balance',), '/v1/me/getbalance')
                 currency = spec.code.split('_')[0]
                 for b in balances:
                     if b.get('currency_code') == currency:
@@ -146,8 +189,8 @@ class BitFlyerExchange(ExchangeAdapter):
                         return max(float(b.get('amount', 0)) - reserve, 0.0)
                 return 0.0
             else:
-                positions = self._private_request(
-                    'GET', f'/v1/me/getpositions?product_code={spec.code}')
+                positions = self._snapshot(('positions', spec.code),
+                                           f'/v1/me/getpositions?product_code={spec.code}')
                 size = 0.0
                 for p in positions:
                     if p.get('side') == 'BUY':
@@ -179,15 +222,85 @@ class BitFlyerExchange(ExchangeAdapter):
             'size': size,
         }
 
+        price = self._price_cache.get(spec.code)
         if self.is_dryrun:
             logger.info(f'trade [{spec.name}]: {side} {size} dryrun (order not sent)')
+            self._ledger('record_order', spec.code, side, size, 'dryrun', price=price)
             return 0
 
         try:
             result = self._private_request('POST', '/v1/me/sendchildorder', body)
+            acceptance_id = result.get('child_order_acceptance_id')
             logger.info(f'trade [{spec.name}]: {side} {size} success. '
-                        f'acceptance_id={result.get("child_order_acceptance_id")}')
+                        f'acceptance_id={acceptance_id}')
+            self._ledger('record_order', spec.code, side, size, 'accepted', price=price,
+                         order_id=acceptance_id)
+            if self.ledger is not None and acceptance_id:
+                with self._unsettled_lock:
+                    self._unsettled[acceptance_id] = [spec, side, size, price, 0]
             return 1
         except Exception as e:
             logger.warning(f'trade [{spec.name}]: {side} {size} failed. error: {e}')
+            self._ledger('record_order', spec.code, side, size, 'failed', price=price)
             return -1
+        finally:
+            # 失敗しても約定している可能性があるので、口座情報は取り直す
+            self.snapshot.invalidate(keep=lambda key: key[0] == 'ticker')
+
+    # --- 台帳 ---
+
+    # 約定履歴を確認する回数の上限（それでも揃わなければ取得できた分だけ記録する）
+    SETTLE_ATTEMPTS = 5
+
+    def _settle_fills(self):
+        # 約定待ちの注文の約定履歴を取得して台帳に記録する
+        # （別のスレッドと同じ注文を二重に記録しないよう、取り出してから確認する）
+        with self._unsettled_lock:
+            pending = list(self._unsettled.items())
+            self._unsettled.clear()
+        for acceptance_id, entry in pending:
+            spec, side, size, price, attempts = entry
+            try:
+                executions = self._private_request(
+                    'GET', f'/v1/me/getexecutions?product_code={spec.code}'
+                           f'&child_order_acceptance_id={acceptance_id}')
+            except Exception as e:
+                logger.debug(f'failed to get executions of {acceptance_id}: {e}')
+                executions = []
+            filled = sum(float(x.get('size', 0)) for x in executions)
+            entry[4] = attempts = attempts + 1
+            if filled < size * (1 - 1e-9) and attempts < self.SETTLE_ATTEMPTS:
+                with self._unsettled_lock:
+                    self._unsettled[acceptance_id] = entry
+                continue
+            if filled < size * (1 - 1e-9):
+                logger.warning(f'[{spec.name}] only {filled} of {size} filled for {acceptance_id}')
+            for x in executions:
+                fill_price = float(x.get('price', 0))
+                # 手数料は数量（BTC/ETH）で返るので円に換算する
+                fee = float(x.get('commission') or 0) * fill_price
+                self._ledger('record_fill', spec.code, x.get('side', side),
+                             float(x.get('size', 0)), fill_price, fee=fee, ref_price=price,
+                             order_id=acceptance_id, time=_exec_time(x.get('exec_date')))
+
+    def _ledger(self, method, *args, **kwargs):
+        # 台帳に記録する（記録に失敗しても取引は続ける）
+        if self.ledger is None:
+            return
+        try:
+            getattr(self.ledger, method)(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f'failed to write the ledger: {e}')
+
+    def close(self):
+        if self.ledger is not None:
+            self._settle_fills()
+            self._ledger('close')
+
+
+def _exec_time(text):
+    # 約定日時（'2015-07-07T09:57:40.397'、UTC）をエポック秒にする。読めなければ現在時刻
+    try:
+        return datetime.fromisoformat(text.rstrip('Z')).replace(tzinfo=timezone.utc).timestamp()
+    except (AttributeError, ValueError):
+        return time.time()
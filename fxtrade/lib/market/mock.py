@@ -1,13 +1,14 @@
-import json
-import os
+import threading
 import time
-from urllib import request
 
 
 from .. import get_module_logger
-from ..exchange import ExchangeAdapter, ProductSpec
-from ..history import fetch_recent_binance_klines
-from ..candles import Candle
+from ..exchange import ExchangeAdapter, ProductSpec, SnapshotCache
+from ..feed import CandleFeed, scale_candles
+from ..httpclient import shared_pool
+from ..journal import StateJournal
+from ..ledger import ledger_from_config
+from ..realtime import realtime_from_config
 
 
 logger = get_module_logger()
@@ -36,74 +37,128 @@ class PaperExchange(ExchangeAdapter):
         self.spot_fee_rate = float(config.get('spot-fee-rate', 0.0015))
         self.candle_interval = config.get('candle-interval', '1h')
         self.state_path = state_path or config.get('state-path', DEFAULT_STATE_PATH)
+        # 銘柄ごとのエンジンが別スレッドから同時に呼ぶため、口座状態の更新と保存は排他する
+        self.lock = threading.RLock()
+        # 口座状態は変更のたびに全体を書き直さず、変わった項目をジャーナルに追記する
+        self.journal = StateJournal(self.state_path,
+                                    compact_every=int(config.get('compact-every', 1000)))
         self.state = self._load_state()
         self._price_cache = {}
+        self.feeds = {}  # product_code -> CandleFeed
+        # realtime を有効にすると価格はWebSocketで受信した最新値を使う（古ければポーリング）
+        self.realtime = realtime_from_config(config.get('realtime'))
+        self.http = shared_pool()
+        # ティッカーは snapshot-ttl 秒だけ使い回す（1サイクルで足の換算・評価額・約定に使う）
+        self.snapshot = SnapshotCache(ttl=float(config.get('snapshot-ttl', 5.0)))
+        # ledger を指定すると注文・約定・スワップ・資産評価額をSQLiteの台帳に記録する
+        self.ledger = ledger_from_config(config.get('ledger'), 'paper')
 
     # --- 口座状態の永続化 ---
 
     def _load_state(self):
-        if os.path.exists(self.state_path):
-            try:
-                with open(self.state_path) as f:
-                    state = json.load(f)
+        # スナップショットとジャーナルから復元する（旧形式の状態ファイルもそのまま読める）
+        try:
+            state = self.journal.load()
+            if state:
                 logger.info(f'loaded paper trading state from {self.state_path}')
-                return state
-            except Exception as e:
-                logger.warning(f'failed to load paper state: {e}. start fresh')
-        return {}
+            return state
+        except Exception as e:
+            logger.warning(f'failed to load paper state: {e}. start fresh')
+        # 読めなかった記録が後から混ざらないよう、空の状態で書き直しておく
+        self.journal.state = {}
+        try:
+            self.journal.compact()
+        except Exception as e:
+            logger.warning(f'failed to save paper state: {e}')
+        return self.journal.state
 
-    def _save_state(self):
+    def _record(self, code, changes, sync=False):
+        # 変わった項目だけをジャーナルに追記する（状態全体は書き直さない）
         try:
-            os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
-            with open(self.state_path, 'w') as f:
-                json.dump(self.state, f, indent=2)
+            self.journal.record(code, changes, sync=sync)
         except Exception as e:
             logger.warning(f'failed to save paper state: {e}')
 
+    def close(self):
+        # ジャーナルをスナップショットにまとめて閉じる
+        with self.lock:
+            try:
+                self.journal.close()
+            except Exception as e:
+                logger.warning(f'failed to save paper state: {e}')
+            self._ledger('close')
+
+    def _ledger(self, method, *args, **kwargs):
+        # 台帳に記録する（記録に失敗しても取引は続ける）
+        if self.ledger is None:
+            return
+        try:
+            getattr(self.ledger, method)(*args, **kwargs)
+        except Exception as e:
+            logger.warning(f'failed to write the ledger: {e}')
+
     def _account(self, spec: ProductSpec):
         # 銘柄ごとの仮想口座を取得する（なければ初期資金で作成）
-        if spec.code not in self.state:
-            self.state[spec.code] = {
-                'cash': self.initial_jpy,
-                'size': 0.0,
-                'entry_price': 0.0,
-                'fees_paid': 0.0,
-                'swap_paid': 0.0,
-                'trade_count': 0,
-                'last_swap_time': time.time(),
-            }
-            self._save_state()
-        return self.state[spec.code]
+        with self.lock:
+            if spec.code not in self.state:
+                self.state[spec.code] = {
+                    'cash': self.initial_jpy,
+                    'size': 0.0,
+                    'entry_price': 0.0,
+                    'fees_paid': 0.0,
+                    'swap_paid': 0.0,
+                    'trade_count': 0,
+                    'last_swap_time': time.time(),
+                }
+                self._record(spec.code, dict(self.state[spec.code]), sync=True)
+            return self.state[spec.code]
 
     # --- 市場データ ---
 
     def get_candles(self, spec, limit):
+        feed = self._feed(spec, limit)
         try:
-            candles = fetch_recent_binance_klines(spec.symbol, self.candle_interval,
-                                                  limit=min(limit + 1, 1000))
+            feed.update()
         except Exception as e:
             logger.warning(f'failed to fetch candles: {e}')
             return []
-        if not candles:
+        if not feed.candles:
             return []
-        candles = candles[:-1]  # 最後の1本は未確定足なので除外する
-
         # bitFlyerの現在価格との比率でJPY相当にスケーリングする
-        bf_price = self._bitflyer_ticker(spec)
-        if bf_price > 0 and candles[-1].close > 0:
-            rate = bf_price / candles[-1].close
-        else:
-            rate = 1.0
-        return [Candle(time=c.time, open=c.open * rate, high=c.high * rate,
-                       low=c.low * rate, close=c.close * rate,
-                       volume=c.volume) for c in candles]
+        return scale_candles(list(feed.candles)[-limit:], self._bitflyer_ticker(spec))
+
+    def latest_candle_time(self, spec):
+        # 前回以降に確定した足だけを取得し、最新の確定足の時刻を返す
+        feed = self.feeds.get(spec.code)
+        if feed is None:
+            return None
+        try:
+            feed.update()
+        except Exception as e:
+            logger.warning(f'failed to fetch candles: {e}')
+            return None
+        return feed.last_time()
+
+    def _feed(self, spec, limit):
+        # 銘柄ごとの確定足のフィード（必要な本数が増えたら作り直す）
+        feed = self.feeds.get(spec.code)
+        if feed is None or feed.limit < limit:
+            feed = CandleFeed(spec.symbol, self.candle_interval, limit)
+            self.feeds[spec.code] = feed
+        return feed
 
     def _bitflyer_ticker(self, spec):
+        if self.realtime is not None:
+            self.realtime.watch(spec.code)
+            price = self.realtime.price(spec.code)
+            if price:
+                self._price_cache[spec.code] = price
+                return price
         try:
             url = f'{BITFLYER_URL}/v1/getticker?product_code={spec.code}'
             logger.debug(f'call api: {url}')
-            with request.urlopen(url, timeout=15) as response:
-                ticker = json.loads(response.read())
+            ticker = self.snapshot.get(('ticker', spec.code),
+                                       lambda: self.http.get_json(url, timeout=15))
             price = float(ticker.get('ltp', 0))
             if price > 0:
                 self._price_cache[spec.code] = price
@@ -121,12 +176,14 @@ class PaperExchange(ExchangeAdapter):
     # --- 仮想口座 ---
 
     def get_equity(self, spec):
-        acc = self._account(spec)
-        self._apply_swap(spec, acc)
         price = self.get_price(spec)
-        if price <= 0:
-            price = acc['entry_price']
-        equity = acc['cash'] + acc['size'] * (price - acc['entry_price'])
+        with self.lock:
+            acc = self._account(spec)
+            self._apply_swap(spec, acc)
+            if price <= 0:
+                price = acc['entry_price']
+            equity = acc['cash'] + acc['size'] * (price - acc['entry_price'])
+            self._ledger('record_equity', spec.code, equity, acc['size'])
         logger.info(f'paper equity [{spec.name}]: {equity:,.0f} JPY '
                     f'(cash={acc["cash"]:,.0f}, size={acc["size"]}, '
                     f'entry={acc["entry_price"]:,.0f}, price={price:,.0f})')
@@ -148,16 +205,26 @@ class PaperExchange(ExchangeAdapter):
         if swap > 0:
             acc['cash'] -= swap
             acc['swap_paid'] += swap
-            self._save_state()
+            self._ledger('record_swap', spec.code, swap)
+            self._record(spec.code, {'cash': acc['cash'], 'swap_paid': acc['swap_paid'],
+                                     'last_swap_time': now})
 
     def market_order(self, spec, side, size):
         # 仮想約定を記録する（実際の注文は行わない）
-        acc = self._account(spec)
         price = self.get_price(spec)
         if price <= 0:
             logger.warning(f'[{spec.name}] no price available. order skipped')
             return -1
+        with self.lock:
+            result = self._fill(spec, side, size, price)
+            self._ledger('record_order', spec.code, side, size,
+                         'filled' if result == 1 else 'rejected', price=price)
+            return result
 
+    def _fill(self, spec, side, size, price):
+        acc = self._account(spec)
+        # 約定前の建玉のスワップを約定時刻まで計上する（スワップの起点も約定時刻に進む）
+        self._apply_swap(spec, acc)
         direction = 1 if side == 'BUY' else -1
         fill_price = price * (1 + direction * self.slippage)
         fee_rate = self.spot_fee_rate if spec.spot else 0.0
@@ -196,7 +263,13 @@ class PaperExchange(ExchangeAdapter):
             acc['entry_price'] = 0.0
         acc['size'] = new_size
         acc['trade_count'] += 1
-        self._save_state()
+        # 約定は失いたくないのですぐに fsync する
+        self._record(spec.code, {'cash': acc['cash'], 'fees_paid': acc['fees_paid'],
+                                 'size': new_size, 'entry_price': acc['entry_price'],
+                                 'trade_count': acc['trade_count'],
+                                 'last_swap_time': acc['last_swap_time']}, sync=True)
+
+        self._ledger('record_fill', spec.code, side, size, fill_price, fee=fee, ref_price=price)
 
         logger.info(f'paper trade [{spec.name}]: {side} {size} at {fill_price:,.0f} '
                     f'(fee={fee:,.0f}, position={new_size}, cash={acc["cash"]:,.0f})')
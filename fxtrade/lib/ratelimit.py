@@ -0,0 +1,178 @@
+import random
+import threading
+import time
+from urllib import parse
+
+
+from . import get_module_logger
+
+
+logger = get_module_logger()
+
+
+# 優先度（小さいほど優先）
+PRIORITY_ORDER = 0
+PRIORITY_READ = 1
+
+# エンドポイントごとの予算: 名前 -> (期間内に使える量, 期間（秒）)
+# - bitFlyer: プライベートAPIは5分間に500回、公開APIはIPごとに5分間に500回
+# - Binance: 1分間に6000のウェイト（klines は本数に応じて1〜10、exchangeInfo は20）
+DEFAULT_BUDGETS = {
+    'bitflyer-private': (500, 300.0),
+    'bitflyer-public': (500, 300.0),
+    'binance': (6000, 60.0),
+}
+
+
+class RateLimitTimeout(TimeoutError):
+    # 予算が戻るまで待てなかった
+    pass
+
+
+class _Bucket:
+    # 1つの予算のトークンバケットと統計
+
+    def __init__(self, name, capacity, period, now):
+        self.name = name
+        self.capacity = float(capacity)
+        self.rate = capacity / period        # 1秒あたりに戻る量
+        self.tokens = float(capacity)
+        self.updated = now
+        self.blocked_until = 0.0             # バックオフ中はこの時刻まで使わない
+        self.failures = 0                    # 連続した 429/5xx の回数
+        self.waiting_orders = 0
+        self.used = 0.0
+        self.requests = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.throttled = 0
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+
+class RateLimiter:
+    # 全てのAPI呼び出しで共有するトークンバケット方式のレート制限（スレッドセーフ）
+    #
+    # - 予算はエンドポイントごと（DEFAULT_BUDGETS）。URLから予算とコストを決める
+    # - 発注（PRIORITY_ORDER）は予算の reserve（割合）分を使える。情報取得は reserve を
+    #   残して使い、発注が待っている間は譲る
+    # - 429/5xx を受けたら penalize() で予算ごとに指数バックオフ（ジッター付き）し、
+    #   成功したら success() で元に戻す
+
+    def __init__(self, budgets=None, reserve=0.1, backoff_base=1.0, backoff_max=60.0,
+                 clock=time.monotonic):
+        self.clock = clock
+        self.reserve = reserve
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        now = clock()
+        self.buckets = {name: _Bucket(name, capacity, period, now)
+                        for name, (capacity, period) in (budgets or DEFAULT_BUDGETS).items()}
+        self.cond = threading.Condition()
+
+    def classify(self, method, url):
+        # (予算名, コスト, 優先度) を返す。制限の対象外なら予算名は None
+        parts = parse.urlsplit(url)
+        host = parts.hostname or ''
+        if host.endswith('bitflyer.com'):
+            if parts.path.startswith('/v1/me/'):
+                priority = PRIORITY_ORDER if 'childorder' in parts.path and method != 'GET' \
+                    else PRIORITY_READ
+                return 'bitflyer-private', 1, priority
+            return 'bitflyer-public', 1, PRIORITY_READ
+        if host.endswith('binance.com'):
+            if parts.path.endswith('/exchangeInfo'):
+                return 'binance', 20, PRIORITY_READ
+            if parts.path.endswith('/klines'):
+                limit = int(parse.parse_qs(parts.query).get('limit', ['500'])[0])
+                weight = 1 if limit < 100 else 2 if limit < 500 else 5 if limit <= 1000 else 10
+                return 'binance', weight, PRIORITY_READ
+            return 'binance', 1, PRIORITY_READ
+        return None, 0, PRIORITY_READ
+
+    def acquire(self, budget, cost=1, priority=PRIORITY_READ, timeout=None):
+        # 予算から cost を使う。足りなければ戻るまで待つ（timeout 秒を超えるなら例外）
+        bucket = self.buckets.get(budget)
+        if bucket is None:
+            return 0.0
+        started = self.clock()
+        deadline = None if timeout is None else started + timeout
+        floor = 0.0 if priority == PRIORITY_ORDER else bucket.capacity * self.reserve
+        with self.cond:
+            if priority == PRIORITY_ORDER:
+                bucket.waiting_orders += 1
+            try:
+                while True:
+                    now = self.clock()
+                    bucket.refill(now)
+                    blocked = bucket.blocked_until - now
+                    yielding = priority != PRIORITY_ORDER and bucket.waiting_orders > 0
+                    if blocked <= 0 and not yielding and bucket.tokens - cost >= floor:
+                        break
+                    if blocked > 0:
+                        delay = blocked
+                    elif yielding:
+                        delay = 0.05
+                    else:
+                        delay = (cost + floor - bucket.tokens) / bucket.rate
+                    if deadline is not None and now + delay > deadline:
+                        raise RateLimitTimeout(f'{budget}: no budget within {timeout}s '
+                                               f'(available={bucket.tokens:.1f}, cost={cost})')
+                    self.cond.wait(delay)
+                bucket.tokens -= cost
+                bucket.used += cost
+                bucket.requests += 1
+                waited = self.clock() - started
+                if waited > 0.001:
+                    bucket.waits += 1
+                    bucket.wait_seconds += waited
+                    logger.debug(f'rate limit {budget}: waited {waited:.2f}s')
+                return waited
+            finally:
+                if priority == PRIORITY_ORDER:
+                    bucket.waiting_orders -= 1
+                    self.cond.notify_all()
+
+    def penalize(self, budget, retry_after=None):
+        # 429/5xx を受けた。この予算の利用を指数的に間隔を空けて止める
+        bucket = self.buckets.get(budget)
+        if bucket is None:
+            return 0.0
+        with self.cond:
+            bucket.failures += 1
+            bucket.throttled += 1
+            delay = min(self.backoff_base * 2 ** (bucket.failures - 1), self.backoff_max)
+            delay *= random.uniform(0.5, 1.0)
+            if retry_after:
+                delay = max(delay, retry_after)
+            bucket.blocked_until = max(bucket.blocked_until, self.clock() + delay)
+        logger.warning(f'rate limit {budget}: throttled by server. back off {delay:.1f}s')
+        return delay
+
+    def success(self, budget):
+        bucket = self.buckets.get(budget)
+        if bucket is not None and bucket.failures:
+            with self.cond:
+                bucket.failures = 0
+
+    def stats(self):
+        # 予算ごとの利用状況
+        with self.cond:
+            now = self.clock()
+            result = {}
+            for name, b in self.buckets.items():
+                b.refill(now)
+                result[name] = {
+                    'capacity': b.capacity,
+                    'available': round(b.tokens, 3),
+                    'utilization': round(1.0 - b.tokens / b.capacity, 4),
+                    'used': b.used,
+                    'requests': b.requests,
+                    'waits': b.waits,
+                    'wait_seconds': round(b.wait_seconds, 3),
+                    'throttled': b.throttled,
+                    'backoff_remaining': round(max(b.blocked_until - now, 0.0), 3),
+                }
+            return result
@@ -0,0 +1,294 @@
+import base64
+import hashlib
+import json
+import os
+import random
+import socket
+import ssl
+import struct
+import threading
+import time
+from collections import deque
+from urllib import parse
+
+
+from . import get_module_logger
+
+
+logger = get_module_logger()
+
+
+BITFLYER_REALTIME_URL = 'wss://ws.lightstream.bitflyer.com/json-rpc'
+
+# RFC 6455 のハンドシェイクで使う固定値
+WEBSOCKET_GUID = '258EAFA5-E914-47DA-95CA-C5AB0DC85B11'
+
+OP_CONTINUATION = 0x0
+OP_TEXT = 0x1
+OP_BINARY = 0x2
+OP_CLOSE = 0x8
+OP_PING = 0x9
+OP_PONG = 0xA
+
+
+class WebSocket:
+    # 標準ライブラリだけで書いた最小限のWebSocketクライアント（RFC 6455）
+    # テキストメッセージの送受信・ping/pong・close だけに対応する
+
+    def __init__(self, url, timeout=30.0, context=None):
+        parts = parse.urlsplit(url)
+        if parts.scheme not in ('ws', 'wss'):
+            raise ValueError(f'unsupported scheme: {parts.scheme}')
+        port = parts.port or (443 if parts.scheme == 'wss' else 80)
+        sock = socket.create_connection((parts.hostname, port), timeout=timeout)
+        if parts.scheme == 'wss':
+            context = context or ssl.create_default_context()
+            sock = context.wrap_socket(sock, server_hostname=parts.hostname)
+        self.sock = sock
+        self.rfile = sock.makefile('rb')
+        self.send_lock = threading.Lock()
+        self.closed = False
+        self._handshake(parts, port)
+
+    def _handshake(self, parts, port):
+        key = base64.b64encode(os.urandom(16)).decode()
+        path = (parts.path or '/') + (f'?{parts.query}' if parts.query else '')
+        request = (f'GET {path} HTTP/1.1\r\n'
+                   f'Host: {parts.hostname}:{port}\r\n'
+                   'Upgrade: websocket\r\n'
+                   'Connection: Upgrade\r\n'
+                   f'Sec-WebSocket-Key: {key}\r\n'
+                   'Sec-WebSocket-Version: 13\r\n\r\n')
+        self.sock.sendall(request.encode())
+        status = self.rfile.readline().decode('latin-1')
+        headers = {}
+        while True:
+            line = self.rfile.readline().decode('latin-1').strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        if ' 101 ' not in status:
+            raise ConnectionError(f'websocket handshake failed: {status.strip()}')
+        expected = base64.b64encode(
+            hashlib.sha1((key + WEBSOCKET_GUID).encode()).digest()).decode()
+        if headers.get('sec-websocket-accept') != expected:
+            raise ConnectionError('websocket handshake failed: bad accept key')
+
+    def send(self, text):
+        self._send_frame(OP_TEXT, text.encode())
+
+    def _send_frame(self, opcode, payload):
+        # クライアントから送るフレームは必ずマスクする
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header.append(0x80 | length)
+        elif length < 1 << 16:
+            header.append(0x80 | 126)
+            header += struct.pack('!H', length)
+        else:
+            header.append(0x80 | 127)
+            header += struct.pack('!Q', length)
+        mask = os.urandom(4)
+        header += mask
+        with self.send_lock:
+            self.sock.sendall(bytes(header) + _apply_mask(payload, mask))
+
+    def recv(self):
+        # 次のテキストメッセージを返す（ping には pong を返す）。切断されたら None
+        message = bytearray()
+        while True:
+            fin, opcode, payload = self._recv_frame()
+            if opcode == OP_PING:
+                self._send_frame(OP_PONG, payload)
+                continue
+            if opcode == OP_PONG:
+                continue
+            if opcode == OP_CLOSE:
+                self.close()
+                return None
+            message += payload
+            if fin:
+                return message.decode()
+
+    def _recv_frame(self):
+        head = self._read(2)
+        fin = bool(head[0] & 0x80)
+        opcode = head[0] & 0x0F
+        length = head[1] & 0x7F
+        if length == 126:
+            length = struct.unpack('!H', self._read(2))[0]
+        elif length == 127:
+            length = struct.unpack('!Q', self._read(8))[0]
+        mask = self._read(4) if head[1] & 0x80 else None
+        payload = self._read(length)
+        if mask:
+            payload = _apply_mask(payload, mask)
+        return fin, opcode, payload
+
+    def _read(self, n):
+        data = self.rfile.read(n)
+        if len(data) < n:
+            raise ConnectionError('websocket connection closed')
+        return data
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._send_frame(OP_CLOSE, b'')
+        except OSError:
+            pass
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.rfile.close()
+        self.sock.close()
+
+
+def _apply_mask(payload, mask):
+    # 4バイトのマスクを繰り返しXORする（整数にまとめて一度に計算する）
+    if not payload:
+        return b''
+    key = (mask * (len(payload) // 4 + 1))[:len(payload)]
+    masked = int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')
+    return masked.to_bytes(len(payload), 'big')
+
+
+class RealtimeFeed:
+    # bitFlyer の Realtime API（JSON-RPC over WebSocket）で ticker と約定を受信するフィード
+    #
+    # watch(product_code) した銘柄の lightning_ticker_* / lightning_executions_* を購読し、
+    # 銘柄ごとに最新の価格と直近の約定（trades 件）をメモリに保持する。
+    # 受信はバックグラウンドのスレッドで行い、切断されたら指数的に間隔を空けて再接続し、
+    # 購読中のチャンネルを購読し直す。price() は max_age 秒より古い価格を返さないので、
+    # アダプタは None のときだけポーリングに戻ればよい
+
+    def __init__(self, url=BITFLYER_REALTIME_URL, trades=1000, max_age=10.0,
+                 recv_timeout=60.0, reconnect_max=30.0, context=None):
+        self.url = url
+        self.max_age = max_age
+        self.recv_timeout = recv_timeout
+        self.reconnect_max = reconnect_max
+        self.context = context
+        self.codes = []
+        self.prices = {}        # product_code -> (価格, 受信時刻(monotonic))
+        self.tickers = {}       # product_code -> 最新の ticker メッセージ
+        self.trades = {}        # product_code -> deque(約定)
+        self.trade_limit = trades
+        self.connects = 0
+        self.messages = 0
+        self.lock = threading.Lock()
+        self.ws = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='bitflyer-realtime', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        ws = self.ws
+        if ws is not None:
+            ws.close()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def watch(self, code):
+        # 銘柄を購読に加える（接続中ならすぐに購読する）
+        with self.lock:
+            if code in self.codes:
+                return
+            self.codes.append(code)
+            self.trades[code] = deque(maxlen=self.trade_limit)
+            ws = self.ws
+        if ws is not None:
+            try:
+                self._subscribe(ws, [code])
+            except OSError as e:
+                logger.debug(f'realtime subscribe failed ({e}). will resubscribe on reconnect')
+
+    def price(self, code, max_age=None):
+        # 最新の約定価格（max_age 秒以内に受信したもの）。なければ None
+        max_age = self.max_age if max_age is None else max_age
+        with self.lock:
+            entry = self.prices.get(code)
+        if entry is None or time.monotonic() - entry[1] > max_age:
+            return None
+        return entry[0]
+
+    def recent_trades(self, code):
+        with self.lock:
+            return list(self.trades.get(code, ()))
+
+    # --- 受信スレッド ---
+
+    def _run(self):
+        delay = 1.0
+        while not self._stopped.is_set():
+            try:
+                ws = WebSocket(self.url, timeout=self.recv_timeout, context=self.context)
+                with self.lock:
+                    self.ws = ws
+                    self.connects += 1
+                    codes = list(self.codes)
+                logger.info(f'realtime connected: {self.url}')
+                self._subscribe(ws, codes)
+                delay = 1.0
+                while not self._stopped.is_set():
+                    text = ws.recv()
+                    if text is None:
+                        break
+                    self._on_message(text)
+            except Exception as e:
+                if not self._stopped.is_set():
+                    logger.warning(f'realtime connection error: {e}')
+            finally:
+                with self.lock:
+                    ws, self.ws = self.ws, None
+                if ws is not None:
+                    ws.close()
+            if self._stopped.wait(delay * random.uniform(0.5, 1.0)):
+                break
+            delay = min(delay * 2, self.reconnect_max)
+
+    def _subscribe(self, ws, codes):
+        for code in codes:
+            for channel in (f'lightning_ticker_{code}', f'lightning_executions_{code}'):
+                ws.send(json.dumps({'method': 'subscribe', 'params': {'channel': channel}}))
+
+    def _on_message(self, text):
+        data = json.loads(text)
+        if data.get('method') != 'channelMessage':
+            return
+        params = data.get('params') or {}
+        channel = params.get('channel', '')
+        message = params.get('message')
+        now = time.monotonic()
+        with self.lock:
+            self.messages += 1
+            if channel.startswith('lightning_ticker_'):
+                code = channel[len('lightning_ticker_'):]
+                self.tickers[code] = message
+                price = float(message.get('ltp', 0))
+                if price > 0:
+                    self.prices[code] = (price, now)
+            elif channel.startswith('lightning_executions_'):
+                code = channel[len('lightning_executions_'):]
+                trades = self.trades.setdefault(code, deque(maxlen=self.trade_limit))
+                trades.extend(message)
+                if message:
+                    self.prices[code] = (float(message[-1]['price']), now)
+
+
+def realtime_from_config(setting):
+    # 設定値（true / URL / 未設定）からフィードを作って開始する。未設定なら None
+    if not setting:
+        return None
+    url = setting if isinstance(setting, str) else BITFLYER_REALTIME_URL
+    return RealtimeFeed(url).start()
@@ -0,0 +1,202 @@
+import copy
+import os
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+
+
+from . import get_module_logger, set_config_path
+from .backtest import SimulatedExchange, BacktestResult, TapeStrategy, run_backtest
+from .candles import Candle
+from .engine import order_delta
+from .exchange import ProductSpec
+from .risk import RiskManager
+from .strategy import TrendStrategy, create_strategy
+
+
+logger = get_module_logger()
+
+
+# コストシナリオで指定できる項目（run_backtest の引数名と同じ）
+COST_FIELDS = ('fee_rate', 'slippage', 'swap_rate_daily')
+
+
+@dataclass
+class RecostResult:
+    scenario: dict
+    result: BacktestResult
+    # コスト変更によって判断が変わっていたはずの足: (テープ上の位置, 時刻, 理由) のリスト
+    # 理由: 'min-size'（目標が最小数量を跨いだ）, 'order'（発注の有無が変わった）,
+    #       'fill'（現物の残高クランプの有無が変わった）
+    flagged: list = field(default_factory=list)
+
+
+class _ScenarioRun:
+    # 1つのコストシナリオの再計算状態
+
+    def __init__(self, spec, candles, initial_jpy, scenario, config):
+        unknown = set(scenario) - set(COST_FIELDS)
+        if unknown:
+            raise ValueError(f'unknown cost fields: {sorted(unknown)} (use {COST_FIELDS})')
+        self.spec = spec
+        self.scenario = dict(scenario)
+        self.sim = SimulatedExchange(spec, candles, initial_jpy,
+                                     fee_rate=scenario.get('fee_rate'),
+                                     slippage=scenario.get('slippage', 0.0005),
+                                     swap_rate_daily=scenario.get('swap_rate_daily', 0.0004))
+        self.risk = RiskManager(config.get('risk'))
+        self.rebalance_threshold = float(config.get('rebalance-threshold', 0.3))
+        self.equity_curve = []
+        self.peak = initial_jpy
+        self.max_dd = 0.0
+        self.flagged = []
+
+    def step(self, index, bar):
+        spec = self.spec
+        sim = self.sim
+        sim.advance(index)
+        position = sim.account.size
+        equity = sim.equity()
+
+        # 記録された注文はそのまま再生し、このコストでの判断が記録と食い違う足を記録する
+        if equity > 0:
+            signal = bar.signal
+            target = self.risk.position_size(equity, signal.price, signal,
+                                             spot=spec.spot, min_size=spec.min_size)
+            if signal.direction != 0 and (target == 0.0) != (bar.target == 0.0):
+                self.flagged.append((index, bar.time, 'min-size'))
+            delta = order_delta(spec, position, target, self.rebalance_threshold)
+            if (delta == 0.0) != (bar.ordered == 0.0):
+                self.flagged.append((index, bar.time, 'order'))
+
+        if bar.ordered != 0.0:
+            sim.last_fill = None
+            sim.market_order(spec, 'BUY' if bar.ordered > 0 else 'SELL', abs(bar.ordered))
+            ordered, filled = sim.last_fill
+            clamped = abs(filled - ordered) > 1e-12
+            recorded_clamped = abs(bar.filled - bar.ordered) > 1e-12
+            if clamped != recorded_clamped:
+                self.flagged.append((index, bar.time, 'fill'))
+
+        eq = sim.equity()
+        self.equity_curve.append((bar.time, eq))
+        self.peak = max(self.peak, eq)
+        if self.peak > 0:
+            self.max_dd = max(self.max_dd, 1.0 - eq / self.peak)
+
+    def result(self, initial_jpy, years):
+        acc = self.sim.account
+        result = BacktestResult(
+            initial_equity=initial_jpy,
+            final_equity=self.sim.equity(),
+            max_drawdown=self.max_dd,
+            trade_count=acc.trade_count,
+            fees_paid=acc.fees_paid,
+            swap_paid=acc.swap_paid,
+            margin_call_count=self.sim.margin_call_count,
+            years=years,
+            equity_curve=self.equity_curve,
+        )
+        return RecostResult(scenario=self.scenario, result=result, flagged=self.flagged)
+
+
+def recost_tape(spec: ProductSpec, tape, initial_jpy, scenarios, config=None):
+    # 記録済みのテープ（run_backtest(record_tape=True)）を複数のコスト条件で再計算する
+    #
+    # 売買の判断（発注数量）は記録どおりに固定し、約定価格・手数料・スワップ・
+    # 資産推移・マージンコールだけを各シナリオで計算し直す。
+    # テープを1回走査する間に全シナリオを同時に進めるため、戦略の再計算は一切行わない。
+    # scenarios: {'fee_rate': ..., 'slippage': ..., 'swap_rate_daily': ...} のリスト
+    #            （省略した項目は run_backtest のデフォルト値）
+    config = config or {}
+    if not tape:
+        return [RecostResult(scenario=dict(s),
+                             result=BacktestResult(initial_equity=initial_jpy,
+                                                   final_equity=initial_jpy,
+                                                   max_drawdown=0.0, trade_count=0,
+                                                   fees_paid=0.0, swap_paid=0.0,
+                                                   margin_call_count=0, years=0.0))
+                for s in scenarios]
+
+    # シミュレータは終値だけを参照するため、テープの価格から足を復元して全シナリオで共有する
+    candles = [Candle(time=bar.time, open=bar.price, high=bar.price, low=bar.price,
+                      close=bar.price, volume=0.0) for bar in tape]
+    runs = [_ScenarioRun(spec, candles, initial_jpy, s, config) for s in scenarios]
+
+    for i, bar in enumerate(tape):
+        for run in runs:
+            run.step(i, bar)
+
+    years = (tape[-1].time - tape[0].time) / (365.25 * 86400)
+    results = [run.result(initial_jpy, years) for run in runs]
+    for r in results:
+        if r.flagged:
+            logger.info(f'[{spec.name}] recost {r.scenario}: '
+                        f'{len(r.flagged)} bars would have changed a sizing decision')
+    return results
+
+
+# --- リスク設定の再生 ---
+
+@dataclass
+class ReplayResult:
+    variant: dict
+    result: BacktestResult
+    replayed: int     # 記録したシグナルを使った足の数
+    recomputed: int   # 状態が記録と食い違い、戦略で計算し直した足の数
+
+
+# 再生で変更できる設定（シグナルに影響しないもの）
+REPLAY_FIELDS = ('risk.', 'rebalance-threshold')
+
+
+def replay_risk(spec: ProductSpec, candles, tape, initial_jpy, variants, config=None,
+                workers=None, fee_rate=None, slippage=0.0005, swap_rate_daily=0.0004):
+    # 記録済みのテープ（run_backtest(record_tape=True)）を使い、リスク設定だけを変えた
+    # バックテストを複数まとめて実行する
+    #
+    # variants: 変更する設定のリスト。キーはスイープの grid と同じドット区切り
+    #           例: [{'risk.risk-per-trade': 0.02}, {'risk.max-leverage': 1.0,
+    #                 'rebalance-threshold': 0.1}]
+    # 戦略の設定は変えられない（テープが無効になる）。
+    # 結果は各設定で run_backtest を実行した場合と完全に一致する。
+    # 設定ごとに workers 個のプロセスで並列に実行する（None ならCPU数、1 なら直列）
+    config = config or {}
+    if not isinstance(create_strategy(config.get('strategy')), TrendStrategy):
+        raise ValueError('risk replay supports TrendStrategy only')
+    configs = []
+    for variant in variants:
+        unknown = [k for k in variant
+                   if not any(k == f or k.startswith(f) for f in REPLAY_FIELDS)]
+        if unknown:
+            raise ValueError(f'cannot replay {sorted(unknown)}: '
+                             f'only risk.* and rebalance-threshold may change')
+        c = copy.deepcopy(config)
+        for key, value in variant.items():
+            set_config_path(c, key, value)
+        configs.append(c)
+
+    args = [(spec, candles, tape, initial_jpy, c, fee_rate, slippage, swap_rate_daily)
+            for c in configs]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers > 1 and len(args) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(args))) as pool:
+            outcomes = list(pool.map(_replay_one, *zip(*args)))
+    else:
+        outcomes = [_replay_one(*a) for a in args]
+
+    results = []
+    for variant, (result, replayed, recomputed) in zip(variants, outcomes):
+        logger.debug(f'[{spec.name}] replay {variant}: replayed={replayed} '
+                     f'recomputed={recomputed}')
+        results.append(ReplayResult(variant=dict(variant), result=result,
+                                    replayed=replayed, recomputed=recomputed))
+    return results
+
+
+def _replay_one(spec, candles, tape, initial_jpy, config, fee_rate, slippage, swap_rate_daily):
+    strategy = TapeStrategy(tape, create_strategy(config.get('strategy')))
+    result = run_backtest(spec, candles, initial_jpy, config=config, fee_rate=fee_rate,
+                          slippage=slippage, swap_rate_daily=swap_rate_daily,
+                          strategy=strategy)
+    return result, strategy.replayed, strategy.recomputed
@@ -0,0 +1,331 @@
+import ast
+import operator
+from collections import deque
+
+
+from . import get_module_logger
+from .indicators import ema, sma, atr, rsi
+from .strategy import Signal, PositionState
+
+
+logger = get_module_logger()
+
+
+# --- ルール式のコンパイル ---
+#
+# ルールはPythonの式の部分集合で書く（ast で構文解析し、許可した要素だけを受け付ける）:
+#   系列       : open / high / low / close / volume
+#   数値       : 20, 1.5
+#   関数       : ema(x, n) sma(x, n) highest(x, n) lowest(x, n) rsi(x, n) atr(n) abs(x)
+#                （x を省略すると close。例: ema(20) は ema(close, 20)）
+#   n本前の値  : x[n]（例: highest(close, 200)[1] は前の足までの200本の最高値）
+#   演算       : + - * /  比較 > < >= <= == !=  論理 and or not
+# 例: "ema(20) > ema(300) and close > highest(close, 200)[1]"
+#
+# 式は共通部分式をまとめたノードの列（トポロジカル順）にコンパイルする。
+# 複数のルールで同じ ema(20) を使っても計算は1回になる。
+# RuleProgram.run(candles) で、渡された系列全体をノードごとに一括計算する。
+# 戦略はバックテスト・ライブとも足の窓（エンジンの candle_limit 本）に対して実行する
+# （EMAなどは窓の先頭の足を初期値にするので、1本ずつの逐次計算では同じ値にならない）
+
+SERIES = ('open', 'high', 'low', 'close', 'volume')
+WINDOW_FUNCS = ('ema', 'sma', 'highest', 'lowest', 'rsi')
+
+_BINOPS = {ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul}
+_CMPOPS = {ast.Gt: operator.gt, ast.Lt: operator.lt, ast.GtE: operator.ge,
+           ast.LtE: operator.le, ast.Eq: operator.eq, ast.NotEq: operator.ne}
+
+
+def _div(a, b):
+    # 0除算は0とする（ライブで例外を出さない）
+    return a / b if b else 0.0
+
+
+def _and(a, b):
+    return bool(a) and bool(b)
+
+
+def _or(a, b):
+    return bool(a) or bool(b)
+
+
+def _not(a):
+    return not a
+
+
+class RuleProgram:
+    # コンパイル済みのルール群
+    # nodes: (演算, 引数...) のタプルのリスト。引数のノードは添字で参照する
+    # outputs: {ルール名: ノードの添字}
+
+    def __init__(self):
+        self.nodes = []
+        self.index = {}
+        self.outputs = {}
+
+    def _intern(self, node):
+        # 同じノードは1つにまとめる（共通部分式の除去）
+        if node not in self.index:
+            self.index[node] = len(self.nodes)
+            self.nodes.append(node)
+        return self.index[node]
+
+    def add(self, name, text):
+        try:
+            tree = ast.parse(text, mode='eval')
+        except SyntaxError as e:
+            raise ValueError(f'rule {name}: {e.msg}: {text}') from None
+        self.outputs[name] = self._compile(tree.body, name)
+        return self
+
+    def _compile(self, node, name):
+        def c(child):
+            return self._compile(child, name)
+
+        if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) \
+                and not isinstance(node.value, bool):
+            return self._intern(('const', float(node.value)))
+        if isinstance(node, ast.Name):
+            if node.id not in SERIES:
+                raise ValueError(f'rule {name}: unknown series {node.id} (use {SERIES})')
+            return self._intern(('series', node.id))
+        if isinstance(node, ast.BoolOp):
+            fn = 'and' if isinstance(node.op, ast.And) else 'or'
+            result = c(node.values[0])
+            for v in node.values[1:]:
+                result = self._intern((fn, result, c(v)))
+            return result
+        if isinstance(node, ast.UnaryOp):
+            if isinstance(node.op, ast.Not):
+                return self._intern(('not', c(node.operand)))
+            if isinstance(node.op, ast.USub):
+                return self._intern(('sub', self._intern(('const', 0.0)), c(node.operand)))
+            if isinstance(node.op, ast.UAdd):
+                return c(node.operand)
+        if isinstance(node, ast.BinOp):
+            if isinstance(node.op, ast.Div):
+                return self._intern(('div', c(node.left), c(node.right)))
+            for op_type, fn in _BINOPS.items():
+                if isinstance(node.op, op_type):
+                    return self._intern((fn.__name__, c(node.left), c(node.right)))
+        if isinstance(node, ast.Compare):
+            # a < b < c は (a < b) and (b < c)
+            result = None
+            left = c(node.left)
+            for op, comparator in zip(node.ops, node.comparators):
+                right = c(comparator)
+                fn = next((f for t, f in _CMPOPS.items() if isinstance(op, t)), None)
+                if fn is None:
+                    break
+                term = self._intern((fn.__name__, left, right))
+                result = term if result is None else self._intern(('and', result, term))
+                left = right
+            else:
+                return result
+        if isinstance(node, ast.Subscript):
+            lag = node.slice
+            if isinstance(lag, ast.Constant) and isinstance(lag.value, int) and lag.value >= 0:
+                child = c(node.value)
+                return child if lag.value == 0 else self._intern(('lag', child, lag.value))
+            raise ValueError(f'rule {name}: lag must be a non-negative integer')
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+            return self._compile_call(node.func.id, node.args, name)
+        raise ValueError(f'rule {name}: unsupported expression: {ast.unparse(node)}')
+
+    def _compile_call(self, fn, args, name):
+        def span_of(arg):
+            if isinstance(arg, ast.Constant) and isinstance(arg.value, int) and arg.value > 0:
+                return arg.value
+            raise ValueError(f'rule {name}: {fn}() period must be a positive integer')
+
+        if fn in WINDOW_FUNCS:
+            if len(args) == 1:
+                child = self._intern(('series', 'close'))
+            elif len(args) == 2:
+                child = self._compile(args[0], name)
+            else:
+                raise ValueError(f'rule {name}: {fn}() takes (series, period) or (period)')
+            return self._intern((fn, child, span_of(args[-1])))
+        if fn == 'atr' and len(args) == 1:
+            return self._intern(('atr', span_of(args[0])))
+        if fn == 'abs' and len(args) == 1:
+            return self._intern(('abs', self._compile(args[0], name)))
+        raise ValueError(f'rule {name}: unknown function {fn}()')
+
+    def lookback(self):
+        # 値が落ち着くまでに必要な足の本数の目安（各ノードの期間・ラグの累積の最大）
+        depth = []
+        for node in self.nodes:
+            op = node[0]
+            own = node[2] if op in WINDOW_FUNCS or op == 'lag' else \
+                node[1] if op == 'atr' else 0
+            children = [depth[a] for a in _children(node)]
+            depth.append(own + max(children, default=0))
+        return max(depth, default=0)
+
+    def run(self, candles):
+        # 系列全体を一括計算する。返り値は {ルール名: 値のリスト}
+        columns = []
+        for node in self.nodes:
+            columns.append(_column(node, columns, candles))
+        return {name: columns[i] for name, i in self.outputs.items()}
+
+
+def _children(node):
+    op = node[0]
+    if op in ('const', 'series', 'atr'):
+        return ()
+    if op in WINDOW_FUNCS or op in ('lag', 'abs', 'not'):
+        return (node[1],)
+    return (node[1], node[2])
+
+
+_FUNCS = {'add': operator.add, 'sub': operator.sub, 'mul': operator.mul, 'div': _div,
+          'gt': operator.gt, 'lt': operator.lt, 'ge': operator.ge, 'le': operator.le,
+          'eq': operator.eq, 'ne': operator.ne, 'and': _and, 'or': _or}
+
+
+def _column(node, columns, candles):
+    # 1つのノードの値を系列全体について求める
+    op = node[0]
+    n = len(candles)
+    if op == 'const':
+        return [node[1]] * n
+    if op == 'series':
+        return [getattr(c, node[1]) for c in candles]
+    if op == 'atr':
+        return atr(candles, node[1])
+    if op in _FUNCS:
+        return list(map(_FUNCS[op], columns[node[1]], columns[node[2]]))
+    values = columns[node[1]]
+    if op == 'not':
+        return list(map(_not, values))
+    if op == 'abs':
+        return list(map(abs, values))
+    if op == 'lag':
+        k = node[2]
+        return values[:1] * min(k, n) + values[:max(n - k, 0)]
+    if op == 'ema':
+        return ema(values, node[2])
+    if op == 'sma':
+        return sma(values, node[2])
+    if op == 'rsi':
+        return rsi(values, node[2])
+    # highest / lowest: 単調キューで O(n)
+    q = _RollingExtreme(node[2], op == 'highest')
+    return [q.update(v) for v in values]
+
+
+class _RollingExtreme:
+    # 直近span個の最大値（最小値）。単調キューで O(1) 償却
+
+    def __init__(self, span, highest):
+        self.span = span
+        self.highest = highest
+        self.queue = deque()  # (位置, 値)
+        self.count = 0
+
+    def update(self, v):
+        q = self.queue
+        while q and (q[-1][1] <= v if self.highest else q[-1][1] >= v):
+            q.pop()
+        q.append((self.count, v))
+        if q[0][0] <= self.count - self.span:
+            q.popleft()
+        self.count += 1
+        return q[0][1]
+
+
+def compile_rules(rules):
+    # {ルール名: 式} をまとめて1つのプログラムにコンパイルする
+    program = RuleProgram()
+    for name, text in rules.items():
+        program.add(name, text)
+    return program
+
+
+# --- ルールで売買する戦略 ---
+
+class RuleStrategy:
+    # 設定のルール式で売買する戦略
+    #
+    # rules:
+    #   long-entry / short-entry : ノーポジションのときにエントリーする条件
+    #   long-exit / short-exit   : 保有中に決済する条件（決済した足で逆方向の
+    #                              エントリー条件が成り立てばドテンする）
+    #   strength                 : ポジションサイズの係数（省略時は1.0。0〜1にクリップ）
+    # 損切りは TrendStrategy と同じシャンデリアエグジット（最良値から ATR×trail-atr-mult）
+    # 設定例: {"rules": {"long-entry": "ema(20) > ema(300) and close > highest(close, 200)[1]",
+    #                    "long-exit": "ema(20) < ema(300)"}, "trail-atr-mult": 2.5}
+    #
+    # TrendStrategy と同じく、値は渡された足の窓（エンジンの candle_limit 本）の先頭から
+    # 計算する。バックテストとライブで同じ窓を渡すので、EMAなどの初期値の取り方も一致する
+    # （ライブの足は毎サイクル現在価格で換算し直されるため、前回の計算は引き継がない）
+
+    RULES = ('long-entry', 'long-exit', 'short-entry', 'short-exit', 'strength')
+
+    def __init__(self, config):
+        config = dict(config)
+        rules = dict(config.get('rules') or {})
+        unknown = set(rules) - set(self.RULES)
+        if unknown:
+            raise ValueError(f'unknown rules: {sorted(unknown)} (use {" / ".join(self.RULES)})')
+        if not rules.get('long-entry') and not rules.get('short-entry'):
+            raise ValueError('rule strategy needs long-entry or short-entry')
+        self.atr_span = int(config.get('atr-span', 14))
+        self.trail_atr_mult = float(config.get('trail-atr-mult', 2.5))
+        self.allow_short = bool(config.get('allow-short', True))
+        self.program = compile_rules(rules)
+        self.program.add('_atr', f'atr({self.atr_span})')
+        # 直近に計算した窓（先頭と末尾の足）とその値。同じ足で何度も呼ばれても1回だけ計算する
+        self._mark = None
+        self._last = None
+        logger.debug(f'RuleStrategy: rules={rules} nodes={len(self.program.nodes)}')
+
+    def min_history(self):
+        return self.program.lookback() + 2
+
+    def values(self, candles):
+        # 最新の足のルールの値（窓の先頭から計算する）
+        mark = (len(candles), candles[0].time, candles[0].close,
+                candles[-1].time, candles[-1].close)
+        if mark != self._mark:
+            columns = self.program.run(candles)
+            self._mark = mark
+            self._last = {name: column[-1] for name, column in columns.items()}
+        return self._last
+
+    def evaluate(self, candles, position: PositionState):
+        price = candles[-1].close if candles else 0.0
+        if len(candles) < self.min_history():
+            logger.debug(f'not enough candles: {len(candles)} < {self.min_history()}')
+            return Signal(direction=0, strength=0.0, stop_price=0.0, atr=0.0, price=price)
+
+        values = self.values(candles)
+        current_atr = values['_atr']
+        strength = min(max(float(values.get('strength', 1.0)), 0.0), 1.0)
+        long_entry = bool(values.get('long-entry', False))
+        short_entry = bool(values.get('short-entry', False)) and self.allow_short
+
+        if position.direction != 0:
+            position.update_extreme(price)
+            stop = position.extreme_price - position.direction * self.trail_atr_mult * current_atr
+            stopped = (position.direction > 0 and price <= stop) or \
+                      (position.direction < 0 and price >= stop)
+            exit_rule = values.get('long-exit' if position.direction > 0 else 'short-exit', False)
+            if stopped or exit_rule:
+                reverse = short_entry if position.direction > 0 else long_entry
+                if reverse:
+                    direction = -position.direction
+                    return Signal(direction, strength,
+                                  price - direction * self.trail_atr_mult * current_atr,
+                                  current_atr, price)
+                return Signal(0, 0.0, 0.0, current_atr, price)
+            return Signal(position.direction, strength, stop, current_atr, price)
+
+        for direction, entry in ((1, long_entry), (-1, short_entry)):
+            if entry:
+                return Signal(direction, strength,
+                              price - direction * self.trail_atr_mult * current_atr,
+                              current_atr, price)
+        return Signal(0, 0.0, 0.0, current_atr, price)
@@ -0,0 +1,170 @@
+import asyncio
+import math
+import time
+from dataclasses import dataclass, asdict
+
+
+from . import get_module_logger, update_transaction_id
+from .engine import TradingEngine
+from .httpclient import shared_pool
+
+
+logger = get_module_logger()
+
+
+@dataclass
+class EngineStats:
+    cycles: int = 0
+    errors: int = 0
+    last_latency: float = 0.0    # 直近のステップの所要時間（秒）
+    last_error: str = ''
+    last_drift: float = 0.0      # 予定した起床時刻からの遅れ（秒。スケジュール使用時）
+    max_drift: float = 0.0
+
+
+class CandleSchedule:
+    # 足の確定時刻に合わせて次に起きる時刻を決めるスケジュール
+    #
+    # 足の確定（interval の倍数の時刻）から settle 秒後に起きる（データ元の反映待ち）。
+    # light を指定すると、足の確定の間も light 秒ごとに起きる（新しい足がなければ
+    # エンジンはストップの確認だけを行う）。確定したはずの足をエンジンがまだ評価して
+    # いなければ（取得の失敗・データ元の遅れ）、次の確定を待たずに retry 秒後に起きる。
+    # 時刻の整列には壁時計を使い、待機そのものはイベントループの単調時計で行う
+
+    def __init__(self, interval, settle=5.0, light=None, retry=30.0, wall=time.time):
+        self.interval = interval
+        self.settle = settle
+        self.light = light
+        self.retry = retry
+        self.wall = wall
+
+    def next_wake(self, last_bar_time=None):
+        # (起きる時刻（エポック秒）, 種類) を返す。種類: 'bar' / 'light' / 'catch-up'
+        now = self.wall()
+        closed = math.floor(now / self.interval) * self.interval  # 直近の足の確定時刻
+        wake = closed + self.settle
+        if wake <= now:
+            wake += self.interval
+        # 確定済みの足（開始時刻 closed - interval）を評価していなければ取り直す
+        if last_bar_time is not None and last_bar_time < closed - self.interval and \
+                now >= closed + self.settle and now + self.retry < wake:
+            return now + self.retry, 'catch-up'
+        if self.light and now + self.light < wake - self.light / 2:
+            return now + self.light, 'light'
+        return wake, 'bar'
+
+
+class EngineRunner:
+    # 銘柄ごとの TradingEngine を asyncio のタスクとして並行に動かす
+    #
+    # 取引所APIの呼び出しはブロッキングなので、各エンジンの step() はスレッドで実行する
+    # （asyncio.to_thread）。1銘柄のAPI応答が遅れても他の銘柄の判断は待たされず、
+    # 1サイクルにかかる時間は各銘柄の合計ではなく最も遅い銘柄の時間になる。
+    # エンジンのエラーはそのエンジンのタスクの中で記録して次のサイクルに進む
+    # stats_interval 秒ごとと終了時に、エンジンとAPI（接続・レート制限）の統計をログに出す
+
+    def __init__(self, engines, wait_time, schedule: CandleSchedule = None,
+                 stats_interval=600.0):
+        self.engines = list(engines)
+        self.wait_time = wait_time
+        # schedule を指定すると wait_time の代わりに足の確定時刻に合わせて待つ
+        self.schedule = schedule
+        self.stats_interval = stats_interval
+        self.stats = {engine.spec.name: EngineStats() for engine in self.engines}
+        self._stopped = None
+
+    async def run(self, cycles=None):
+        # 全エンジンを動かす。cycles を指定するとその回数だけ step() して終わる
+        # （省略時は stop() が呼ばれるかタスクがキャンセルされるまで続ける）
+        self._stopped = asyncio.Event()
+        tasks = [asyncio.create_task(self._run_engine(engine, cycles),
+                                     name=f'engine-{engine.spec.name}')
+                 for engine in self.engines]
+        reporter = None
+        if self.stats_interval:
+            reporter = asyncio.create_task(self._report_loop(), name='runner-stats')
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if reporter is not None:
+                reporter.cancel()
+                await asyncio.gather(reporter, return_exceptions=True)
+            self.report()
+
+    def stop(self):
+        if self._stopped is not None:
+            self._stopped.set()
+
+    def report(self):
+        # エンジンの統計と、共有の接続プール・レート制限の利用状況をログに出して返す
+        pool = shared_pool()
+        report = {'engines': {name: asdict(stats) for name, stats in self.stats.items()},
+                  'http': pool.stats()}
+        if pool.limiter is not None:
+            report['rate-limit'] = pool.limiter.stats()
+        logger.info({'runner-stats': report})
+        return report
+
+    async def _report_loop(self):
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            self.report()
+
+    async def _run_engine(self, engine: TradingEngine, cycles):
+        stats = self.stats[engine.spec.name]
+        while not self._stopped.is_set():
+            started = time.monotonic()
+            try:
+                # 取引ごとにログを追えるようにトランザクションIDを更新する
+                update_transaction_id()
+                logger.debug(f'start trade cycle: {engine.spec.name}')
+                await asyncio.to_thread(engine.step)
+                logger.debug(f'end trade cycle: {engine.spec.name}')
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                # 予期せぬエラーが発生しても、このエンジンも他のエンジンも継続させる
+                stats.errors += 1
+                stats.last_error = str(e)
+                logger.warning(f'[{engine.spec.name}] unhandled error occurred. '
+                               f'but keep event loop. error: {e}')
+            stats.cycles += 1
+            stats.last_latency = time.monotonic() - started
+            if cycles is not None and stats.cycles >= cycles:
+                return
+            await self._wait(engine, stats)
+
+    async def _wait(self, engine, stats):
+        # 次のサイクルまで待機する（stop() で待機を打ち切る）
+        if self.schedule is None:
+            # APIリクエストの上限に注意して待機する
+            logger.debug(f'[{engine.spec.name}] wait a {self.wait_time} sec')
+            target = None
+            delay = self.wait_time
+        else:
+            target, kind = self.schedule.next_wake(engine.last_bar_time)
+            delay = max(target - self.schedule.wall(), 0.0)
+            if kind == 'catch-up':
+                logger.info(f'[{engine.spec.name}] the last closed candle is not evaluated yet. '
+                            f'retry in {delay:.0f} sec')
+            logger.debug(f'[{engine.spec.name}] wait {delay:.1f} sec for {kind} '
+                         f'(at {target:.0f})')
+        try:
+            await asyncio.wait_for(self._stopped.wait(), timeout=delay)
+            return
+        except asyncio.TimeoutError:
+            pass
+        if target is not None:
+            # 予定より遅れて起きた分（イベントループの混雑・スリープからの復帰など）を記録する
+            drift = self.schedule.wall() - target
+            stats.last_drift = drift
+            stats.max_drift = max(stats.max_drift, drift)
+            if drift >= self.schedule.interval:
+                # 足の確定を丸ごと逃した。起きたこのサイクルで最新の足から評価し直す
+                logger.warning(f'[{engine.spec.name}] woke {drift:.0f} sec late. '
+                               f'catch up {int(drift // self.schedule.interval)} missed candles')
+            elif drift > 1.0:
+                logger.warning(f'[{engine.spec.name}] woke {drift:.1f} sec late')
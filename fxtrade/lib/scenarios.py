@@ -0,0 +1,142 @@
+import copy
+import csv
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+
+from . import get_module_logger
+from .backtest import run_backtest, TapeStrategy
+from .exchange import products_from_config
+from .history import load_packed, DEFAULT_START_MS
+from .recost import COST_FIELDS
+from .strategy import TrendStrategy, create_strategy
+
+
+logger = get_module_logger()
+
+
+# 比較表の列
+TABLE_COLUMNS = ('product', 'interval', 'cost', 'final_equity', 'cagr', 'max_drawdown',
+                 'trade_count', 'fees_paid', 'swap_paid', 'margin_call_count')
+
+
+def expand_scenarios(scenario):
+    # シナリオ定義から実行するグループのリストを作る
+    #
+    # scenario の例:
+    #   {"products": ["btc", "eth"], "intervals": ["1h", "4h", "1d"], "initial": 500000,
+    #    "config": {...tradingセクション...},
+    #    "costs": [{"name": "base"}, {"name": "slip20", "slippage": 0.002},
+    #              {"name": "swap2x", "swap_rate_daily": 0.0008}]}
+    # コストの項目は run_backtest の引数名（省略した項目はデフォルト値）。
+    # 銘柄と足の間隔が同じセルはコストが違っても売買の判断がほぼ同じなので、
+    # 1つのグループにまとめて指標の計算を共有する
+    products = scenario.get('products') or ['btc']
+    intervals = scenario.get('intervals') or ['1h']
+    costs = [dict(c) for c in scenario.get('costs') or [{'name': 'base'}]]
+    for i, cost in enumerate(costs):
+        unknown = set(cost) - set(COST_FIELDS) - {'name'}
+        if unknown:
+            raise ValueError(f'unknown cost fields: {sorted(unknown)} (use {COST_FIELDS})')
+        cost.setdefault('name', f'cost{i}')
+    groups = []
+    for product in products:
+        for interval in intervals:
+            groups.append({
+                'product': product,
+                'interval': interval,
+                'initial': float(scenario.get('initial', 500000)),
+                'start_ms': int(scenario.get('start-ms', DEFAULT_START_MS)),
+                'config': copy.deepcopy(scenario.get('config') or {}),
+                'costs': costs,
+            })
+    return groups
+
+
+# --- ワーカー ---
+
+_datasets = {}
+
+
+def run_group(group, cache_dir):
+    # 1グループ（同じ銘柄・足の間隔で、コストだけが違うセル）を実行し、表の行のリストを返す
+    #
+    # 最初のコストで通常どおり実行してシグナルをテープに記録し、残りのコストは
+    # TapeStrategy で再生する。コストの違いでポジション状態が記録とずれた足だけ
+    # 戦略を計算し直すため、結果は各コストで run_backtest した場合と一致する
+    spec = products_from_config(group['product'])[0]
+    key = (spec.symbol, group['interval'], group['start_ms'])
+    if key not in _datasets:
+        # ノード内の全プロセスが同じパック形式のキャッシュをmmapする
+        _datasets[key] = load_packed(spec.symbol, group['interval'], group['start_ms'],
+                                     cache_dir)
+    candles = _datasets[key]
+    config = group['config']
+    replayable = isinstance(create_strategy(config.get('strategy')), TrendStrategy)
+
+    rows = []
+    tape = None
+    for cost in group['costs']:
+        costs = {k: cost[k] for k in COST_FIELDS if k in cost}
+        strategy = None
+        if tape is not None:
+            strategy = TapeStrategy(tape, create_strategy(config.get('strategy')))
+        result = run_backtest(spec, candles, group['initial'], config=config,
+                              record_tape=replayable and tape is None, strategy=strategy,
+                              **costs)
+        if tape is None:
+            tape = result.tape
+        else:
+            logger.debug(f'[{spec.name}] {group["interval"]} {cost["name"]}: '
+                         f'replayed={strategy.replayed} recomputed={strategy.recomputed}')
+        row = {'product': group['product'], 'interval': group['interval'],
+               'cost': cost['name']}
+        row.update({k: v for k, v in result.to_dict().items() if k in TABLE_COLUMNS})
+        rows.append(row)
+    return rows
+
+
+def run_scenarios(scenario, cache_dir='docs/artifacts/data', workers=None):
+    # シナリオの全セルを並列に実行し、比較表の行のリストを返す
+    groups = expand_scenarios(scenario)
+    # データセットは起動前に用意しておく（ワーカーが同時に取得しないように）
+    for group in groups:
+        spec = products_from_config(group['product'])[0]
+        load_packed(spec.symbol, group['interval'], group['start_ms'], cache_dir)
+
+    workers = workers or os.cpu_count() or 1
+    logger.info(f'run {len(groups)} scenario groups '
+                f'({sum(len(g["costs"]) for g in groups)} cells) on {workers} workers')
+    if workers > 1 and len(groups) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(groups))) as pool:
+            results = list(pool.map(run_group, groups, [cache_dir] * len(groups)))
+    else:
+        results = [run_group(g, cache_dir) for g in groups]
+    return [row for rows in results for row in rows]
+
+
+def format_table(rows):
+    # 比較表をテキストに整形する
+    header = ('product', 'interval', 'cost', 'final', 'cagr', 'maxDD', 'trades',
+              'fees', 'swap', 'margin_calls')
+    lines = [[r['product'], r['interval'], r['cost'], f'{r["final_equity"]:,.0f}',
+              f'{r["cagr"]:+.1%}', f'{r["max_drawdown"]:.1%}', str(r['trade_count']),
+              f'{r["fees_paid"]:,.0f}', f'{r["swap_paid"]:,.0f}', str(r['margin_call_count'])]
+             for r in rows]
+    widths = [max(len(h), *(len(line[i]) for line in lines)) if lines else len(h)
+              for i, h in enumerate(header)]
+    out = ['  '.join(h.ljust(w) for h, w in zip(header, widths))]
+    out.extend('  '.join(v.rjust(w) if i >= 3 else v.ljust(w)
+                         for i, (v, w) in enumerate(zip(line, widths)))
+               for line in lines)
+    return '\n'.join(out)
+
+
+def write_table(rows, path):
+    # 比較表をCSVに書き出す
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=TABLE_COLUMNS)
+        writer.writeheader()
+        for row in rows:
+            writer.writerow({k: row[k] for k in TABLE_COLUMNS})
@@ -0,0 +1,125 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+
+
+from . import get_module_logger
+from .candles import candles_to_csv, candles_from_csv
+from .history import fetch_recent_binance_klines, INTERVAL_SECONDS
+from .strategy import TrendStrategy
+
+
+logger = get_module_logger()
+
+
+@dataclass
+class ScreenRow:
+    # 1銘柄のスクリーニング結果
+    symbol: str
+    price: float
+    trend: int          # 1: 上昇（EMA fast > slow）, -1: 下降
+    strength: float     # EMAの乖離をATRで正規化した強さ（0.0〜1.0。TrendStrategy と同じ定義）
+    breakout: int       # 1: 上抜け, -1: 下抜け, 0: チャネル内
+    confirmed: bool     # トレンド方向へのブレイクアウトが確認された（TrendStrategy のエントリー条件）
+
+
+def load_universe(symbols, interval, limit, cache_dir, workers=16, refresh=False,
+                  clock=time.time):
+    # 多数の銘柄の直近のローソク足を並列に読み込む（キャッシュが新しければ取得しない）
+    # 返り値は {シンボル: ローソク足のリスト}。取得できなかった銘柄は含まない
+    bar_seconds = INTERVAL_SECONDS[interval]
+    # 確定済みの最新の足の開始時刻。キャッシュの最後の足がこれより古ければ取り直す
+    # （ファイルの更新時刻では、足の確定直前に保存したキャッシュを次の足まで使ってしまう）
+    last_closed = (int(clock()) // bar_seconds - 1) * bar_seconds
+
+    def load(symbol):
+        path = os.path.join(cache_dir, f'{symbol}_{interval}_recent.csv')
+        if os.path.exists(path) and not refresh:
+            candles = candles_from_csv(path)
+            if len(candles) >= limit and candles[-1].time >= last_closed:
+                return candles[-limit:]
+        try:
+            candles = fetch_recent_binance_klines(symbol, interval, limit=min(limit + 1, 1000))
+        except Exception as e:
+            logger.warning(f'failed to fetch candles for {symbol}: {e}')
+            return []
+        candles = candles[:-1]  # 最後の1本は未確定足なので除外する
+        candles_to_csv(candles, path)
+        return candles
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        loaded = dict(zip(symbols, pool.map(load, symbols)))
+    return {symbol: candles for symbol, candles in loaded.items() if candles}
+
+
+def price_matrix(universe, length):
+    # 銘柄ごとのローソク足を末尾 length 本で揃え、2次元の行列（時刻 × 銘柄）に積む
+    # 本数が足りない銘柄は除外する。返り値は (シンボルのリスト, 終値, 高値, 安値)
+    symbols = [s for s, candles in universe.items() if len(candles) >= length]
+    columns = [universe[s][-length:] for s in symbols]
+    closes = [[col[t].close for col in columns] for t in range(length)]
+    highs = [[col[t].high for col in columns] for t in range(length)]
+    lows = [[col[t].low for col in columns] for t in range(length)]
+    return symbols, closes, highs, lows
+
+
+def screen(symbols, closes, highs, lows, strategy: TrendStrategy):
+    # 全銘柄の EMA クロス・ATR で正規化したトレンドの強さ・ドンチャンブレイクアウトを
+    # 行列の1回の走査でまとめて計算する（値は strategy.evaluate を銘柄ごとに呼んだ場合と一致する）
+    if strategy.atr_source != 'ema' or strategy.band_mode != 'donchian':
+        raise ValueError('screener supports the default atr-source / band-source only')
+    n = len(symbols)
+    if not n:
+        return []
+    fast_alpha = 2.0 / (strategy.fast_span + 1)
+    slow_alpha = 2.0 / (strategy.slow_span + 1)
+    atr_alpha = 2.0 / (strategy.atr_span + 1)
+
+    fast = list(closes[0])
+    slow = list(closes[0])
+    atr = [highs[0][j] - lows[0][j] for j in range(n)]
+    for t in range(1, len(closes)):
+        row, high_row, low_row, prev = closes[t], highs[t], lows[t], closes[t - 1]
+        for j in range(n):
+            v = row[j]
+            fast[j] = fast_alpha * v + (1 - fast_alpha) * fast[j]
+            slow[j] = slow_alpha * v + (1 - slow_alpha) * slow[j]
+            h, lo, pc = high_row[j], low_row[j], prev[j]
+            tr = max(h - lo, abs(h - pc), abs(lo - pc))
+            atr[j] = atr_alpha * tr + (1 - atr_alpha) * atr[j]
+
+    # ブレイクアウトは現在の足を除いた直近N本の終値で判定する
+    window = closes[-(strategy.donchian_span + 1):-1]
+    high_band = [max(r[j] for r in window) for j in range(n)]
+    low_band = [min(r[j] for r in window) for j in range(n)]
+
+    rows = []
+    last = closes[-1]
+    for j, symbol in enumerate(symbols):
+        trend = 1 if fast[j] > slow[j] else -1
+        strength = min(abs(fast[j] - slow[j]) / (atr[j] * 2.0), 1.0) if atr[j] > 0 else 0.0
+        breakout = 1 if last[j] > high_band[j] else (-1 if last[j] < low_band[j] else 0)
+        rows.append(ScreenRow(symbol=symbol, price=last[j], trend=trend, strength=strength,
+                              breakout=breakout, confirmed=(breakout == trend)))
+    return rank(rows)
+
+
+def rank(rows):
+    # 確認済みのトレンドを優先し、強い順に並べる
+    return sorted(rows, key=lambda r: (not r.confirmed, -r.strength, r.symbol))
+
+
+def screen_universe(symbols, interval, cache_dir, strategy_config=None, workers=16,
+                    refresh=False, clock=time.time):
+    # 銘柄リストを読み込み、TrendStrategy の条件でスクリーニングした順位表を返す
+    strategy = TrendStrategy(strategy_config)
+    # ライブのエンジンと同じ本数の足で計算する
+    length = strategy.min_history() + 10
+    universe = load_universe(symbols, interval, length, cache_dir,
+                             workers=workers, refresh=refresh, clock=clock)
+    symbols, closes, highs, lows = price_matrix(universe, length)
+    skipped = len(universe) - len(symbols)
+    if skipped:
+        logger.info(f'{skipped} symbols skipped (less than {length} candles)')
+    return screen(symbols, closes, highs, lows, strategy)
@@ -0,0 +1,183 @@
+from dataclasses import dataclass, replace
+
+
+from . import get_module_logger
+from .backtest import SimulatedExchange, BacktestResult, run_backtest
+from .engine import TradingEngine
+from .exchange import ProductSpec
+from .strategy import PositionState, TrendStrategy, create_strategy
+
+
+logger = get_module_logger()
+
+
+class SharedSignals:
+    # 同じ足を同時に進める複数のエンジンで、シグナルの計算結果を共有する戦略
+    #
+    # TrendStrategy のシグナルはローソク足とポジション状態だけで決まるため、
+    # 同じ足で同じ状態のエンジン（ノーポジション同士、同じ足で建てたポジション同士）には
+    # 1回計算したシグナルを配る。保持するのは現在の足の分だけ
+
+    def __init__(self, strategy: TrendStrategy):
+        self.strategy = strategy
+        self.time = None
+        self.signals = {}
+        self.computed = 0
+        self.shared = 0
+
+    @property
+    def allow_short(self):
+        return self.strategy.allow_short
+
+    @allow_short.setter
+    def allow_short(self, value):
+        self.strategy.allow_short = value
+
+    def min_history(self):
+        return self.strategy.min_history()
+
+    def evaluate(self, candles, position: PositionState):
+        time = candles[-1].time
+        if time != self.time:
+            self.time = time
+            self.signals.clear()
+        state = (position.direction, position.entry_price, position.extreme_price)
+        signal = self.signals.get(state)
+        if signal is not None:
+            # 元の戦略と同じく、保有中は最良値を更新してから返す
+            position.update_extreme(candles[-1].close)
+            self.shared += 1
+            return replace(signal)
+        self.computed += 1
+        signal = self.strategy.evaluate(candles, position)
+        self.signals[state] = replace(signal)
+        return signal
+
+
+class _StartRun:
+    # 1つの開始位置のバックテストの状態（資産推移は保持せず、最大ドローダウンだけを追う）
+
+    def __init__(self, spec, candles, initial_jpy, start, strategy, config, costs):
+        self.start = start
+        self.sim = SimulatedExchange(spec, candles, initial_jpy, **costs)
+        self.engine = TradingEngine(self.sim, spec, strategy=strategy, config=config)
+        self.peak = initial_jpy
+        self.max_dd = 0.0
+
+    def step(self, index):
+        self.sim.advance(index)
+        self.engine.step()
+        eq = self.sim.equity()
+        self.peak = max(self.peak, eq)
+        if self.peak > 0:
+            self.max_dd = max(self.max_dd, 1.0 - eq / self.peak)
+
+    def result(self, candles, initial_jpy):
+        acc = self.sim.account
+        return BacktestResult(
+            initial_equity=initial_jpy,
+            final_equity=self.sim.equity(),
+            max_drawdown=self.max_dd,
+            trade_count=acc.trade_count,
+            fees_paid=acc.fees_paid,
+            swap_paid=acc.swap_paid,
+            margin_call_count=self.sim.margin_call_count,
+            years=(candles[-1].time - candles[self.start].time) / (365.25 * 86400),
+        )
+
+
+@dataclass
+class StartDateResult:
+    start: int              # 開始位置（足の添字）
+    start_time: int         # 開始時刻（エポック秒）
+    result: BacktestResult
+
+
+def start_indices(candles, every_seconds, count, warmup=0):
+    # warmup 本目から every_seconds ごとに count 個の開始位置を選ぶ
+    indices = []
+    next_time = None
+    for i in range(warmup, len(candles)):
+        if next_time is None or candles[i].time >= next_time:
+            indices.append(i)
+            if len(indices) >= count:
+                break
+            next_time = candles[i].time + every_seconds
+    return indices
+
+
+def _distinct_starts(starts, warmup):
+    # 指標の準備期間（warmup 本）より前の開始位置は warmup に揃えて実行されるため、
+    # 同じ位置に揃う開始位置は最初の1つだけを残す（同じ結果が分布に重複しないように）
+    seen = set()
+    result = []
+    for s in starts:
+        effective = max(s, warmup)
+        if effective in seen:
+            logger.warning(f'start {s} falls inside the warmup ({warmup} bars). skipped')
+            continue
+        seen.add(effective)
+        result.append(s)
+    return result
+
+
+def run_start_dates(spec: ProductSpec, candles, initial_jpy, starts, config=None,
+                    fee_rate=None, slippage=0.0005, swap_rate_daily=0.0004):
+    # 同じ設定のバックテストを複数の開始位置から実行する（開始時期への感応度の検証）
+    #
+    # 全開始位置のエンジンを同じ足で並べて進め、シグナルは SharedSignals で共有する。
+    # 開始時期が違っても、ノーポジション同士や同じ足でエントリーしたもの同士は状態が
+    # 一致するため、指標の計算はほぼ1回分で済む（開始位置ごとに増えるのは口座の計算だけ）。
+    # 各結果は run_backtest(start=...) と一致する（資産推移は保持しない）
+    config = config or {}
+    costs = dict(fee_rate=fee_rate, slippage=slippage, swap_rate_daily=swap_rate_daily)
+    base = create_strategy(config.get('strategy'))
+    starts = _distinct_starts(starts, base.min_history())
+    if not isinstance(base, TrendStrategy):
+        # 内部状態を持つ戦略はシグナルを共有できないので、1つずつ実行する
+        return [StartDateResult(start=s, start_time=candles[s].time,
+                                result=run_backtest(spec, candles, initial_jpy, config=config,
+                                                    start=s, **costs))
+                for s in starts]
+
+    strategy = SharedSignals(base)
+    warmup = strategy.min_history()
+    runs = [_StartRun(spec, candles, initial_jpy, s, strategy, config, costs)
+            for s in sorted({max(s, warmup) for s in starts}) if s < len(candles)]
+    active = []
+    pending = list(runs)
+    first = runs[0].start if runs else len(candles)
+    for i in range(first, len(candles)):
+        while pending and pending[0].start == i:
+            active.append(pending.pop(0))
+        for run in active:
+            run.step(i)
+    logger.info(f'[{spec.name}] {len(runs)} start dates: signals computed={strategy.computed} '
+                f'shared={strategy.shared}')
+
+    by_start = {run.start: run for run in runs}
+    results = []
+    for s in starts:
+        run = by_start.get(max(s, warmup))
+        if run is None:
+            logger.warning(f'start {s} is beyond the data. skipped')
+            continue
+        results.append(StartDateResult(start=s, start_time=candles[run.start].time,
+                                       result=run.result(candles, initial_jpy)))
+    return results
+
+
+def distribution(values):
+    # 値の分布の要約（最小・四分位・中央値・最大）
+    values = sorted(values)
+    if not values:
+        return {}
+
+    def quantile(q):
+        pos = q * (len(values) - 1)
+        lo = int(pos)
+        hi = min(lo + 1, len(values) - 1)
+        return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+    return {'min': values[0], 'p25': quantile(0.25), 'median': quantile(0.5),
+            'p75': quantile(0.75), 'max': values[-1]}
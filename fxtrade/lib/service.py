@@ -0,0 +1,221 @@
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+from . import get_module_logger
+from .backtest import run_backtest
+from .exchange import products_from_config
+from .history import load_or_fetch, DEFAULT_START_MS, INTERVAL_SECONDS
+
+
+logger = get_module_logger()
+
+
+class DatasetCache:
+    # 読み込み済みのローソク足を保持するLRUキャッシュ（スレッドセーフ）
+    # maxsize を超えたら最も長く使われていないデータセットから捨てる
+    # 同じデータセットを同時に要求されたときは1回だけ読み込む
+
+    def __init__(self, cache_dir, maxsize=8):
+        self.cache_dir = cache_dir
+        self.maxsize = maxsize
+        self.items = OrderedDict()
+        self.key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, symbol, interval, start_ms=DEFAULT_START_MS):
+        key = (symbol, interval, start_ms)
+        with self.lock:
+            if key in self.items:
+                return self._hit(key)
+            key_lock = self.key_locks.setdefault(key, threading.Lock())
+        with key_lock:
+            with self.lock:
+                if key in self.items:
+                    return self._hit(key)
+            candles = load_or_fetch(symbol, interval, start_ms, self.cache_dir)
+            with self.lock:
+                self.misses += 1
+                self.items[key] = candles
+                self.items.move_to_end(key)
+                while len(self.items) > self.maxsize:
+                    evicted, _ = self.items.popitem(last=False)
+                    logger.debug(f'evict dataset {evicted}')
+            return candles
+
+    def _hit(self, key):
+        self.items.move_to_end(key)
+        self.hits += 1
+        return self.items[key]
+
+    def stats(self):
+        with self.lock:
+            return {'datasets': [list(k) for k in self.items], 'hits': self.hits,
+                    'misses': self.misses}
+
+
+def validate_job(job):
+    # ジョブの内容を確認し、既定値を補ったジョブを返す（不正なら ValueError）
+    if not isinstance(job, dict):
+        raise ValueError('job must be a json object')
+    job = dict(job)
+    job.setdefault('product', 'btc')
+    job.setdefault('interval', '1h')
+    job.setdefault('initial', 500000)
+    job.setdefault('start_ms', DEFAULT_START_MS)
+    if job['product'] not in ('btc', 'eth'):
+        raise ValueError(f'unknown product: {job["product"]} (use btc / eth)')
+    if job['interval'] not in INTERVAL_SECONDS:
+        raise ValueError(f'unknown interval: {job["interval"]}')
+    job['initial'] = float(job['initial'])
+    job['start_ms'] = int(job['start_ms'])
+    return job
+
+
+# --- ワーカープロセス ---
+
+_datasets = None
+
+
+def _init_worker(cache_dir, cache_size):
+    global _datasets
+    _datasets = DatasetCache(cache_dir, maxsize=cache_size)
+
+
+def run_job(job, datasets=None):
+    # 1件のバックテストジョブを実行して、結果の要約を返す
+    datasets = datasets or _datasets
+    spec = products_from_config(job['product'])[0]
+    started = time.monotonic()
+    candles = datasets.get(spec.symbol, job['interval'], job['start_ms'])
+    result = run_backtest(spec, candles, job['initial'], config=job.get('config'),
+                          skip_quiescent=bool(job.get('skip_quiescent')))
+    reply = result.to_dict(curve=bool(job.get('curve')))
+    reply['summary'] = result.summary()
+    reply['elapsed'] = time.monotonic() - started
+    return reply
+
+
+def _run_in_worker(job):
+    # ワーカーのキャッシュの状況を結果と一緒に返す（/health で集計する）
+    return run_job(job), os.getpid(), _datasets.stats()
+
+
+# --- HTTPサーバ ---
+
+class _Handler(BaseHTTPRequestHandler):
+    #   POST /backtest  ジョブ（JSON）を実行して結果を返す
+    #   GET  /health    稼働状況を返す
+
+    def do_GET(self):
+        if self.path != '/health':
+            return self._reply(404, {'error': 'not found'})
+        self._reply(200, self.server.service.stats())
+
+    def do_POST(self):
+        if self.path != '/backtest':
+            return self._reply(404, {'error': 'not found'})
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            job = validate_job(json.loads(self.rfile.read(length) or b'{}'))
+        except ValueError as e:
+            return self._reply(400, {'error': str(e)})
+        try:
+            reply = self.server.service.submit(job)
+        except Exception as e:
+            logger.warning(f'backtest job failed: {e}')
+            return self._reply(500, {'error': str(e)})
+        self._reply(200, reply)
+
+    def _reply(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        logger.debug(f'backtest service: {format % args}')
+
+
+class BacktestService:
+    # 常駐するバックテストサービス
+    # ワーカープロセスを起動したまま保ち、各ワーカーが読み込んだデータセットを
+    # LRUキャッシュに保持するため、2回目以降のジョブは起動・importとCSV読み込みのコストを払わない
+    # workers=0 の場合はサーバのスレッドで直接実行する（テスト・デバッグ用）
+
+    def __init__(self, host='127.0.0.1', port=8766, workers=2, cache_size=8,
+                 cache_dir='docs/artifacts/data'):
+        self.workers = workers
+        self.local_datasets = None
+        self.pool = None
+        if workers > 0:
+            self.pool = ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                                            initargs=(cache_dir, cache_size))
+            # 全ワーカーを先に起動しておく
+            for f in [self.pool.submit(time.sleep, 0) for _ in range(workers)]:
+                f.result()
+        else:
+            self.local_datasets = DatasetCache(cache_dir, maxsize=cache_size)
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.service = self
+        self.address = self.server.server_address
+        self.job_count = 0
+        self.worker_caches = {}  # ワーカーのPID -> 直近のジョブを終えた時点のキャッシュの状況
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self._thread = None
+
+    def submit(self, job):
+        with self.lock:
+            self.job_count += 1
+        if self.pool is not None:
+            reply, pid, cache = self.pool.submit(_run_in_worker, job).result()
+            with self.lock:
+                self.worker_caches[pid] = cache
+            return reply
+        return run_job(job, self.local_datasets)
+
+    def stats(self):
+        stats = {'jobs': self.job_count, 'workers': self.workers,
+                 'uptime': time.time() - self.started}
+        if self.local_datasets is not None:
+            stats['cache'] = self.local_datasets.stats()
+        else:
+            # 各ワーカーのキャッシュを合算する（datasets はいずれかのワーカーが持っているもの）
+            with self.lock:
+                caches = list(self.worker_caches.values())
+            datasets = sorted({tuple(d) for cache in caches for d in cache['datasets']})
+            stats['cache'] = {'datasets': [list(d) for d in datasets],
+                              'hits': sum(cache['hits'] for cache in caches),
+                              'misses': sum(cache['misses'] for cache in caches)}
+        return stats
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f'backtest service listening on http://{self.address[0]}:{self.address[1]}')
+        return self
+
+    def serve_forever(self):
+        logger.info(f'backtest service listening on http://{self.address[0]}:{self.address[1]}')
+        try:
+            self.server.serve_forever()
+        finally:
+            self.close()
+
+    def close(self):
+        if self._thread is not None:
+            self.server.shutdown()
+        self.server.server_close()
+        if self.pool is not None:
+            self.pool.shutdown()
@@ -2,7 +2,7 @@ from dataclasses import dataclass
 
 
 from . import get_module_logger
-from .indicators import ema, atr
+from .indicators import IndicatorBank, RollingQuantile
 
 
 logger = get_module_logger()
@@ -44,6 +44,9 @@ class TrendStrategy:
     # 強さ:
     #   - EMAの乖離をATRで正規化した値。トレンドが強いほどポジションを大きくする
 
+    ATR_SOURCES = ('ema', 'median')
+    BAND_SOURCES = ('donchian', 'quantile')
+
     def __init__(self, config=None):
         config = config or {}
         # デフォルト値はBTC/ETHの2017〜2026年のバックテストで選定した
@@ -54,6 +57,23 @@ class TrendStrategy:
         self.donchian_span = int(config.get('donchian-span', 200))
         self.trail_atr_mult = float(config.get('trail-atr-mult', 2.5))
         self.allow_short = bool(config.get('allow-short', True))
+        # ATRの代わりに真の値幅の中央値を使う（'median'）と、急変した1本でストップが広がらない
+        self.atr_source = config.get('atr-source', 'ema')
+        # ブレイクアウト帯を最高値・最安値の代わりに分位点で作る（'quantile'）と、
+        # 一時的なヒゲのような終値でチャネルが広がらない。band-quantile=0.1 なら 90%/10% 点
+        self.band_mode = config.get('band-source', 'donchian')
+        self.band_quantile = float(config.get('band-quantile', 0.1))
+        if self.atr_source not in self.ATR_SOURCES:
+            raise ValueError(f'unknown atr-source: {self.atr_source} '
+                             f'(use {" / ".join(self.ATR_SOURCES)})')
+        if self.band_mode not in self.BAND_SOURCES:
+            raise ValueError(f'unknown band-source: {self.band_mode} '
+                             f'(use {" / ".join(self.BAND_SOURCES)})')
+        # 中央値・分位点を足ごとに差分更新するための状態（RollingQuantile, 直近の足の目印）
+        self._rollers = {}
+        # ブレイクアウト帯の外部の索引（indicators.SparseTable）。指定するとウィンドウ内で
+        # 計算する代わりにそこから引く（同じ系列でドンチャンの期間を変えて何度も評価する場合）
+        self.band_source = None
         logger.debug(f'TrendStrategy params: fast={self.fast_span} slow={self.slow_span} '
                      f'atr={self.atr_span} donchian={self.donchian_span} '
                      f'trail={self.trail_atr_mult} allow_short={self.allow_short}')
@@ -69,18 +89,24 @@ class TrendStrategy:
             return Signal(direction=0, strength=0.0, stop_price=0.0, atr=0.0,
                           price=candles[-1].close if candles else 0.0)
 
-        closes = [c.close for c in candles]
-        price = closes[-1]
+        band_spans = ()
+        if self.band_source is None and self.band_mode == 'donchian':
+            band_spans = (self.donchian_span,)
+        atr_spans = (self.atr_span,) if self.atr_source == 'ema' else ()
+        bank = IndicatorBank(candles, ema_spans=(self.fast_span, self.slow_span),
+                             atr_spans=atr_spans, band_spans=band_spans)
+        return self.evaluate_bank(bank, position)
 
-        fast = ema(closes, self.fast_span)
-        slow = ema(closes, self.slow_span)
-        atr_series = atr(candles, self.atr_span)
-        current_atr = atr_series[-1]
+    def evaluate_bank(self, bank: IndicatorBank, position: PositionState):
+        # 計算済みの指標（IndicatorBank）からシグナルを計算する
+        # 複数の戦略で指標を共有する場合はこちらを直接呼ぶ
+        price = bank.closes[-1]
+        fast = bank.ema(self.fast_span)
+        slow = bank.ema(self.slow_span)
+        current_atr = self._atr(bank)
         # ブレイクアウト判定は現在の足を除いた直近N本の終値で行う
         # （高値・安値ベースだと緩やかなトレンドを取りこぼすため終値を使う）
-        window = closes[-(self.donchian_span + 1):-1]
-        high_band = max(window)
-        low_band = min(window)
+        high_band, low_band = self._bands(bank)
 
         trend = 1 if fast[-1] > slow[-1] else -1
 
@@ -121,6 +147,47 @@ class TrendStrategy:
 
         return Signal(0, 0.0, 0.0, current_atr, price)
 
+    def _atr(self, bank):
+        if self.atr_source == 'median':
+            candles = bank.candles
+            return self._roller('atr', self.atr_span, candles, len(candles),
+                                lambda k: _true_range(candles, k)).quantile(0.5)
+        return bank.atr(self.atr_span)[-1]
+
+    def _bands(self, bank):
+        if self.band_mode == 'quantile':
+            # 現在の足を除いた直近N本の終値の分位点
+            closes = bank.closes
+            roll = self._roller('band', self.donchian_span, bank.candles, len(closes) - 1,
+                                closes.__getitem__)
+            return (roll.quantile(1.0 - self.band_quantile), roll.quantile(self.band_quantile))
+        if self.band_source is not None:
+            bands = self.band_source.bands_at(bank.candles[-1].time, self.donchian_span)
+            if bands is not None:
+                return bands
+        return bank.bands(self.donchian_span)
+
+    def _roller(self, key, span, candles, end, value_at):
+        # value_at(0..end-1) の末尾span個を保持する RollingQuantile を返す
+        # 前回の呼び出しから1本進んだだけなら1個追加するだけ（O(log span)）で、
+        # それ以外（初回・飛び・別の系列）は窓から作り直す。どちらでも値は同じ
+        mark = (candles[end - 1].time, candles[end - 1].close, candles[max(0, end - span)].close)
+        roll, last = self._rollers.get(key, (None, None))
+        if last == mark:
+            return roll
+        prev = None
+        if end >= 2:
+            prev = (candles[end - 2].time, candles[end - 2].close,
+                    candles[max(0, end - 1 - span)].close)
+        if roll is not None and last == prev:
+            roll.update(value_at(end - 1))
+        else:
+            roll = RollingQuantile(span)
+            for k in range(max(0, end - span), end):
+                roll.update(value_at(k))
+        self._rollers[key] = (roll, mark)
+        return roll
+
     def _breakout_confirmed(self, trend, price, high_band, low_band):
         # ドンチャンチャネルのブレイクアウトでトレンドを確認する
         if trend > 0:
@@ -135,3 +202,118 @@ class TrendStrategy:
     def _trailing_stop(self, position: PositionState, current_atr):
         # シャンデリアエグジット: 最良値からATR×係数の逆行で決済
         return position.extreme_price - position.direction * self.trail_atr_mult * current_atr
+
+
+def _true_range(candles, k):
+    # k本目の真の値幅（indicators.true_ranges と同じ定義）
+    c = candles[k]
+    if k == 0:
+        return c.high - c.low
+    pc = candles[k - 1].close
+    return max(c.high - c.low, abs(c.high - pc), abs(c.low - pc))
+
+
+class EnsembleStrategy:
+    # 複数の TrendStrategy（パラメータ違い）のシグナルを1つの目標にまとめる戦略
+    #
+    # - 指標はメンバー全員の期間をまとめて IndicatorBank で1回だけ計算し、共有する
+    #   （EMA 10/20/50 と 200/300 のように期間が重なっても再計算しない）
+    # - 各メンバーは自分専用の仮想ポジション状態を持ち、単独で運用した場合と同じ判断をする
+    # - mode:
+    #     'average': 方向×強さの平均。符号が方向、絶対値が強さ
+    #     'vote'   : 過半数のメンバーが同じ方向のときだけその方向に張る。
+    #                強さは賛成メンバーの強さの合計 / メンバー数
+    # 設定例: {"mode": "vote", "trail-atr-mult": 2.5,
+    #          "members": [{"fast-span": 10, "slow-span": 200}, {"fast-span": 50, "slow-span": 300}]}
+    # メンバーの設定に無い項目は上位の設定を引き継ぐ
+
+    MODES = ('average', 'vote')
+
+    def __init__(self, config):
+        config = dict(config)
+        member_configs = config.pop('members')
+        self.mode = config.pop('mode', 'average')
+        if self.mode not in self.MODES:
+            raise ValueError(f'unknown ensemble mode: {self.mode} (use {" / ".join(self.MODES)})')
+        if not member_configs:
+            raise ValueError('ensemble strategy needs at least one member')
+        self.members = [TrendStrategy(dict(config, **m)) for m in member_configs]
+        self.member_states = [PositionState() for _ in self.members]
+        self._ema_spans = sorted({s for m in self.members for s in (m.fast_span, m.slow_span)})
+        self._atr_spans = sorted({m.atr_span for m in self.members})
+        self._band_spans = sorted({m.donchian_span for m in self.members})
+        logger.debug(f'EnsembleStrategy: mode={self.mode} members={len(self.members)}')
+
+    @property
+    def allow_short(self):
+        return all(m.allow_short for m in self.members)
+
+    @allow_short.setter
+    def allow_short(self, value):
+        for m in self.members:
+            m.allow_short = value
+
+    def min_history(self):
+        return max(m.min_history() for m in self.members)
+
+    def evaluate(self, candles, position: PositionState):
+        # position はエンジン側の実ポジションの状態。メンバーは各自の仮想状態で判断する
+        if len(candles) < self.min_history():
+            logger.debug(f'not enough candles: {len(candles)} < {self.min_history()}')
+            return Signal(direction=0, strength=0.0, stop_price=0.0, atr=0.0,
+                          price=candles[-1].close if candles else 0.0)
+
+        bank = IndicatorBank(candles, ema_spans=self._ema_spans,
+                             atr_spans=self._atr_spans, band_spans=self._band_spans)
+        price = bank.closes[-1]
+        signals = []
+        for i, member in enumerate(self.members):
+            signal = member.evaluate_bank(bank, self.member_states[i])
+            signals.append(signal)
+            self._follow(i, signal)
+
+        if self.mode == 'average':
+            score = sum(s.direction * s.strength for s in signals) / len(signals)
+            direction = (score > 0) - (score < 0)
+            strength = abs(score)
+        else:
+            votes = sum(s.direction for s in signals)
+            direction = (votes > 0) - (votes < 0)
+            agree = [s for s in signals if s.direction == direction]
+            if direction == 0 or len(agree) * 2 <= len(signals):
+                direction = 0
+            strength = sum(s.strength for s in agree) / len(signals) if direction else 0.0
+
+        current_atr = sum(s.atr for s in signals) / len(signals)
+        if direction == 0:
+            return Signal(0, 0.0, 0.0, current_atr, price)
+        # 損切り水準は同じ方向のメンバーの水準の平均
+        agree = [s for s in signals if s.direction == direction]
+        stop = sum(s.stop_price for s in agree) / len(agree)
+        logger.debug(f'ensemble signal: direction={direction} strength={strength:.3f} '
+                     f'members={[s.direction for s in signals]}')
+        return Signal(direction, strength, stop, current_atr, price)
+
+    def _follow(self, i, signal):
+        # メンバーの仮想ポジション状態をシグナルどおりに更新する（エンジンの状態更新と同じ規則）
+        state = self.member_states[i]
+        if signal.direction == state.direction:
+            return
+        if signal.direction == 0:
+            self.member_states[i] = PositionState()
+        else:
+            self.member_states[i] = PositionState(direction=signal.direction,
+                                                  entry_price=signal.price,
+                                                  extreme_price=signal.price)
+
+
+def create_strategy(config=None):
+    # 設定から戦略を作る（members があればアンサンブル、rules があればルール式の戦略、
+    # どちらもなければ単独の TrendStrategy）
+    config = config or {}
+    if config.get('members'):
+        return EnsembleStrategy(config)
+    if config.get('rules'):
+        from .rules import RuleStrategy
+        return RuleStrategy(config)
+    return TrendStrategy(config)
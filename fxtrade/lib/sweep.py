@@ -0,0 +1,347 @@
+import copy
+import hmac
+import itertools
+import json
+import multiprocessing
+import os
+import socket
+import socketserver
+import threading
+import time
+import uuid
+from collections import deque
+
+
+from . import get_module_logger, set_config_path
+from .backtest import run_backtest
+from .exchange import products_from_config
+from .history import load_packed, DEFAULT_START_MS
+from .indicators import SparseTable
+from .strategy import TrendStrategy, create_strategy
+
+
+logger = get_module_logger()
+
+
+# --- スイープの定義 ---
+
+def expand_sweep(sweep):
+    # スイープ定義から実行するセル（1回分のバックテスト条件）のリストを作る
+    #
+    # sweep の例:
+    #   {"products": ["btc", "eth"], "intervals": ["1h", "4h"], "initial": 500000,
+    #    "config": {...tradingセクション...},
+    #    "grid": {"strategy.donchian-span": [100, 200], "risk.risk-per-trade": [0.02, 0.04]}}
+    # grid のキーは config 内の位置をドット区切りで指定する
+    products = sweep.get('products') or ['btc']
+    intervals = sweep.get('intervals') or ['1h']
+    grid = sweep.get('grid') or {}
+    keys = sorted(grid)
+    cells = []
+    for product, interval in itertools.product(products, intervals):
+        for values in itertools.product(*(grid[k] for k in keys)):
+            config = copy.deepcopy(sweep.get('config') or {})
+            params = dict(zip(keys, values))
+            for key, value in params.items():
+                set_config_path(config, key, value)
+            cells.append({
+                'product': product,
+                'interval': interval,
+                'initial': float(sweep.get('initial', 500000)),
+                'start_ms': int(sweep.get('start-ms', DEFAULT_START_MS)),
+                'params': params,
+                'config': config,
+            })
+    return cells
+
+
+def cell_dataset(cell):
+    # セルが使うデータセット（シンボル, 足の間隔）
+    spec = products_from_config(cell['product'])[0]
+    return (spec.symbol, cell['interval'])
+
+
+def run_cell(cell, candles, band_source=None):
+    # 1セル分のバックテストを実行し、結果の要約を返す
+    # band_source: データセットの終値の SparseTable（ドンチャンの期間によらず共有できる）
+    spec = products_from_config(cell['product'])[0]
+    config = cell.get('config') or {}
+    strategy = create_strategy(config.get('strategy'))
+    if band_source is not None and isinstance(strategy, TrendStrategy):
+        strategy.band_source = band_source
+    result = run_backtest(spec, candles, cell['initial'], config=config, strategy=strategy)
+    return result.to_dict()
+
+
+# --- コーディネータ ---
+
+class TaskBoard:
+    # セルの配布状況を管理する（スレッドセーフ）
+    # ハートビートが途絶えたワーカーに貸し出していたセルは再びキューに戻す
+
+    def __init__(self, cells):
+        self.cells = list(cells)
+        self.pending = deque(range(len(self.cells)))
+        self.leases = {}      # task_id -> worker_id
+        self.results = {}     # task_id -> 結果
+        self.last_seen = {}   # worker_id -> 最終ハートビート（monotonic）
+        self.lock = threading.Lock()
+
+    def datasets(self):
+        return sorted({cell_dataset(c) for c in self.cells})
+
+    def get(self, worker_id):
+        with self.lock:
+            self.last_seen[worker_id] = time.monotonic()
+            if self.pending:
+                task_id = self.pending.popleft()
+                self.leases[task_id] = worker_id
+                logger.debug(f'task {task_id} leased to {worker_id}')
+                return {'task': task_id, 'cell': self.cells[task_id]}
+            if self.leases:
+                return {'wait': True}
+            return {'done': True}
+
+    def heartbeat(self, worker_id):
+        with self.lock:
+            self.last_seen[worker_id] = time.monotonic()
+        return {}
+
+    def put(self, worker_id, task_id, result):
+        with self.lock:
+            self.last_seen[worker_id] = time.monotonic()
+            # 再配布後に遅れて届いた結果は最初の1件だけ採用する
+            if task_id not in self.results:
+                self.results[task_id] = result
+            if self.leases.get(task_id) == worker_id:
+                del self.leases[task_id]
+            if task_id in self.pending:
+                self.pending.remove(task_id)
+        return {}
+
+    def reap(self, timeout):
+        # ハートビートが timeout 秒以上ないワーカーのセルを再配布する
+        now = time.monotonic()
+        with self.lock:
+            lost = {w for w, t in self.last_seen.items() if now - t > timeout}
+            for task_id, worker_id in list(self.leases.items()):
+                if worker_id in lost:
+                    logger.warning(f'worker {worker_id} lost. requeue task {task_id}')
+                    del self.leases[task_id]
+                    self.pending.appendleft(task_id)
+            for worker_id in lost:
+                del self.last_seen[worker_id]
+
+    def finished(self):
+        with self.lock:
+            return len(self.results) == len(self.cells)
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # 1行1メッセージのJSONプロトコル
+    #   {"key": ..., "op": "get" | "heartbeat" | "put" | "datasets", "worker": ..., ...}
+
+    def handle(self):
+        board = self.server.board
+        for line in self.rfile:
+            try:
+                msg = json.loads(line)
+                if not hmac.compare_digest(str(msg.get('key', '')), self.server.authkey):
+                    reply = {'error': 'unauthorized'}
+                elif msg['op'] == 'get':
+                    reply = board.get(msg['worker'])
+                elif msg['op'] == 'heartbeat':
+                    reply = board.heartbeat(msg['worker'])
+                elif msg['op'] == 'put':
+                    reply = board.put(msg['worker'], msg['task'], msg['result'])
+                elif msg['op'] == 'datasets':
+                    reply = {'datasets': board.datasets()}
+                else:
+                    reply = {'error': f'unknown op: {msg["op"]}'}
+            except Exception as e:
+                reply = {'error': str(e)}
+            self.wfile.write(json.dumps(reply).encode() + b'\n')
+            self.wfile.flush()
+            if reply.get('error') == 'unauthorized':
+                return
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class SweepCoordinator:
+    # セルをTCPでワーカーに配り、結果を集める
+    # address のポートに0を指定すると空いているポートを使う（.address で確認できる）
+
+    def __init__(self, cells, address=('127.0.0.1', 0), authkey='', heartbeat_timeout=30.0):
+        self.board = TaskBoard(cells)
+        self.heartbeat_timeout = heartbeat_timeout
+        self.server = _Server(address, _Handler)
+        self.server.board = self.board
+        self.server.authkey = authkey
+        self.address = self.server.server_address
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        logger.info(f'sweep coordinator listening on {self.address[0]}:{self.address[1]} '
+                    f'({len(self.board.cells)} cells)')
+        return self
+
+    def wait(self, timeout=None, poll=0.5):
+        # 全セルの結果が揃うまで待ち、セル順の結果リストを返す
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self.board.finished():
+            if deadline is not None and time.monotonic() > deadline:
+                raise TimeoutError('sweep did not finish in time')
+            self.board.reap(self.heartbeat_timeout)
+            time.sleep(poll)
+        return [self.board.results[i] for i in range(len(self.board.cells))]
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+# --- ワーカー ---
+
+class _Connection:
+
+    def __init__(self, address, authkey, timeout=30.0):
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.file = self.sock.makefile('rwb')
+        self.authkey = authkey
+
+    def call(self, op, **kwargs):
+        msg = dict(kwargs, op=op, key=self.authkey)
+        self.file.write(json.dumps(msg).encode() + b'\n')
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ConnectionError('coordinator closed the connection')
+        reply = json.loads(line)
+        if 'error' in reply:
+            raise RuntimeError(f'coordinator error: {reply["error"]}')
+        return reply
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+
+class SweepWorker:
+    # コーディネータからセルを受け取り、バックテストを実行して結果を返す
+    # datasets: {(シンボル, 足の間隔): ローソク足} 。同じノードのワーカー間で共有する
+    # band_tables: {(シンボル, 足の間隔): SparseTable} 。無ければ最初に使うときに作る
+
+    def __init__(self, address, authkey='', cache_dir='docs/artifacts/data',
+                 datasets=None, worker_id=None, heartbeat_interval=5.0, poll=0.5,
+                 band_tables=None):
+        self.address = tuple(address)
+        self.authkey = authkey
+        self.cache_dir = cache_dir
+        self.datasets = datasets if datasets is not None else {}
+        self.band_tables = band_tables if band_tables is not None else {}
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        self.heartbeat_interval = heartbeat_interval
+        self.poll = poll
+        self._stop = threading.Event()
+
+    def candles(self, cell):
+        key = cell_dataset(cell)
+        if key not in self.datasets:
+            self.datasets[key] = load_packed(key[0], key[1], cell['start_ms'], self.cache_dir)
+        return self.datasets[key]
+
+    def band_table(self, cell):
+        key = cell_dataset(cell)
+        if key not in self.band_tables:
+            self.band_tables[key] = SparseTable.from_candles(self.candles(cell))
+        return self.band_tables[key]
+
+    def _heartbeat_loop(self):
+        try:
+            conn = _Connection(self.address, self.authkey)
+        except OSError as e:
+            logger.warning(f'[{self.worker_id}] heartbeat connection failed: {e}')
+            return
+        try:
+            while not self._stop.wait(self.heartbeat_interval):
+                conn.call('heartbeat', worker=self.worker_id)
+        except (OSError, ConnectionError, RuntimeError) as e:
+            logger.debug(f'[{self.worker_id}] heartbeat stopped: {e}')
+        finally:
+            conn.close()
+
+    def run(self):
+        # 全セルが終わるまでセルの取得と実行を繰り返す。処理したセル数を返す
+        conn = _Connection(self.address, self.authkey)
+        heartbeat = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        heartbeat.start()
+        count = 0
+        try:
+            while not self._stop.is_set():
+                reply = conn.call('get', worker=self.worker_id)
+                if reply.get('done'):
+                    break
+                if reply.get('wait'):
+                    time.sleep(self.poll)
+                    continue
+                cell = reply['cell']
+                logger.info(f'[{self.worker_id}] run task {reply["task"]}: '
+                            f'{cell["product"]} {cell["interval"]} {cell["params"]}')
+                try:
+                    result = run_cell(cell, self.candles(cell), self.band_table(cell))
+                except Exception as e:
+                    logger.warning(f'[{self.worker_id}] task {reply["task"]} failed: {e}')
+                    result = {'error': str(e)}
+                conn.call('put', worker=self.worker_id, task=reply['task'], result=result)
+                count += 1
+        finally:
+            self._stop.set()
+            conn.close()
+        return count
+
+    def stop(self):
+        self._stop.set()
+
+
+def _worker_process(address, authkey, cache_dir, paths, heartbeat_interval, band_tables):
+    from .candles import PackedCandles
+    datasets = {key: PackedCandles.open(path) for key, path in paths.items()}
+    SweepWorker(address, authkey, cache_dir=cache_dir, datasets=datasets,
+                heartbeat_interval=heartbeat_interval, band_tables=band_tables).run()
+
+
+def run_node(address, authkey='', workers=None, cache_dir='docs/artifacts/data',
+             start_ms=DEFAULT_START_MS, heartbeat_interval=5.0):
+    # 1台のマシンで複数のワーカープロセスを起動する
+    # スイープが使うデータセットは先にパック形式で用意し、全ワーカーが同じファイルをmmapする
+    # （ノード内でローソク足のデータは1つだけになる）
+    workers = workers or os.cpu_count() or 1
+    conn = _Connection(address, authkey)
+    try:
+        datasets = [tuple(d) for d in conn.call('datasets')['datasets']]
+    finally:
+        conn.close()
+    paths = {}
+    band_tables = {}
+    for symbol, interval in datasets:
+        candles = load_packed(symbol, interval, start_ms, cache_dir)
+        paths[(symbol, interval)] = os.path.join(cache_dir, f'{symbol}_{interval}.f64')
+        # ブレイクアウト帯の索引は起動前に1回だけ作り、fork したワーカーが読み取り専用で共有する
+        band_tables[(symbol, interval)] = SparseTable.from_candles(candles)
+    logger.info(f'start {workers} sweep workers ({len(paths)} shared datasets)')
+
+    processes = [multiprocessing.Process(target=_worker_process,
+                                         args=(tuple(address), authkey, cache_dir, paths,
+                                               heartbeat_interval, band_tables))
+                 for _ in range(workers)]
+    for p in processes:
+        p.start()
+    for p in processes:
+        p.join()
+    return [p.exitcode for p in processes]
@@ -1,9 +1,15 @@
+import contextvars
 import json
 import uuid
-from logging import getLogger, StreamHandler, DEBUG, Formatter
+from logging import getLogger, StreamHandler, DEBUG, Formatter, Filter
 
 
 transaction_id = uuid.uuid4().hex
+# トランザクションIDはコンテキストごとに持つ（asyncio のタスクごと。asyncio.to_thread で
+# 実行するスレッドにも引き継がれる）。エンジンが並行して動いてもログのIDが混ざらない
+_transaction_id = contextvars.ContextVar('transaction_id', default=transaction_id)
+LOG_FORMAT = '{"timestamp": "%(asctime)-15s", "transaction-id": "%(transaction_id)s", ' \
+             '"level": "%(levelname)s", "message": %(message)s}'
 handler = StreamHandler()
 logger = getLogger(__name__)
 
@@ -22,6 +28,17 @@ class JsonFormatter(Formatter):
         return super().format(record)
 
 
+class TransactionIdFilter(Filter):
+    # ログのレコードに、出力したコンテキストのトランザクションIDを付ける
+
+    def filter(self, record):
+        record.transaction_id = _transaction_id.get()
+        return True
+
+
+transaction_id_filter = TransactionIdFilter()
+
+
 def anonymization(x):
     data = str(x)
     if len(data) < 1:
@@ -34,25 +51,32 @@ def anonymization(x):
         return data[0] + data[1] + '*'*(len(data)-3) + data[-1]
 
 
+def set_config_path(config, dotted, value):
+    # ドット区切りのキー（例: 'risk.max-leverage'）で入れ子の設定に値を入れる
+    node = config
+    parts = dotted.split('.')
+    for part in parts[:-1]:
+        node = node.setdefault(part, {})
+    node[parts[-1]] = value
+
+
 def update_transaction_id():
-    transaction_id = uuid.uuid4().hex
-    set_transaction_id(transaction_id)
+    set_transaction_id(uuid.uuid4().hex)
 
 
 def set_transaction_id(new_transaction_id):
-    transaction_id = new_transaction_id
-    formatter = JsonFormatter('{"timestamp": "%(asctime)-15s", "transaction-id": ' + f'"{transaction_id}"' + ', "level": "%(levelname)s", "message": %(message)s}')
-    handler.setFormatter(formatter)
+    # 現在のコンテキスト（タスク・スレッド）のトランザクションIDだけを変える
+    _transaction_id.set(new_transaction_id)
 
 
 def get_transaction_id():
-    return transaction_id
+    return _transaction_id.get()
 
 
 def get_module_logger():
-    formatter = JsonFormatter('{"timestamp": "%(asctime)-15s", "transaction-id": ' + f'"{transaction_id}"' + ', "level": "%(levelname)s", "message": %(message)s}')
     handler.setLevel(DEBUG)
-    handler.setFormatter(formatter)
+    handler.setFormatter(JsonFormatter(LOG_FORMAT))
+    handler.addFilter(transaction_id_filter)
     logger.setLevel(DEBUG)
     logger.addHandler(handler)
     logger.propagate = False
@@ -0,0 +1,56 @@
+import argparse
+import json
+import logging
+
+
+from lib import get_module_logger
+from lib.history import INTERVAL_SECONDS, fetch_binance_symbols
+from lib.screener import screen_universe
+
+
+logger = get_module_logger()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Trend Screener')
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument('--symbols', help='comma separated symbols (e.g. BTCUSDT,ETHUSDT)')
+    group.add_argument('--symbols-file', help='file with one symbol per line')
+    group.add_argument('--quote', help='screen every trading symbol quoted in this asset (e.g. USDT)')
+    parser.add_argument('--interval', choices=list(INTERVAL_SECONDS), default='4h')
+    parser.add_argument('--cache-dir', default='docs/artifacts/screen')
+    parser.add_argument('--config', help='trading config json file (optional)')
+    parser.add_argument('--workers', type=int, default=16, help='concurrent downloads')
+    parser.add_argument('--top', type=int, default=50, help='number of rows to print')
+    parser.add_argument('--refresh', action='store_true', help='ignore cached candles')
+    parser.add_argument('-v', '--verbosity', action='store_true')
+    args = parser.parse_args()
+
+    if not args.verbosity:
+        logger.setLevel(logging.INFO)
+
+    strategy_config = None
+    if args.config:
+        with open(args.config) as f:
+            strategy_config = (json.load(f).get('trading') or {}).get('strategy')
+
+    if args.symbols:
+        symbols = [s.strip().upper() for s in args.symbols.split(',') if s.strip()]
+    elif args.symbols_file:
+        with open(args.symbols_file) as f:
+            symbols = [line.strip().upper() for line in f if line.strip()]
+    else:
+        symbols = fetch_binance_symbols(args.quote.upper())
+    logger.info(f'screening {len(symbols)} symbols on {args.interval}')
+
+    rows = screen_universe(symbols, args.interval, args.cache_dir, strategy_config,
+                           workers=args.workers, refresh=args.refresh)
+    print(f'{"rank":>4} {"symbol":<14} {"price":>14} {"trend":>5} {"strength":>8} '
+          f'{"breakout":>8} confirmed')
+    for i, r in enumerate(rows[:args.top], 1):
+        print(f'{i:>4} {r.symbol:<14} {r.price:>14.6g} {r.trend:>+5d} {r.strength:>8.3f} '
+              f'{r.breakout:>+8d} {"yes" if r.confirmed else "no"}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,17 @@
+import csv
 import math
+import os
 import random
+import tempfile
 import unittest
+from unittest import mock
 
 
-from fxtrade.lib.candles import Candle
+from fxtrade.lib.candles import Candle, candles_to_csv, iter_candles_from_csv, iter_chunks
 from fxtrade.lib.exchange import PRODUCT_BTC_FX, PRODUCT_ETH_SPOT
-from fxtrade.lib.backtest import SimulatedExchange, run_backtest
+from fxtrade.lib.engine import TradingEngine
+from fxtrade.lib.backtest import SimulatedExchange, run_backtest, run_backtest_streaming, \
+    run_backtest_segmented, SubBarExchange
 
 
 def make_candles(closes, bar_seconds=3600):
@@ -147,5 +153,183 @@ class TestBacktest(unittest.TestCase):
         self.assertGreaterEqual(result.final_equity, 0)
 
 
+class TestSkipQuiescent(unittest.TestCase):
+
+    CONFIG = {'strategy': {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}}
+
+    def assert_identical(self, spec, closes):
+        candles = make_candles(closes)
+        expected = run_backtest(spec, candles, 500000, config=self.CONFIG)
+        result = run_backtest(spec, candles, 500000, config=self.CONFIG, skip_quiescent=True)
+        self.assertEqual(result.equity_curve, expected.equity_curve)
+        self.assertEqual(result.final_equity, expected.final_equity)
+        self.assertEqual(result.max_drawdown, expected.max_drawdown)
+        self.assertEqual(result.trade_count, expected.trade_count)
+        self.assertEqual(result.swap_paid, expected.swap_paid)
+
+    def test_identical_to_per_bar_loop(self):
+        # 読み飛ばしても1本ずつ実行した場合と結果が完全に一致する
+        self.assert_identical(PRODUCT_BTC_FX, trending_market())
+        self.assert_identical(PRODUCT_ETH_SPOT, trending_market(seed=3))
+        random.seed(11)
+        choppy = [1000000.0]
+        for _ in range(600):
+            choppy.append(choppy[-1] * random.choice([0.97, 0.99, 1.0, 1.01, 1.03]))
+        self.assert_identical(PRODUCT_BTC_FX, choppy)
+
+    def test_skips_engine_steps(self):
+        candles = make_candles([1000000.0, 1001000.0] * 300)
+        with mock.patch.object(TradingEngine, 'step', autospec=True,
+                               side_effect=TradingEngine.step) as step:
+            result = run_backtest(PRODUCT_BTC_FX, candles, 500000, config=self.CONFIG,
+                                  skip_quiescent=True)
+        # レンジ相場ではエンジンがほとんど呼ばれない
+        self.assertLess(step.call_count, len(result.equity_curve) // 10)
+        self.assertEqual(len(result.equity_curve), len(candles) - 32)
+
+
+class TestStreamingBacktest(unittest.TestCase):
+
+    CONFIG = {'strategy': {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}}
+
+    def test_matches_in_memory_backtest(self):
+        # チャンクの境界をまたいでも、メモリ上のバックテストと結果が一致する
+        candles = make_candles(trending_market())
+        expected = run_backtest(PRODUCT_BTC_FX, candles, 500000, config=self.CONFIG)
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'candles.csv')
+            equity_path = os.path.join(d, 'equity.csv')
+            trades_path = os.path.join(d, 'trades.csv')
+            candles_to_csv(candles, path)
+            result = run_backtest_streaming(
+                PRODUCT_BTC_FX, iter_chunks(iter_candles_from_csv(path), 37), 500000,
+                config=self.CONFIG, equity_path=equity_path, trades_path=trades_path)
+            with open(equity_path) as f:
+                curve = [(int(r['time']), float(r['equity'])) for r in csv.DictReader(f)]
+            with open(trades_path) as f:
+                trades = list(csv.DictReader(f))
+        self.assertEqual(result.final_equity, expected.final_equity)
+        self.assertEqual(result.max_drawdown, expected.max_drawdown)
+        self.assertEqual(result.swap_paid, expected.swap_paid)
+        self.assertAlmostEqual(result.years, expected.years)
+        self.assertEqual(curve, expected.equity_curve)
+        self.assertEqual(len(trades), expected.trade_count)
+
+    def test_not_enough_candles(self):
+        candles = make_candles([100.0] * 10)
+        result = run_backtest_streaming(PRODUCT_BTC_FX, iter_chunks(candles, 4), 500000,
+                                        config=self.CONFIG)
+        self.assertEqual(result.final_equity, 500000)
+        self.assertEqual(result.trade_count, 0)
+
+
+class TestSegmentedBacktest(unittest.TestCase):
+
+    CONFIG = {'strategy': {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}}
+
+    def assert_identical(self, spec, candles, **kwargs):
+        expected = run_backtest(spec, candles, 500000, config=self.CONFIG)
+        result = run_backtest_segmented(spec, candles, 500000, config=self.CONFIG, **kwargs)
+        self.assertEqual(result.equity_curve, expected.equity_curve)
+        self.assertEqual(result.final_equity, expected.final_equity)
+        self.assertEqual(result.trade_count, expected.trade_count)
+        self.assertEqual(result.swap_paid, expected.swap_paid)
+        self.assertEqual(result.years, expected.years)
+
+    def test_identical_to_serial_run(self):
+        # 区間の境界でポジションを持っていても（記録と状態が食い違っても）結果は一致する
+        candles = make_candles(trending_market(1200))
+        self.assert_identical(PRODUCT_BTC_FX, candles, segments=5, workers=1)
+        self.assert_identical(PRODUCT_ETH_SPOT, candles, segments=3, workers=1)
+
+    def test_parallel_segments(self):
+        self.assert_identical(PRODUCT_BTC_FX, make_candles(trending_market(900)),
+                              segments=3, workers=2)
+
+    def test_short_history(self):
+        self.assert_identical(PRODUCT_BTC_FX, make_candles(trending_market(40)), segments=4)
+
+
+def aggregate(fine, n):
+    # 細かい足を n 本ずつまとめて粗い足にする
+    return [Candle(time=chunk[0].time, open=chunk[0].open,
+                   high=max(c.high for c in chunk), low=min(c.low for c in chunk),
+                   close=chunk[-1].close, volume=sum(c.volume for c in chunk))
+            for chunk in (fine[k:k + n] for k in range(0, len(fine) - n + 1, n))]
+
+
+class CountingCandles:
+    # 参照された細かい足の本数を数える
+
+    def __init__(self, candles):
+        self.candles = candles
+        self.touched = set()
+
+    def __len__(self):
+        return len(self.candles)
+
+    def __getitem__(self, index):
+        self.touched.add(index)
+        return self.candles[index]
+
+
+class TestSubBarExecution(unittest.TestCase):
+
+    CONFIG = {'strategy': {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}}
+
+    def test_stop_fills_inside_the_bar(self):
+        fine = make_candles([100.0] * 30 + [99.0, 97.0, 90.0] + [95.0] * 27, bar_seconds=60)
+        coarse = aggregate(fine, 30)
+        sim = SubBarExchange(PRODUCT_BTC_FX, coarse, fine, 1000000, slippage=0.0,
+                             swap_rate_daily=0.0)
+        fills = []
+        sim.on_fill = lambda index, side, size, price, fee: fills.append((side, price))
+        sim.market_order(PRODUCT_BTC_FX, 'BUY', 1.0)
+        sim.advance(1)
+        self.assertFalse(sim.check_stop(PRODUCT_BTC_FX, -1, 98.0))  # 方向が違う
+        self.assertTrue(sim.check_stop(PRODUCT_BTC_FX, 1, 98.0))
+        # 99 → 97 は窓を開けて水準を跨いだので、その足の始値で約定する
+        self.assertEqual(fills, [('BUY', 100.0), ('SELL', 97.0)])
+        self.assertEqual(sim.get_position(PRODUCT_BTC_FX), 0.0)
+        self.assertAlmostEqual(sim.account.cash, 1000000 - 3.0)
+        self.assertEqual(sim.fine_lookups, 1)
+
+    def test_swap_is_prorated_to_the_stop_fill(self):
+        # 30分足の途中（1分目）でストップが約定したら、その足のスワップは1分ぶんだけ
+        fine = make_candles([100.0] * 30 + [99.0, 97.0, 90.0] + [95.0] * 27, bar_seconds=60)
+        coarse = aggregate(fine, 30)
+        sim = SubBarExchange(PRODUCT_BTC_FX, coarse, fine, 1000000, slippage=0.0,
+                             swap_rate_daily=0.0004)
+        sim.market_order(PRODUCT_BTC_FX, 'BUY', 1.0)
+        sim.advance(1)
+        notional = coarse[1].close
+        self.assertAlmostEqual(sim.account.swap_paid, notional * 0.0004 * 1800 / 86400)
+        self.assertTrue(sim.check_stop(PRODUCT_BTC_FX, 1, 98.0))
+        self.assertAlmostEqual(sim.account.swap_paid, notional * 0.0004 * 60 / 86400)
+        self.assertAlmostEqual(sim.account.cash, 1000000 - 3.0 - sim.account.swap_paid)
+
+    def test_touches_fine_data_only_on_crossed_bars(self):
+        random.seed(5)
+        prices = [1000000.0]
+        for i in range(600 * 60 - 1):
+            drift = 0.00005 if (i // (150 * 60)) % 2 == 0 else -0.00005
+            prices.append(prices[-1] * (1 + drift + random.gauss(0, 0.0006)))
+        fine = make_candles(prices, bar_seconds=60)
+        coarse = aggregate(fine, 60)
+        counting = CountingCandles(fine)
+        result = run_backtest(PRODUCT_BTC_FX, coarse, 500000, config=self.CONFIG,
+                              fine_candles=counting)
+        baseline = run_backtest(PRODUCT_BTC_FX, coarse, 500000, config=self.CONFIG)
+        self.assertGreater(result.trade_count, 0)
+        self.assertNotEqual(result.final_equity, baseline.final_equity)
+        self.assertLess(len(counting.touched), len(fine) // 10)
+
+    def test_rejects_tape_recording(self):
+        candles = make_candles(trending_market(100))
+        with self.assertRaises(ValueError):
+            run_backtest(PRODUCT_BTC_FX, candles, 500000, fine_candles=candles,
+                         record_tape=True)
+
+
 if __name__ == '__main__':
     unittest.main()
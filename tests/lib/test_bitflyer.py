@@ -1,8 +1,11 @@
+import threading
+import time
 import unittest
+from collections import Counter
 
 
 from fxtrade.lib.market.bitflyer import BitFlyerExchange
-from fxtrade.lib.exchange import PRODUCT_ETH_SPOT, PRODUCT_BTC_FX
+from fxtrade.lib.exchange import PRODUCT_ETH_SPOT, PRODUCT_BTC_FX, SnapshotCache
 
 
 class FakeBitFlyerExchange(BitFlyerExchange):
@@ -89,5 +92,101 @@ class TestSpotReserves(unittest.TestCase):
         self.assertAlmostEqual(ex.get_position(PRODUCT_BTC_FX), 0.05)
 
 
+class CountingBitFlyerExchange(FakeBitFlyerExchange):
+    # APIの呼び出し回数を数えるスタブ（ティッカーも含める）
+
+    def __init__(self, config, balances):
+        super().__init__(config, balances=balances)
+        self.calls = Counter()
+
+    def _private_request(self, method, path, body=None):
+        self.calls[path.split('?')[0]] += 1
+        if 'getcollateral' in path:
+            return {'collateral': 100000.0, 'open_position_pnl': 0.0}
+        if 'getpositions' in path:
+            return []
+        return super()._private_request(method, path, body)
+
+    def _public_request(self, path):
+        self.calls[path.split('?')[0]] += 1
+        return {'ltp': self.price}
+
+    get_price = BitFlyerExchange.get_price
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def test_one_fetch_per_cycle(self):
+        # 1サイクル（ポジション・評価額・売りのクランプ）で残高とティッカーは1回ずつ
+        ex = CountingBitFlyerExchange(config_with_reserve(0.5), TestSpotReserves.BALANCES)
+        ex.is_dryrun = False
+        ex.get_price(PRODUCT_ETH_SPOT)
+        ex.get_position(PRODUCT_ETH_SPOT)
+        ex.get_equity(PRODUCT_ETH_SPOT)
+        ex.market_order(PRODUCT_ETH_SPOT, 'SELL', 0.1875)
+        self.assertEqual(ex.calls['/v1/me/getbalance'], 1)
+        self.assertEqual(ex.calls['/v1/getticker'], 1)
+        # 発注後は口座情報だけを取り直す
+        ex.get_equity(PRODUCT_ETH_SPOT)
+        self.assertEqual(ex.calls['/v1/me/getbalance'], 2)
+        self.assertEqual(ex.calls['/v1/getticker'], 1)
+
+    def test_shared_across_products(self):
+        # 同じ口座の証拠金は銘柄をまたいで共有し、建玉は銘柄ごとに取得する
+        ex = CountingBitFlyerExchange({'key': 'k', 'secret': 's'}, TestSpotReserves.BALANCES)
+        for _ in range(3):
+            ex.get_equity(PRODUCT_BTC_FX)
+            ex.get_position(PRODUCT_BTC_FX)
+            ex.get_position(PRODUCT_ETH_SPOT)
+        self.assertEqual(ex.calls['/v1/me/getcollateral'], 1)
+        self.assertEqual(ex.calls['/v1/me/getpositions'], 1)
+        self.assertEqual(ex.calls['/v1/me/getbalance'], 1)
+
+    def test_ttl_and_invalidate(self):
+        now = [0.0]
+        cache = SnapshotCache(ttl=5.0, clock=lambda: now[0])
+        values = iter(range(100))
+        fetch = lambda: next(values)
+        self.assertEqual(cache.get('a', fetch), 0)
+        now[0] = 4.9
+        self.assertEqual(cache.get('a', fetch), 0)
+        now[0] = 5.0
+        self.assertEqual(cache.get('a', fetch), 1)
+        cache.get('ticker', fetch)
+        cache.invalidate(keep=lambda key: key == 'ticker')
+        self.assertEqual(cache.get('a', fetch), 3)
+        self.assertEqual(cache.get('ticker', fetch), 2)
+        self.assertEqual(SnapshotCache(ttl=0).get('a', fetch), 4)
+
+    def test_concurrent_reads_fetch_once(self):
+        cache = SnapshotCache(ttl=5.0)
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            time.sleep(0.05)
+            return 'balance'
+
+        threads = [threading.Thread(target=cache.get, args=('balance', fetch))
+                   for _ in range(8)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(cache.stats()['hits'], 7)
+
+    def test_fetch_racing_an_order_is_not_kept(self):
+        # 取得中に発注（invalidate）されたら、その結果は保持しない
+        cache = SnapshotCache(ttl=5.0)
+
+        def fetch():
+            cache.invalidate()
+            return 'before order'
+
+        self.assertEqual(cache.get('balance', fetch), 'before order')
+        self.assertEqual(cache.get('balance', lambda: 'after order'), 'after order')
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,142 @@
+import unittest
+
+
+from fxtrade.lib.engine import TradingEngine
+from fxtrade.lib.exchange import PRODUCT_BTC_FX
+from fxtrade.lib.feed import CandleFeed, MAX_KLINES, scale_candles
+from tests.lib.test_engine import FakeExchange, make_candles
+
+
+class FakeKlines:
+    # Binanceの代わり。now 本目までが確定足で、now 本目が未確定足
+
+    def __init__(self, candles, now):
+        self.candles = candles
+        self.now = now
+        self.calls = []
+
+    def __call__(self, symbol, interval, limit=500, start_ms=None):
+        visible = self.candles[:self.now + 1]
+        if start_ms is not None:
+            visible = [c for c in visible if c.time * 1000 >= start_ms]
+            rows = visible[:limit]
+        else:
+            rows = visible[-limit:]
+        self.calls.append((limit, start_ms, len(rows)))
+        return rows
+
+
+class TestCandleFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.candles = make_candles([100.0 + i for i in range(3000)])
+        self.klines = FakeKlines(self.candles, now=500)
+        self.feed = CandleFeed('BTCUSDT', '1h', 200, fetch=self.klines, min_refresh=0)
+
+    def test_fetches_only_new_candles(self):
+        self.assertEqual(self.feed.update(), 200)
+        self.assertEqual(list(self.feed.candles), self.candles[300:500])
+        # 新しい足が確定していなければ未確定足1本だけを受け取る
+        self.assertEqual(self.feed.update(), 0)
+        self.assertEqual(self.klines.calls[-1][2], 1)
+        self.klines.now = 502
+        self.assertEqual(self.feed.update(), 2)
+        self.assertEqual(list(self.feed.candles), self.candles[302:502])
+        self.assertEqual(self.klines.calls[-1][2], 3)
+
+    def test_reload_after_long_gap(self):
+        self.feed.update()
+        self.klines.now = 500 + MAX_KLINES + 10
+        self.feed.update()
+        self.assertEqual(list(self.feed.candles), self.candles[self.klines.now - 200:self.klines.now])
+
+    def test_min_refresh(self):
+        now = [0.0]
+        feed = CandleFeed('BTCUSDT', '1h', 200, fetch=self.klines, min_refresh=1.0,
+                          clock=lambda: now[0])
+        feed.update()
+        feed.update()
+        self.assertEqual(feed.requests, 1)
+        now[0] = 1.0
+        feed.update()
+        self.assertEqual(feed.requests, 2)
+
+    def test_scale_candles(self):
+        scaled = scale_candles(self.candles[:3], 204.0)
+        self.assertAlmostEqual(scaled[-1].close, 204.0)
+        self.assertAlmostEqual(scaled[0].close, 200.0)
+
+
+class FeedExchange(FakeExchange):
+    # 確定足の時刻を返せる取引所
+
+    def __init__(self, candles):
+        super().__init__(candles)
+        self.candle_calls = 0
+        self.price = candles[-1].close
+
+    def latest_candle_time(self, spec):
+        return self.candles[-1].time
+
+    def get_candles(self, spec, limit):
+        self.candle_calls += 1
+        return super().get_candles(spec, limit)
+
+    def get_price(self, spec):
+        return self.price
+
+
+class TestSkipWithoutNewBar(unittest.TestCase):
+
+    CONFIG = {'strategy': {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}}
+
+    def setUp(self):
+        self.candles = make_candles([100000.0 + i * 1000 for i in range(300)])
+        self.exchange = FeedExchange(self.candles[:200])
+        self.engine = TradingEngine(self.exchange, PRODUCT_BTC_FX, config=self.CONFIG)
+
+    def test_evaluates_once_per_bar(self):
+        traded, signal = self.engine.step()
+        self.assertTrue(traded)
+        self.exchange.position = self.exchange.orders[0][1]
+        for _ in range(5):
+            self.assertEqual(self.engine.step(), (False, None))
+        self.assertEqual(self.exchange.candle_calls, 1)
+        self.exchange.candles = self.candles[:201]
+        self.engine.step()
+        self.assertEqual(self.exchange.candle_calls, 2)
+
+    def test_failed_order_is_retried_in_the_same_bar(self):
+        self.exchange.order_result = -1
+        self.assertFalse(self.engine.step()[0])
+        self.assertEqual(len(self.exchange.orders), 1)
+        # 同じ足のままでも評価し直して再発注する
+        self.assertFalse(self.engine.step()[0])
+        self.assertEqual(len(self.exchange.orders), 2)
+        self.exchange.order_result = 1
+        traded, signal = self.engine.step()
+        self.assertTrue(traded)
+        self.assertEqual(self.exchange.orders[-1], self.exchange.orders[0])
+        # 発注できたら、この足の間は評価を省く
+        self.exchange.position = self.exchange.orders[-1][1]
+        self.assertEqual(self.engine.step(), (False, None))
+        self.assertEqual(self.exchange.candle_calls, 3)
+
+    def test_stop_checked_inside_the_bar(self):
+        self.engine.step()
+        size = self.exchange.orders[0][1]
+        self.exchange.position = size
+        stop = self.engine.last_signal.stop_price
+        self.exchange.price = stop * 1.001
+        self.assertFalse(self.engine.step()[0])
+        self.exchange.price = stop * 0.999
+        traded, signal = self.engine.step()
+        self.assertTrue(traded)
+        self.assertEqual(self.exchange.orders[-1], ('SELL', size))
+        self.assertEqual(signal.direction, 0)
+        self.assertEqual(self.engine.position_state.direction, 0)
+        self.assertEqual(self.exchange.candle_calls, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
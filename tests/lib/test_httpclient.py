@@ -0,0 +1,167 @@
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import unittest
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+
+from fxtrade.lib.httpclient import HttpPool, HttpError
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    # keep-alive に対応した取引所APIの代わり
+    protocol_version = 'HTTP/1.1'
+    # ヘッダーと本文を別々に書くので、Nagleで応答が遅れないようにする
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path.startswith('/missing'):
+            self._reply(404, {'error': 'not found'})
+        elif self.path.startswith('/close'):
+            # 応答後に接続を閉じるサーバーを模擬する
+            self.close_connection = True
+            self._reply(200, {'ltp': 1.0}, close=True)
+        else:
+            self._reply(200, {'ltp': 300000.0, 'path': self.path})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        body = json.loads(self.rfile.read(length))
+        self._reply(200, {'echo': body, 'key': self.headers.get('ACCESS-KEY')})
+
+    def _reply(self, status, obj, close=False):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if close:
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, context=None):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.paths = []
+        self.connections = 0
+        if context is not None:
+            self.socket = context.wrap_socket(self.socket, server_side=True)
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def process_request(self, request, client_address):
+        self.connections += 1
+        super().process_request(request, client_address)
+
+    def url(self, scheme='http'):
+        return f'{scheme}://127.0.0.1:{self.server_address[1]}'
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+class TestHttpPool(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.pool = HttpPool(max_per_host=2, timeout=5)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    def test_keep_alive_reuses_connection(self):
+        for i in range(10):
+            self.assertEqual(self.pool.get_json(f'{self.server.url()}/ticker?i={i}')['path'],
+                             f'/ticker?i={i}')
+        reply = self.pool.request_json('POST', self.server.url() + '/order', body=b'{"a": 1}',
+                                       headers={'ACCESS-KEY': 'k'})
+        self.assertEqual(reply, {'echo': {'a': 1}, 'key': 'k'})
+        self.assertEqual(self.server.connections, 1)
+        stats = self.pool.stats()[self.server.url()]
+        self.assertEqual((stats['requests'], stats['connects'], stats['errors']), (11, 1, 0))
+        self.assertIn('p95_ms', stats)
+
+    def test_error_status_and_connection_close(self):
+        with self.assertRaises(HttpError) as cm:
+            self.pool.get_json(self.server.url() + '/missing')
+        self.assertEqual(cm.exception.status, 404)
+        # 4xxでも接続は使い回せる
+        self.pool.get_json(self.server.url() + '/ticker')
+        self.assertEqual(self.server.connections, 1)
+        # Connection: close の応答のあとは新しく接続する
+        self.pool.get_json(self.server.url() + '/close')
+        self.pool.get_json(self.server.url() + '/ticker')
+        self.assertEqual(self.server.connections, 2)
+
+    def test_stale_connection_is_retried_for_get(self):
+        self.pool.get_json(self.server.url() + '/ticker')
+        # サーバー側で接続が閉じられた状態にする
+        for pool in self.pool.hosts.values():
+            for conn, _ in pool.idle:
+                conn.sock.shutdown(2)
+        self.assertEqual(self.pool.get_json(self.server.url() + '/ticker')['ltp'], 300000.0)
+        stats = self.pool.stats()[self.server.url()]
+        self.assertEqual((stats['connects'], stats['errors']), (2, 0))
+
+    def test_pool_is_bounded(self):
+        errors = []
+
+        def fetch():
+            try:
+                for _ in range(5):
+                    self.pool.get_json(self.server.url() + '/ticker')
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=fetch) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertLessEqual(self.server.connections, 2)
+        self.assertEqual(len(self.server.paths), 30)
+
+
+@unittest.skipUnless(shutil.which('openssl'), 'openssl is required to make a test certificate')
+class TestHttpsPool(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        cert = os.path.join(self.tmp.name, 'cert.pem')
+        key = os.path.join(self.tmp.name, 'key.pem')
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                        '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=127.0.0.1',
+                        '-addext', 'subjectAltName=IP:127.0.0.1'],
+                       check=True, capture_output=True)
+        server_context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        server_context.load_cert_chain(cert, key)
+        self.server = StandInServer(server_context)
+        self.pool = HttpPool(timeout=5, context=ssl.create_default_context(cafile=cert))
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+        self.tmp.cleanup()
+
+    def test_tls_handshake_once(self):
+        for _ in range(5):
+            self.assertEqual(self.pool.get_json(self.server.url('https') + '/ticker')['ltp'],
+                             300000.0)
+        self.assertEqual(self.server.connections, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
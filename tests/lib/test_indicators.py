@@ -1,8 +1,14 @@
+import math
+import random
+import statistics
 import unittest
 
 
 from fxtrade.lib.candles import Candle
-from fxtrade.lib.indicators import ema, sma, atr, realized_volatility, donchian
+from fxtrade.lib.indicators import ema, sma, atr, realized_volatility, donchian, \
+    ema_many, prior_bands, IndicatorBank, EMA, ATR, RSI, ADX, Keltner, rsi, \
+    bollinger_width, keltner, adx, zscore, SparseTable, IndexableSkiplist, rolling_median, \
+    rolling_quantile, median_true_range, quantile_bands, true_ranges
 
 
 def make_candles(closes):
@@ -69,5 +75,164 @@ class TestIndicators(unittest.TestCase):
         self.assertAlmostEqual(low_band, 95.0 * 0.99)
 
 
+class TestIndicatorBank(unittest.TestCase):
+
+    def setUp(self):
+        closes = [100.0 + (i * 7 % 13) - i * 0.3 for i in range(120)]
+        self.candles = make_candles(closes)
+        self.closes = closes
+
+    def test_ema_many_matches_ema(self):
+        result = ema_many(self.closes, [10, 20, 50, 20])
+        self.assertEqual(sorted(result), [10, 20, 50])
+        for span, series in result.items():
+            self.assertEqual(series, ema(self.closes, span))
+
+    def test_prior_bands_match_window(self):
+        bands = prior_bands(self.closes, [1, 5, 30, 200])
+        for span, (high, low) in bands.items():
+            window = self.closes[-(span + 1):-1]
+            self.assertEqual(high, max(window))
+            self.assertEqual(low, min(window))
+
+    def test_bank_shares_values(self):
+        bank = IndicatorBank(self.candles, ema_spans=(10, 50), atr_spans=(14,),
+                             band_spans=(20,))
+        self.assertEqual(bank.ema(10), ema(self.closes, 10))
+        self.assertEqual(bank.atr(14), atr(self.candles, 14))
+        self.assertIs(bank.ema(50), bank.ema(50))
+        # 事前に指定していない期間もその場で計算できる
+        self.assertEqual(bank.ema(30), ema(self.closes, 30))
+        self.assertEqual(bank.atr(7), atr(self.candles, 7))
+        self.assertEqual(bank.bands(40), (max(self.closes[-41:-1]), min(self.closes[-41:-1])))
+
+
+class TestStreamingIndicators(unittest.TestCase):
+
+    def setUp(self):
+        self.closes = [100.0 + (i * 7 % 13) + i * 0.5 for i in range(80)]
+        self.candles = make_candles(self.closes)
+
+    def test_ema_and_atr_match_batch(self):
+        e = EMA(10)
+        self.assertEqual([e.update(v) for v in self.closes], ema(self.closes, 10))
+        a = ATR(14)
+        self.assertEqual([a.update(c) for c in self.candles], atr(self.candles, 14))
+
+    def test_batch_equals_incremental(self):
+        # 一括計算と逐次計算は同じ実装なので値が一致する
+        ind = RSI(14)
+        self.assertEqual(rsi(self.closes), [ind.update(v) for v in self.closes])
+        ind = ADX(14)
+        self.assertEqual(adx(self.candles), [ind.update(c) for c in self.candles])
+
+    def test_rsi_bounds(self):
+        self.assertEqual(rsi([float(v) for v in range(30)])[-1], 100.0)
+        self.assertEqual(rsi([100.0] * 30)[-1], 50.0)
+        self.assertLess(rsi([float(v) for v in range(30, 0, -1)])[-1], 1.0)
+        for v in rsi(self.closes):
+            self.assertTrue(0.0 <= v <= 100.0)
+
+    def test_bollinger_width(self):
+        self.assertEqual(bollinger_width([100.0] * 30)[-1], 0.0)
+        wide = bollinger_width([100.0, 120.0] * 15)[-1]
+        narrow = bollinger_width([100.0, 101.0] * 15)[-1]
+        self.assertGreater(wide, narrow)
+        self.assertAlmostEqual(wide, 2 * 2.0 * 10.0 / 110.0)
+
+    def test_keltner(self):
+        middle, upper, lower = keltner(self.candles, 20, 2.0)[-1]
+        self.assertAlmostEqual(middle, ema(self.closes, 20)[-1])
+        self.assertAlmostEqual(upper - lower, 4.0 * atr(self.candles, 20)[-1])
+        self.assertEqual(Keltner(20).update(self.candles[0])[0], self.closes[0])
+
+    def test_adx_trend_vs_range(self):
+        trend = adx(make_candles([100.0 + i * 2 for i in range(100)]))[-1]
+        ranging = adx(make_candles([100.0, 103.0, 99.0, 102.0] * 25))[-1]
+        self.assertGreater(trend, 50.0)
+        self.assertLess(ranging, trend)
+
+    def test_zscore(self):
+        self.assertEqual(zscore([5.0] * 10)[-1], 0.0)
+        z = zscore([1.0, 2.0, 3.0, 4.0, 10.0], span=5)[-1]
+        self.assertAlmostEqual(z, (10.0 - 4.0) / math.sqrt((9 + 4 + 1 + 0 + 36) / 5))
+
+
+class TestSparseTable(unittest.TestCase):
+
+    def test_matches_brute_force(self):
+        rng = random.Random(3)
+        values = [rng.uniform(90, 110) for _ in range(300)]
+        table = SparseTable(values)
+        for _ in range(500):
+            lo = rng.randrange(0, 299)
+            hi = rng.randrange(lo + 1, 301)
+            self.assertEqual(table.query(lo, hi), (max(values[lo:hi]), min(values[lo:hi])))
+        with self.assertRaises(ValueError):
+            table.query(5, 5)
+
+    def test_prior_bands_match_window_computation(self):
+        # どの期間でも、ウィンドウ内で計算した帯と同じ値を返す
+        rng = random.Random(4)
+        candles = make_candles([rng.uniform(90, 110) for _ in range(400)])
+        table = SparseTable.from_candles(candles)
+        closes = [c.close for c in candles]
+        for span in (5, 20, 64, 150):
+            for end in (200, 333, 400):
+                window = closes[end - 200:end]
+                self.assertEqual(table.bands_at(candles[end - 1].time, span),
+                                 prior_bands(window, [span])[span])
+        self.assertIsNone(table.bands_at(-1, 20))
+
+
+class TestOrderStatistics(unittest.TestCase):
+
+    def test_skiplist_keeps_order(self):
+        rng = random.Random(1)
+        skiplist = IndexableSkiplist()
+        expected = []
+        for _ in range(2000):
+            if expected and rng.random() < 0.4:
+                v = rng.choice(expected)
+                expected.remove(v)
+                skiplist.remove(v)
+            else:
+                v = rng.choice([rng.random(), 0.5])  # 重複する値も扱える
+                expected.append(v)
+                skiplist.insert(v)
+        expected.sort()
+        self.assertEqual([skiplist[i] for i in range(len(skiplist))], expected)
+        self.assertEqual(skiplist[-1], expected[-1])
+        with self.assertRaises(KeyError):
+            skiplist.remove(2.0)
+
+    def test_rolling_median_and_quantile(self):
+        rng = random.Random(2)
+        values = [rng.gauss(0, 1) for _ in range(300)]
+        medians = rolling_median(values, 15)
+        uppers = rolling_quantile(values, 15, 0.9)
+        for i in range(len(values)):
+            window = values[max(0, i - 14):i + 1]
+            self.assertAlmostEqual(medians[i], statistics.median(window))
+            self.assertLessEqual(uppers[i], max(window))
+            self.assertGreaterEqual(uppers[i], medians[i])
+
+    def test_median_true_range_ignores_spike(self):
+        closes = [100.0] * 40
+        closes[30] = 150.0
+        candles = make_candles(closes)
+        self.assertAlmostEqual(median_true_range(candles, 14)[-1],
+                               statistics.median(true_ranges(candles)[-14:]))
+        self.assertLess(median_true_range(candles, 14)[-1], atr(candles, 14)[-1])
+
+    def test_quantile_bands(self):
+        closes = [float(v) for v in range(1, 102)]
+        # q=0 は最高値・最安値（prior_bands と同じ）
+        self.assertEqual(quantile_bands(closes, 20, 0.0), prior_bands(closes, [20])[20])
+        high, low = quantile_bands(closes, 20, 0.1)
+        self.assertAlmostEqual(high, 98.1)
+        self.assertAlmostEqual(low, 82.9)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,140 @@
+import json
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+
+from fxtrade.lib.exchange import PRODUCT_BTC_FX
+from fxtrade.lib.journal import StateJournal
+from fxtrade.lib.market.mock import PaperExchange
+
+
+class TestStateJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'state.json')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_replay_restores_state(self):
+        journal = StateJournal(self.path)
+        state = journal.load()
+        state['A'] = {'cash': 100.0, 'size': 0.0}
+        journal.record('A', dict(state['A']))
+        state['A']['cash'] = 90.0
+        journal.record('A', {'cash': 90.0})
+        state['B'] = {'cash': 5.0}
+        journal.record('B', {'cash': 5.0}, sync=True)
+        # スナップショットはまだ書いていない（追記だけ）
+        self.assertFalse(os.path.exists(self.path))
+        self.assertEqual(StateJournal(self.path).load(), state)
+
+    def test_torn_last_record_is_ignored(self):
+        journal = StateJournal(self.path)
+        journal.load()
+        journal.record('A', {'cash': 100.0})
+        journal.record('A', {'cash': 90.0})
+        journal.close()
+        journal = StateJournal(self.path)
+        journal.load()
+        journal.record('A', {'cash': 80.0}, sync=True)
+        journal.file.write('{"seq": 4, "code": "A", "se')  # 書きかけで落ちた
+        journal.file.flush()
+        restored = StateJournal(self.path)
+        self.assertEqual(restored.load(), {'A': {'cash': 80.0}})
+        # 壊れた行は切り詰められるので、続きから記録して読み直せる
+        restored.record('A', {'cash': 70.0})
+        self.assertEqual(StateJournal(self.path).load(), {'A': {'cash': 70.0}})
+
+    def test_incomplete_record_is_treated_as_torn(self):
+        # JSONとしては読めるが項目が欠けた・型が違う行も、書きかけの行と同じく切り捨てる
+        for broken in ('{"seq": 2, "code": "A"}', '{"seq": 2, "code": "A", "set": 5}',
+                       '[1, 2]', '{"seq": "2", "code": "A", "set": {}}'):
+            journal = StateJournal(self.path)
+            journal.load()
+            journal.record('A', {'cash': 100.0}, sync=True)
+            journal.file.write(broken + '\n' + '{"seq": 3, "code": "A", "set": {"cash": 1.0}}\n')
+            journal.file.close()
+            restored = StateJournal(self.path)
+            self.assertEqual(restored.load(), {'A': {'cash': 100.0}}, broken)
+            restored.record('A', {'cash': 90.0})
+            self.assertEqual(StateJournal(self.path).load(), {'A': {'cash': 90.0}}, broken)
+            restored.file.close()
+            os.remove(restored.journal_path)
+
+    def test_compaction_keeps_journal_small(self):
+        journal = StateJournal(self.path, compact_every=10)
+        state = journal.load()
+        for i in range(25):
+            state['A'] = {'count': i}
+            journal.record('A', {'count': i})
+        self.assertEqual(journal.records, 5)
+        with open(journal.journal_path) as f:
+            self.assertEqual(len(f.readlines()), 5)
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {'seq': 20, 'accounts': {'A': {'count': 19}}})
+        self.assertEqual(StateJournal(self.path).load(), {'A': {'count': 24}})
+
+    def test_records_older_than_snapshot_are_skipped(self):
+        # スナップショットを書いた直後、ジャーナルを空にする前に落ちた場合
+        journal = StateJournal(self.path)
+        journal.load()
+        journal.record('A', {'cash': 1.0})
+        with open(self.path, 'w') as f:
+            json.dump({'seq': 1, 'accounts': {'A': {'cash': 2.0}}}, f)
+        self.assertEqual(StateJournal(self.path).load(), {'A': {'cash': 2.0}})
+
+    def test_legacy_state_file(self):
+        with open(self.path, 'w') as f:
+            json.dump({'FX_BTC_JPY': {'cash': 1.0}}, f)
+        journal = StateJournal(self.path)
+        self.assertEqual(journal.load(), {'FX_BTC_JPY': {'cash': 1.0}})
+        journal.record('FX_BTC_JPY', {'cash': 2.0})
+        self.assertEqual(StateJournal(self.path).load(), {'FX_BTC_JPY': {'cash': 2.0}})
+
+
+class TestPaperExchangeJournal(unittest.TestCase):
+
+    def test_fills_survive_restart(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'state.json')
+            ex = PaperExchange(state_path=path)
+            ex.get_price = lambda spec: 15000000.0
+            self.assertEqual(ex.market_order(PRODUCT_BTC_FX, 'BUY', 0.01), 1)
+            self.assertEqual(ex.market_order(PRODUCT_BTC_FX, 'SELL', 0.02), 1)
+            # 閉じずに再起動してもジャーナルから同じ状態に戻る
+            self.assertEqual(PaperExchange(state_path=path).state, ex.state)
+            ex.close()
+            with open(path) as f:
+                self.assertEqual(json.load(f)['accounts'], ex.state)
+            self.assertEqual(os.path.getsize(path + '.journal'), 0)
+            self.assertEqual(PaperExchange(state_path=path).state, ex.state)
+
+    def test_swap_clock_survives_crash(self):
+        # ノーポジションの期間のあとに建てて、close() せずに落ちた場合
+        with tempfile.TemporaryDirectory() as tmp, \
+                mock.patch('fxtrade.lib.market.mock.time.time') as now:
+            path = os.path.join(tmp, 'state.json')
+            now.return_value = 1700000000.0
+            ex = PaperExchange(state_path=path)
+            ex.get_price = lambda spec: 15000000.0
+            ex.get_equity(PRODUCT_BTC_FX)
+            now.return_value += 30 * 86400
+            self.assertEqual(ex.market_order(PRODUCT_BTC_FX, 'BUY', 0.1), 1)
+            restarted = PaperExchange(state_path=path)
+            restarted.get_price = ex.get_price
+            restarted.get_equity(PRODUCT_BTC_FX)
+            self.assertEqual(restarted.state[PRODUCT_BTC_FX.code]['swap_paid'], 0.0)
+            # 建てたあとの経過分だけが計上される
+            now.return_value += 86400
+            restarted.get_equity(PRODUCT_BTC_FX)
+            expected = 0.1 * 15000000.0 * restarted.swap_rate_daily
+            self.assertAlmostEqual(restarted.state[PRODUCT_BTC_FX.code]['swap_paid'], expected,
+                                   delta=expected * 0.01)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,159 @@
+import os
+import sqlite3
+import tempfile
+import unittest
+
+
+from fxtrade.lib.backtest import run_backtest, run_backtest_streaming
+from fxtrade.lib.candles import iter_chunks
+from fxtrade.lib.exchange import PRODUCT_BTC_FX
+from fxtrade.lib.ledger import Ledger
+from fxtrade.lib.market.mock import PaperExchange
+from tests.lib.test_backtest import make_candles, trending_market
+from tests.lib.test_bitflyer import FakeBitFlyerExchange
+
+
+class TestLedger(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'ledger.sqlite3')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def count(self, table):
+        # 別の接続から見える件数（書き込み済みのものだけ）
+        with sqlite3.connect(self.path) as conn:
+            return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def test_batched_inserts(self):
+        ledger = Ledger(self.path, mode='test', batch=3, flush_interval=3600)
+        ledger.record_equity('A', 1.0, time=1)
+        ledger.record_swap('A', 0.5, time=1)
+        self.assertEqual(self.count('equity'), 0)
+        ledger.record_order('A', 'BUY', 1.0, 'filled', time=2)
+        self.assertEqual((self.count('equity'), self.count('swaps'), self.count('orders')),
+                         (1, 1, 1))
+        ledger.record_equity('A', 2.0, time=3)
+        ledger.close()
+        self.assertEqual(self.count('equity'), 2)
+        with sqlite3.connect(self.path) as conn:
+            self.assertEqual(conn.execute('PRAGMA journal_mode').fetchone()[0], 'wal')
+            indexes = {row[0] for row in conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'index'")}
+            self.assertEqual(conn.execute('SELECT mode FROM runs').fetchone()[0], 'test')
+        self.assertTrue({'fills_product_time', 'fills_run', 'equity_time'} <= indexes)
+
+    def test_fill_query(self):
+        ledger = Ledger(self.path, run_id='r1', batch=100)
+        ledger.record_fill('FX_BTC_JPY', 'BUY', 0.01, 100.2, ref_price=100.0, time=10)
+        ledger.record_fill('FX_BTC_JPY', 'SELL', 0.01, 99.95, ref_price=100.0, time=20)
+        ledger.record_fill('ETH_JPY', 'BUY', 0.1, 101.0, fee=0.1, ref_price=100.0, time=30)
+        # スリッページは不利な方向が正
+        rows = ledger.fills(product='FX_BTC_JPY')
+        self.assertAlmostEqual(rows[0]['slippage'], 0.002)
+        self.assertAlmostEqual(rows[1]['slippage'], 0.0005)
+        rows = ledger.fills(product='FX_BTC_JPY', start=0, end=30, min_slippage=0.001)
+        self.assertEqual([r['time'] for r in rows], [10])
+        self.assertEqual(len(ledger.fills(run_id='r1', start=25)), 1)
+        ledger.close()
+
+
+class TestLedgerAdapters(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, 'ledger.sqlite3')
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def count(self, table):
+        with sqlite3.connect(self.path) as conn:
+            return conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+
+    def test_backtest_records_match_result(self):
+        candles = make_candles(trending_market(800))
+        ledger = Ledger(self.path, mode='backtest')
+        result = run_backtest(PRODUCT_BTC_FX, candles, 500000, ledger=ledger)
+        self.assertGreater(result.trade_count, 0)
+        [totals] = ledger.query('SELECT COUNT(*) AS n, SUM(fee) AS fee FROM fills')
+        self.assertEqual(totals['n'], result.trade_count)
+        [swaps] = ledger.query('SELECT SUM(amount) AS total FROM swaps')
+        self.assertAlmostEqual(swaps['total'], result.swap_paid, places=6)
+        [equity] = ledger.query('SELECT COUNT(*) AS n, MAX(time) AS last FROM equity')
+        self.assertEqual(equity['n'], len(result.equity_curve))
+        self.assertEqual(equity['last'], candles[-1].time)
+        orders = ledger.query("SELECT COUNT(*) AS n FROM orders WHERE status = 'filled'")
+        self.assertEqual(orders[0]['n'], result.trade_count)
+        ledger.close()
+
+    def test_streaming_backtest(self):
+        candles = make_candles(trending_market(800))
+        ledger = Ledger(self.path, mode='backtest')
+        result = run_backtest_streaming(PRODUCT_BTC_FX, iter_chunks(iter(candles), 100),
+                                        500000, ledger=ledger)
+        [fills] = ledger.query('SELECT COUNT(*) AS n FROM fills')
+        self.assertEqual(fills['n'], result.trade_count)
+        [equity] = ledger.query('SELECT equity FROM equity ORDER BY time DESC LIMIT 1')
+        self.assertAlmostEqual(equity['equity'], result.final_equity)
+        ledger.close()
+
+    def test_paper_exchange(self):
+        ex = PaperExchange(config={'ledger': self.path},
+                           state_path=os.path.join(self.tmp.name, 'state.json'))
+        ex.get_price = lambda spec: 15000000.0
+        self.assertEqual(ex.market_order(PRODUCT_BTC_FX, 'BUY', 0.01), 1)
+        ex.get_equity(PRODUCT_BTC_FX)
+        # 記録はすぐに書き込まれ、別の接続からも見える
+        self.assertEqual(self.count('fills'), 1)
+        [fill] = ex.ledger.fills()
+        self.assertEqual((fill['side'], fill['size'], fill['ref_price']),
+                         ('BUY', 0.01, 15000000.0))
+        self.assertAlmostEqual(fill['slippage'], ex.slippage)
+        self.assertEqual(ex.ledger.query('SELECT mode FROM runs')[0]['mode'], 'paper')
+        self.assertEqual(len(ex.ledger.query('SELECT * FROM equity')), 1)
+        ex.close()
+
+    def test_live_fills_are_settled_from_executions(self):
+        class Exchange(FakeBitFlyerExchange):
+            executions = []
+
+            def _private_request(self, method, path, body=None):
+                if '/v1/me/getexecutions' in path:
+                    self.calls.append(path)
+                    return self.executions
+                if '/v1/me/getcollateral' in path:
+                    return {'collateral': 100000.0, 'open_position_pnl': 0.0}
+                return super()._private_request(method, path, body)
+
+        ex = Exchange({'key': 'k', 'secret': 's', 'ledger': self.path}, price=15000000.0)
+        ex.calls = []
+        ex.is_dryrun = False
+        ex._price_cache[PRODUCT_BTC_FX.code] = 15000000.0
+        self.assertEqual(ex.market_order(PRODUCT_BTC_FX, 'BUY', 0.02), 1)
+        # まだ約定履歴に出ていない
+        ex.get_equity(PRODUCT_BTC_FX)
+        self.assertEqual(ex.ledger.fills(), [])
+        Exchange.executions = [
+            {'side': 'BUY', 'price': 15010000.0, 'size': 0.01, 'commission': 0,
+             'exec_date': '2024-03-01T00:00:00.5', 'child_order_acceptance_id': 'TEST'},
+            {'side': 'BUY', 'price': 15020000.0, 'size': 0.01, 'commission': 0,
+             'exec_date': '2024-03-01T00:00:01', 'child_order_acceptance_id': 'TEST'},
+        ]
+        ex.get_equity(PRODUCT_BTC_FX)
+        fills = ex.ledger.fills(product='FX_BTC_JPY')
+        self.assertEqual([f['price'] for f in fills], [15010000.0, 15020000.0])
+        self.assertEqual(fills[0]['time'], 1709251200.5)
+        self.assertEqual({f['order_id'] for f in fills}, {'TEST'})
+        # 記録し終えた注文はもう確認しない
+        ex.get_equity(PRODUCT_BTC_FX)
+        self.assertEqual(len(ex.calls), 2)
+        [order] = ex.ledger.query('SELECT status, order_id FROM orders')
+        self.assertEqual(order, {'status': 'accepted', 'order_id': 'TEST'})
+        ex.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
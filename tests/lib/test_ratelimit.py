@@ -0,0 +1,131 @@
+import threading
+import time
+import unittest
+
+
+from fxtrade.lib.httpclient import HttpPool, HttpError
+from fxtrade.lib.ratelimit import RateLimiter, RateLimitTimeout, PRIORITY_ORDER, PRIORITY_READ
+from tests.lib.test_httpclient import StandInServer, StandInHandler
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_classify(self):
+        limiter = RateLimiter()
+        self.assertEqual(limiter.classify('GET', 'https://api.bitflyer.com/v1/me/getbalance'),
+                         ('bitflyer-private', 1, PRIORITY_READ))
+        self.assertEqual(limiter.classify('POST', 'https://api.bitflyer.com/v1/me/sendchildorder'),
+                         ('bitflyer-private', 1, PRIORITY_ORDER))
+        self.assertEqual(limiter.classify('GET', 'https://api.bitflyer.com/v1/getticker')[0],
+                         'bitflyer-public')
+        self.assertEqual(limiter.classify(
+            'GET', 'https://api.binance.com/api/v3/klines?symbol=BTCUSDT&limit=1000')[1], 5)
+        self.assertIsNone(limiter.classify('GET', 'http://127.0.0.1:8000/health')[0])
+
+    def test_reads_leave_reserve_for_orders(self):
+        now = [0.0]
+        limiter = RateLimiter({'api': (10, 10.0)}, reserve=0.2, clock=lambda: now[0])
+        for _ in range(8):
+            limiter.acquire('api')
+        # 情報取得は残り2（予備）を使えない
+        with self.assertRaises(RateLimitTimeout):
+            limiter.acquire('api', timeout=0.5)
+        limiter.acquire('api', priority=PRIORITY_ORDER, timeout=0)
+        limiter.acquire('api', priority=PRIORITY_ORDER, timeout=0)
+        stats = limiter.stats()['api']
+        self.assertEqual((stats['used'], stats['available'], stats['utilization']), (10, 0, 1.0))
+        # 時間が経てば戻る（1秒に1）
+        now[0] = 3.0
+        limiter.acquire('api', timeout=0)
+
+    def test_waits_for_refill(self):
+        limiter = RateLimiter({'api': (5, 0.5)}, reserve=0.0)
+        started = time.monotonic()
+        for _ in range(10):
+            limiter.acquire('api')
+        # 5回分は即座、残りの5回分は0.5秒で戻る
+        self.assertGreater(time.monotonic() - started, 0.4)
+        self.assertGreater(limiter.stats()['api']['waits'], 0)
+
+    def test_waiting_order_goes_first(self):
+        limiter = RateLimiter({'api': (2, 0.4)}, reserve=0.0)
+        limiter.acquire('api')
+        limiter.acquire('api')
+        done = []
+
+        def call(priority, name):
+            limiter.acquire('api', priority=priority)
+            done.append(name)
+
+        reads = [threading.Thread(target=call, args=(PRIORITY_READ, f'read{i}')) for i in range(3)]
+        for t in reads:
+            t.start()
+        time.sleep(0.02)
+        order = threading.Thread(target=call, args=(PRIORITY_ORDER, 'order'))
+        order.start()
+        for t in reads + [order]:
+            t.join()
+        self.assertEqual(done[0], 'order')
+
+    def test_backoff_grows_and_resets(self):
+        limiter = RateLimiter({'api': (10, 1.0)}, backoff_base=1.0, backoff_max=8.0)
+        delays = [limiter.penalize('api') for _ in range(5)]
+        for i, d in enumerate(delays):
+            cap = min(2 ** i, 8.0)
+            self.assertTrue(cap / 2 <= d <= cap, (i, d))
+        self.assertEqual(limiter.penalize('api', retry_after=30), 30)
+        limiter.success('api')
+        self.assertLessEqual(limiter.penalize('api'), 1.0)
+        self.assertEqual(limiter.stats()['api']['throttled'], 7)
+
+
+class ThrottlingHandler(StandInHandler):
+    # 最初の2回は 429 を返す
+
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if len(self.server.paths) <= 2:
+            self._reply(429, {'error': 'too many requests'})
+        else:
+            self._reply(200, {'ltp': 1.0})
+
+    def do_POST(self):
+        self.server.paths.append(self.path)
+        self._reply(503, {'error': 'busy'})
+
+
+class LocalLimiter(RateLimiter):
+    # テスト用サーバーへのリクエストも制限の対象にする
+
+    def classify(self, method, url):
+        return 'local', 1, PRIORITY_ORDER if method == 'POST' else PRIORITY_READ
+
+
+class TestPoolWithLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.server.RequestHandlerClass = ThrottlingHandler
+        self.limiter = LocalLimiter({'local': (100, 1.0)}, backoff_base=0.05)
+        self.pool = HttpPool(timeout=5, limiter=self.limiter)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.close()
+
+    def test_get_retries_after_backoff(self):
+        self.assertEqual(self.pool.get_json(self.server.url() + '/ticker'), {'ltp': 1.0})
+        self.assertEqual(len(self.server.paths), 3)
+        stats = self.limiter.stats()['local']
+        self.assertEqual((stats['requests'], stats['throttled']), (3, 2))
+
+    def test_order_is_not_retried(self):
+        with self.assertRaises(HttpError) as cm:
+            self.pool.request('POST', self.server.url() + '/v1/me/sendchildorder', body=b'{}')
+        self.assertEqual(cm.exception.status, 503)
+        self.assertEqual(len(self.server.paths), 1)
+        self.assertGreater(self.limiter.stats()['local']['backoff_remaining'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,181 @@
+import base64
+import hashlib
+import json
+import socket
+import socketserver
+import struct
+import threading
+import time
+import unittest
+
+
+from fxtrade.lib.exchange import PRODUCT_BTC_FX
+from fxtrade.lib.market.mock import PaperExchange
+from fxtrade.lib.realtime import RealtimeFeed, WebSocket, WEBSOCKET_GUID, _apply_mask
+
+
+class StandInHandler(socketserver.StreamRequestHandler):
+    # bitFlyer の Realtime API の代わり（購読を記録し、サーバーから任意のメッセージを送る）
+
+    def handle(self):
+        headers = {}
+        self.rfile.readline()
+        while True:
+            line = self.rfile.readline().decode().strip()
+            if not line:
+                break
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+        accept = base64.b64encode(hashlib.sha1(
+            (headers['sec-websocket-key'] + WEBSOCKET_GUID).encode()).digest()).decode()
+        self.wfile.write(('HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\n'
+                          f'Connection: Upgrade\r\nSec-WebSocket-Accept: {accept}\r\n\r\n')
+                         .encode())
+        self.server.clients.append(self)
+        try:
+            while True:
+                head = self.rfile.read(2)
+                if len(head) < 2:
+                    return
+                opcode = head[0] & 0x0F
+                length = head[1] & 0x7F
+                if length == 126:
+                    length = struct.unpack('!H', self.rfile.read(2))[0]
+                mask = self.rfile.read(4)
+                payload = _apply_mask(self.rfile.read(length), mask)
+                if opcode == 0x8:
+                    return
+                if opcode == 0xA:
+                    self.server.pongs.append(payload)
+                elif opcode == 0x1:
+                    self.server.received.append(json.loads(payload))
+        finally:
+            if self in self.server.clients:
+                self.server.clients.remove(self)
+
+    def send_frame(self, opcode, payload, fin=True):
+        header = bytes([(0x80 if fin else 0) | opcode])
+        if len(payload) < 126:
+            header += bytes([len(payload)])
+        else:
+            header += bytes([126]) + struct.pack('!H', len(payload))
+        self.wfile.write(header + payload)
+
+
+class StandInServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.clients = []
+        self.received = []
+        self.pongs = []
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    def url(self):
+        return f'ws://127.0.0.1:{self.server_address[1]}/json-rpc'
+
+    def publish(self, channel, message):
+        text = json.dumps({'jsonrpc': '2.0', 'method': 'channelMessage',
+                           'params': {'channel': channel, 'message': message}})
+        for client in list(self.clients):
+            client.send_frame(0x1, text.encode())
+
+    def drop_clients(self):
+        for client in list(self.clients):
+            client.connection.shutdown(socket.SHUT_RDWR)
+
+    def close(self):
+        self.shutdown()
+        self.server_close()
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if condition():
+            return True
+        time.sleep(0.01)
+    return False
+
+
+class TestWebSocket(unittest.TestCase):
+
+    def test_fragmented_message_and_ping(self):
+        server = StandInServer()
+        try:
+            ws = WebSocket(server.url(), timeout=5)
+            self.assertTrue(wait_until(lambda: server.clients))
+            client = server.clients[0]
+            client.send_frame(0x9, b'hb')
+            client.send_frame(0x1, b'{"a": ', fin=False)
+            client.send_frame(0x0, b'1}')
+            self.assertEqual(json.loads(ws.recv()), {'a': 1})
+            self.assertTrue(wait_until(lambda: server.pongs == [b'hb']))
+            # 126バイト以上のメッセージは長さを2バイトで送る
+            ws.send(json.dumps({'pad': 'x' * 300}))
+            self.assertTrue(wait_until(lambda: server.received == [{'pad': 'x' * 300}]))
+            ws.close()
+        finally:
+            server.close()
+
+    def test_mask_round_trip(self):
+        payload = bytes(range(256)) * 3
+        self.assertEqual(_apply_mask(_apply_mask(payload, b'\x01\x02\x03\x04'),
+                                     b'\x01\x02\x03\x04'), payload)
+
+
+class TestRealtimeFeed(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandInServer()
+        self.feed = RealtimeFeed(self.server.url(), trades=3, recv_timeout=5,
+                                 reconnect_max=0.1).start()
+
+    def tearDown(self):
+        self.feed.stop()
+        self.server.close()
+
+    def subscribed(self):
+        return sorted(m['params']['channel'] for m in self.server.received)
+
+    def test_ticker_and_executions(self):
+        self.feed.watch('FX_BTC_JPY')
+        self.assertTrue(wait_until(lambda: len(self.server.received) == 2))
+        self.assertEqual(self.subscribed(), ['lightning_executions_FX_BTC_JPY',
+                                             'lightning_ticker_FX_BTC_JPY'])
+        self.assertIsNone(self.feed.price('FX_BTC_JPY'))
+        self.server.publish('lightning_ticker_FX_BTC_JPY', {'ltp': 15000000.0})
+        self.assertTrue(wait_until(lambda: self.feed.price('FX_BTC_JPY') == 15000000.0))
+        trades = [{'id': i, 'side': 'BUY', 'price': 15000000.0 + i, 'size': 0.01}
+                  for i in range(5)]
+        self.server.publish('lightning_executions_FX_BTC_JPY', trades)
+        self.assertTrue(wait_until(lambda: self.feed.price('FX_BTC_JPY') == 15000004.0))
+        self.assertEqual([t['id'] for t in self.feed.recent_trades('FX_BTC_JPY')], [2, 3, 4])
+        # 古い価格は返さない
+        self.assertIsNone(self.feed.price('FX_BTC_JPY', max_age=-1))
+
+    def test_reconnect_resubscribes(self):
+        self.feed.watch('ETH_JPY')
+        self.assertTrue(wait_until(lambda: len(self.server.received) == 2))
+        self.server.drop_clients()
+        self.assertTrue(wait_until(lambda: self.feed.connects == 2 and
+                                   len(self.server.received) == 4))
+        self.server.publish('lightning_ticker_ETH_JPY', {'ltp': 500000.0})
+        self.assertTrue(wait_until(lambda: self.feed.price('ETH_JPY') == 500000.0))
+
+    def test_adapter_reads_streamed_price(self):
+        ex = PaperExchange(config={'realtime': self.server.url()}, state_path='/nonexistent/x')
+        try:
+            ex.http = None  # ポーリングに戻ったら失敗する
+            self.assertEqual(ex.get_price(PRODUCT_BTC_FX), 0)
+            self.assertTrue(wait_until(lambda: len(self.server.received) == 2))
+            self.server.publish('lightning_ticker_FX_BTC_JPY', {'ltp': 15000000.0})
+            self.assertTrue(wait_until(lambda: ex.get_price(PRODUCT_BTC_FX) == 15000000.0))
+        finally:
+            ex.realtime.stop()
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,110 @@
+import unittest
+
+
+from fxtrade.lib.exchange import PRODUCT_BTC_FX, PRODUCT_ETH_SPOT
+from fxtrade.lib.backtest import run_backtest
+from fxtrade.lib.recost import recost_tape, replay_risk
+from tests.lib.test_backtest import make_candles, trending_market
+
+
+class TestRecost(unittest.TestCase):
+
+    CONFIG = {'strategy': {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}}
+
+    def setUp(self):
+        self.candles = make_candles(trending_market())
+        self.base = run_backtest(PRODUCT_BTC_FX, self.candles, 500000,
+                                 config=self.CONFIG, record_tape=True)
+
+    def test_tape_covers_every_bar(self):
+        self.assertEqual(len(self.base.tape), len(self.base.equity_curve))
+        self.assertTrue(any(bar.ordered != 0 for bar in self.base.tape))
+
+    def test_same_costs_reproduce_backtest(self):
+        # 元と同じコスト条件ならバックテストと完全に一致し、判断の食い違いもない
+        [r] = recost_tape(PRODUCT_BTC_FX, self.base.tape, 500000, [{}], config=self.CONFIG)
+        self.assertEqual(r.result.final_equity, self.base.final_equity)
+        self.assertEqual(r.result.equity_curve, self.base.equity_curve)
+        self.assertEqual(r.result.swap_paid, self.base.swap_paid)
+        self.assertEqual(r.flagged, [])
+
+    def test_multiple_scenarios_in_one_pass(self):
+        results = recost_tape(PRODUCT_BTC_FX, self.base.tape, 500000,
+                              [{'slippage': 0.0}, {'slippage': 0.005, 'swap_rate_daily': 0.002}],
+                              config=self.CONFIG)
+        cheap, costly = results
+        self.assertGreater(cheap.result.final_equity, self.base.final_equity)
+        self.assertLess(costly.result.final_equity, self.base.final_equity)
+        self.assertGreater(costly.result.swap_paid, self.base.swap_paid)
+        # 同じ判断を再生しているので取引回数は変わらない
+        self.assertEqual(cheap.result.trade_count, self.base.trade_count)
+
+    def test_flags_changed_spot_decisions(self):
+        # 現物で極端な手数料を課すと、残高クランプや発注判断が変わる足が検出される
+        base = run_backtest(PRODUCT_ETH_SPOT, self.candles, 500000,
+                            config=self.CONFIG, record_tape=True)
+        [r] = recost_tape(PRODUCT_ETH_SPOT, base.tape, 500000, [{'fee_rate': 0.05}],
+                          config=self.CONFIG)
+        self.assertTrue(r.flagged)
+        self.assertTrue(all(reason in ('min-size', 'order', 'fill')
+                            for _, _, reason in r.flagged))
+
+    def test_unknown_cost_field(self):
+        with self.assertRaises(ValueError):
+            recost_tape(PRODUCT_BTC_FX, self.base.tape, 500000, [{'spread': 0.1}])
+
+
+class TestReplayRisk(unittest.TestCase):
+
+    CONFIG = TestRecost.CONFIG
+
+    def setUp(self):
+        self.candles = make_candles(trending_market())
+        self.base = run_backtest(PRODUCT_BTC_FX, self.candles, 500000,
+                                 config=self.CONFIG, record_tape=True)
+
+    def test_replay_matches_full_backtest(self):
+        variants = [{'risk.risk-per-trade': 0.01}, {'risk.max-leverage': 1.0},
+                    {'risk.drawdown-soft': 0.02, 'risk.drawdown-min-scale': 0.1}]
+        results = replay_risk(PRODUCT_BTC_FX, self.candles, self.base.tape, 500000,
+                              variants, config=self.CONFIG)
+        for variant, r in zip(variants, results):
+            config = dict(self.CONFIG, risk={k.split('.', 1)[1]: v for k, v in variant.items()})
+            expected = run_backtest(PRODUCT_BTC_FX, self.candles, 500000, config=config)
+            self.assertEqual(r.result.final_equity, expected.final_equity)
+            self.assertEqual(r.result.equity_curve, expected.equity_curve)
+            # 状態の経路が変わらないので、すべての足で記録したシグナルを使う
+            self.assertEqual(r.recomputed, 0)
+            self.assertEqual(r.replayed, len(self.base.tape))
+
+    def test_diverging_state_falls_back_to_strategy(self):
+        # 現物で極小のリスクにすると最小数量を下回ってエントリーしない足が出て、
+        # 状態が記録からずれる。その足だけ戦略で計算し直し、結果は元と一致する
+        base = run_backtest(PRODUCT_ETH_SPOT, self.candles, 500000,
+                            config=self.CONFIG, record_tape=True)
+        variant = {'risk.risk-per-trade': 1e-7}
+        [r] = replay_risk(PRODUCT_ETH_SPOT, self.candles, base.tape, 500000, [variant],
+                          config=self.CONFIG)
+        config = dict(self.CONFIG, risk={'risk-per-trade': 1e-7})
+        expected = run_backtest(PRODUCT_ETH_SPOT, self.candles, 500000, config=config)
+        self.assertEqual(r.result.final_equity, expected.final_equity)
+        self.assertEqual(r.result.trade_count, expected.trade_count)
+        self.assertGreater(r.recomputed, 0)
+
+    def test_parallel_workers(self):
+        variants = [{'risk.risk-per-trade': v} for v in (0.01, 0.02, 0.08)]
+        serial = replay_risk(PRODUCT_BTC_FX, self.candles, self.base.tape, 500000,
+                             variants, config=self.CONFIG, workers=1)
+        parallel = replay_risk(PRODUCT_BTC_FX, self.candles, self.base.tape, 500000,
+                               variants, config=self.CONFIG, workers=2)
+        self.assertEqual([r.result.final_equity for r in serial],
+                         [r.result.final_equity for r in parallel])
+
+    def test_rejects_strategy_changes(self):
+        with self.assertRaises(ValueError):
+            replay_risk(PRODUCT_BTC_FX, self.candles, self.base.tape, 500000,
+                        [{'strategy.donchian-span': 10}], config=self.CONFIG)
+
+
+if __name__ == '__main__':
+    unittest.main()
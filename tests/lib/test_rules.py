@@ -0,0 +1,92 @@
+import unittest
+
+
+from fxtrade.lib.exchange import PRODUCT_BTC_FX
+from fxtrade.lib.backtest import run_backtest, run_backtest_streaming
+from fxtrade.lib.candles import iter_chunks
+from fxtrade.lib.indicators import ema
+from fxtrade.lib.rules import compile_rules, RuleStrategy
+from fxtrade.lib.strategy import PositionState, create_strategy
+from tests.lib.test_backtest import make_candles, trending_market
+
+
+RULES = {
+    'long-entry': 'ema(10) > ema(30) and close > highest(close, 20)[1]',
+    'short-entry': 'ema(10) < ema(30) and close < lowest(close, 20)[1]',
+    'long-exit': 'ema(10) < ema(30)',
+    'short-exit': 'not ema(10) < ema(30)',
+    'strength': 'abs(ema(10) - ema(30)) / (atr(14) * 2)',
+}
+
+
+class TestRuleCompiler(unittest.TestCase):
+
+    def setUp(self):
+        self.candles = make_candles(trending_market(400))
+
+    def test_shared_subexpressions(self):
+        # ema(10), ema(30) と比較は全ルールで1つのノードにまとまる
+        program = compile_rules(RULES)
+        self.assertEqual(sum(1 for n in program.nodes if n[0] == 'ema'), 2)
+        self.assertEqual(sum(1 for n in program.nodes if n[0] == 'lt'), 2)
+        self.assertEqual(program.lookback(), 30)
+
+    def test_values(self):
+        columns = compile_rules({'a': 'ema(close, 10)', 'b': 'close[3]',
+                                 'c': '1 < close / close[1] < 1.01'}).run(self.candles)
+        closes = [c.close for c in self.candles]
+        self.assertEqual(columns['a'], ema(closes, 10))
+        self.assertEqual(columns['b'][10], closes[7])
+        self.assertEqual(columns['b'][1], closes[0])
+        self.assertEqual(columns['c'][5], 1 < closes[5] / closes[4] < 1.01)
+
+    def test_rejects_unsafe_or_unknown(self):
+        for text in ('__import__("os")', 'close.real', 'price > 1', 'ema(close, 0)',
+                     'close[-1]', 'ema(close, x=3)', 'close >'):
+            with self.assertRaises(ValueError, msg=text):
+                compile_rules({'long-entry': text})
+
+
+class TestRuleStrategy(unittest.TestCase):
+
+    CONFIG = {'strategy': {'rules': RULES, 'trail-atr-mult': 2.5}}
+
+    def test_create_strategy(self):
+        strategy = create_strategy(self.CONFIG['strategy'])
+        self.assertIsInstance(strategy, RuleStrategy)
+        with self.assertRaises(ValueError):
+            create_strategy({'rules': {'long-exit': 'close > 1'}})
+        with self.assertRaises(ValueError):
+            create_strategy({'rules': {'entry': 'close > 1'}})
+
+    def test_entry_and_stop(self):
+        strategy = RuleStrategy(self.CONFIG['strategy'])
+        candles = make_candles([100.0 + i for i in range(80)])
+        signal = strategy.evaluate(candles, PositionState())
+        self.assertEqual(signal.direction, 1)
+        self.assertLess(signal.stop_price, signal.price)
+
+    def test_backtest_matches_streaming(self):
+        candles = make_candles(trending_market())
+        result = run_backtest(PRODUCT_BTC_FX, candles, 500000, config=self.CONFIG)
+        streamed = run_backtest_streaming(PRODUCT_BTC_FX, iter_chunks(candles, 50), 500000,
+                                          config=self.CONFIG)
+        self.assertGreater(result.trade_count, 0)
+        self.assertEqual(result.final_equity, streamed.final_equity)
+        self.assertEqual(result.trade_count, streamed.trade_count)
+
+    def test_values_depend_only_on_the_window(self):
+        # 値は窓の先頭から計算する（それまでに評価した足や、起動してからの時間に依らない）
+        candles = make_candles(trending_market())
+        window = candles[300:400]
+        config = {'rules': {'long-entry': 'close > ema(30)', 'strength': 'ema(30)'}}
+        running = RuleStrategy(config)
+        for end in range(200, 400):
+            running.values(candles[end - 100:end])
+        expected = ema([c.close for c in window], 30)[-1]
+        self.assertEqual(running.values(window)['strength'], expected)
+        self.assertEqual(RuleStrategy(config).values(window), running.values(window))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,174 @@
+import asyncio
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+
+from fxtrade.lib import get_transaction_id
+from fxtrade.lib.engine import TradingEngine
+from fxtrade.lib.exchange import PRODUCT_BTC_FX, PRODUCT_ETH_SPOT
+from fxtrade.lib.market.mock import PaperExchange
+from fxtrade.lib.runner import EngineRunner, CandleSchedule
+from tests.lib.test_engine import FakeExchange, make_candles
+
+
+class SlowExchange(FakeExchange):
+    # APIの応答が遅い取引所（get_candles が delay 秒かかる）
+
+    def __init__(self, candles, delay, fail=False):
+        super().__init__(candles)
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+
+    def get_candles(self, spec, limit):
+        self.calls += 1
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError('api down')
+        return super().get_candles(spec, limit)
+
+
+class TestEngineRunner(unittest.TestCase):
+
+    def setUp(self):
+        self.candles = make_candles([100 + i * 0.5 for i in range(120)])
+
+    def test_cycle_takes_the_slowest_engine(self):
+        engines = [TradingEngine(SlowExchange(self.candles, 0.3), spec)
+                   for spec in (PRODUCT_BTC_FX, PRODUCT_ETH_SPOT)]
+        runner = EngineRunner(engines, wait_time=0)
+        started = time.monotonic()
+        asyncio.run(runner.run(cycles=1))
+        # 直列なら0.6秒かかる
+        self.assertLess(time.monotonic() - started, 0.5)
+        self.assertEqual([s.cycles for s in runner.stats.values()], [1, 1])
+
+    def test_errors_are_isolated(self):
+        broken = SlowExchange(self.candles, 0.0, fail=True)
+        healthy = SlowExchange(self.candles, 0.0)
+        runner = EngineRunner([TradingEngine(broken, PRODUCT_BTC_FX),
+                               TradingEngine(healthy, PRODUCT_ETH_SPOT)], wait_time=0)
+        asyncio.run(runner.run(cycles=3))
+        self.assertEqual(runner.stats['BTC-FX'].errors, 3)
+        self.assertIn('api down', runner.stats['BTC-FX'].last_error)
+        self.assertEqual(runner.stats['ETH'].errors, 0)
+        self.assertEqual(healthy.calls, 3)
+
+    def test_transaction_ids_do_not_mix(self):
+        # 同時に動くエンジンのスレッドは、それぞれのサイクルのトランザクションIDを使う
+        seen = {}
+
+        class Exchange(SlowExchange):
+            def get_candles(self, spec, limit):
+                before = get_transaction_id()
+                time.sleep(0.1)
+                seen[spec.name] = (before, get_transaction_id())
+                return super().get_candles(spec, limit)
+
+        engines = [TradingEngine(Exchange(self.candles, 0.0), spec)
+                   for spec in (PRODUCT_BTC_FX, PRODUCT_ETH_SPOT)]
+        asyncio.run(EngineRunner(engines, wait_time=0).run(cycles=1))
+        (btc_before, btc_after), (eth_before, eth_after) = seen['BTC-FX'], seen['ETH']
+        self.assertEqual(btc_before, btc_after)
+        self.assertEqual(eth_before, eth_after)
+        self.assertNotEqual(btc_before, eth_before)
+
+    def test_report_includes_rate_limit_budgets(self):
+        runner = EngineRunner([TradingEngine(SlowExchange(self.candles, 0.0), PRODUCT_BTC_FX)],
+                              wait_time=60, stats_interval=0.05)
+        reports = []
+        runner.report = lambda: reports.append(EngineRunner.report(runner))
+
+        async def main():
+            task = asyncio.create_task(runner.run())
+            await asyncio.sleep(0.2)
+            runner.stop()
+            await asyncio.wait_for(task, timeout=5)
+
+        asyncio.run(main())
+        # 定期的に出し、終了時にも出す
+        self.assertGreaterEqual(len(reports), 3)
+        report = reports[-1]
+        self.assertEqual(report['engines']['BTC-FX']['cycles'], 1)
+        self.assertIn('bitflyer-private', report['rate-limit'])
+        self.assertIn('utilization', report['rate-limit']['bitflyer-private'])
+
+    def test_stop_interrupts_wait(self):
+        runner = EngineRunner([TradingEngine(SlowExchange(self.candles, 0.0), PRODUCT_BTC_FX)],
+                              wait_time=60)
+
+        async def main():
+            task = asyncio.create_task(runner.run())
+            await asyncio.sleep(0.1)
+            runner.stop()
+            await asyncio.wait_for(task, timeout=5)
+
+        asyncio.run(main())
+        self.assertEqual(runner.stats['BTC-FX'].cycles, 1)
+
+
+class TestCandleSchedule(unittest.TestCase):
+
+    def schedule(self, now, **kw):
+        return CandleSchedule(3600, settle=5.0, wall=lambda: now, **kw)
+
+    def test_wakes_after_candle_close(self):
+        self.assertEqual(self.schedule(7200 + 100).next_wake(), (10805, 'bar'))
+        # 確定直後（settle 前）ならその確定に合わせる
+        self.assertEqual(self.schedule(7201).next_wake(), (7205, 'bar'))
+
+    def test_light_cadence(self):
+        schedule = self.schedule(7300, light=600)
+        self.assertEqual(schedule.next_wake(7200 - 3600), (7900, 'light'))
+        # 確定の直前は軽い確認を挟まない
+        self.assertEqual(self.schedule(10500, light=600).next_wake(3600), (10805, 'bar'))
+
+    def test_catch_up_missed_candle(self):
+        # 確定済みの足（開始 3600）をまだ評価していなければ retry 秒後に取り直す
+        self.assertEqual(self.schedule(7300, retry=30).next_wake(0), (7330, 'catch-up'))
+        self.assertEqual(self.schedule(7300, retry=30).next_wake(3600), (10805, 'bar'))
+
+    def test_runner_follows_schedule(self):
+        started = time.time()
+        schedule = CandleSchedule(0.2, settle=0.05)
+        runner = EngineRunner([TradingEngine(SlowExchange(self.candles(), 0.0), PRODUCT_BTC_FX)],
+                              wait_time=60, schedule=schedule)
+        asyncio.run(runner.run(cycles=3))
+        stats = runner.stats['BTC-FX']
+        self.assertEqual(stats.cycles, 3)
+        self.assertLess(abs(stats.last_drift), 0.1)
+        self.assertLess(stats.max_drift, 0.1)
+        self.assertLess(time.time() - started, 1.0)
+
+    def candles(self):
+        return make_candles([100 + i * 0.5 for i in range(120)])
+
+
+class TestPaperExchangeConcurrency(unittest.TestCase):
+
+    def test_concurrent_orders_are_all_recorded(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            ex = PaperExchange(state_path=os.path.join(tmp, 'state.json'))
+            ex.get_price = lambda spec: 1000.0
+
+            def trade(spec):
+                for _ in range(50):
+                    ex.market_order(spec, 'BUY', 0.01)
+
+            threads = [threading.Thread(target=trade, args=(spec,))
+                       for spec in (PRODUCT_BTC_FX, PRODUCT_ETH_SPOT) for _ in range(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(ex.state['FX_BTC_JPY']['trade_count'], 100)
+            self.assertEqual(ex.state['ETH_JPY']['trade_count'], 100)
+            self.assertAlmostEqual(ex.get_position(PRODUCT_BTC_FX), 1.0)
+            self.assertEqual(PaperExchange(state_path=ex.state_path).state, ex.state)
+
+
+if __name__ == '__main__':
+    unittest.main()
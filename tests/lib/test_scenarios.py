@@ -0,0 +1,70 @@
+import csv
+import os
+import tempfile
+import unittest
+
+
+from fxtrade.lib.candles import candles_to_csv
+from fxtrade.lib.exchange import PRODUCT_BTC_FX, PRODUCT_ETH_SPOT
+from fxtrade.lib.backtest import run_backtest
+from fxtrade.lib.scenarios import expand_scenarios, run_scenarios, format_table, write_table
+from tests.lib.test_backtest import make_candles, trending_market
+
+
+SCENARIO = {
+    'products': ['btc', 'eth'],
+    'intervals': ['1h'],
+    'initial': 500000,
+    'config': {'strategy': {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}},
+    'costs': [{'name': 'base'}, {'name': 'slip', 'slippage': 0.003},
+              {'name': 'costly', 'fee_rate': 0.01, 'swap_rate_daily': 0.002}],
+}
+
+
+class TestScenarios(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.candles = make_candles(trending_market())
+        for spec in (PRODUCT_BTC_FX, PRODUCT_ETH_SPOT):
+            candles_to_csv(self.candles, os.path.join(self.tmp.name, f'{spec.symbol}_1h.csv'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_expand_groups_costs(self):
+        groups = expand_scenarios(SCENARIO)
+        self.assertEqual([(g['product'], g['interval']) for g in groups],
+                         [('btc', '1h'), ('eth', '1h')])
+        self.assertEqual([c['name'] for c in groups[0]['costs']], ['base', 'slip', 'costly'])
+        with self.assertRaises(ValueError):
+            expand_scenarios({'costs': [{'spread': 0.1}]})
+
+    def test_cells_match_individual_backtests(self):
+        # コストの違うセルはテープの再生で求めるが、個別に実行した結果と一致する
+        rows = run_scenarios(SCENARIO, cache_dir=self.tmp.name, workers=1)
+        self.assertEqual(len(rows), 6)
+        costs = {c['name']: {k: v for k, v in c.items() if k != 'name'}
+                 for c in SCENARIO['costs']}
+        for row in rows:
+            spec = PRODUCT_BTC_FX if row['product'] == 'btc' else PRODUCT_ETH_SPOT
+            expected = run_backtest(spec, self.candles, 500000, config=SCENARIO['config'],
+                                    **costs[row['cost']])
+            self.assertEqual(row['final_equity'], expected.final_equity, row)
+            self.assertEqual(row['trade_count'], expected.trade_count, row)
+
+    def test_parallel_and_table(self):
+        rows = run_scenarios(SCENARIO, cache_dir=self.tmp.name, workers=2)
+        serial = run_scenarios(SCENARIO, cache_dir=self.tmp.name, workers=1)
+        self.assertEqual(rows, serial)
+        table = format_table(rows)
+        self.assertEqual(len(table.splitlines()), 7)
+        self.assertIn('costly', table)
+        path = os.path.join(self.tmp.name, 'out', 'table.csv')
+        write_table(rows, path)
+        with open(path) as f:
+            self.assertEqual(len(list(csv.DictReader(f))), 6)
+
+
+if __name__ == '__main__':
+    unittest.main()
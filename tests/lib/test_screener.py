@@ -0,0 +1,111 @@
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+
+from fxtrade.lib.candles import Candle, candles_to_csv
+from fxtrade.lib.strategy import TrendStrategy, PositionState
+from fxtrade.lib.screener import load_universe, price_matrix, screen, screen_universe
+
+
+CONFIG = {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}
+
+
+def make_candles(closes):
+    return [Candle(time=i * 3600, open=c, high=c * 1.005, low=c * 0.995, close=c, volume=1.0)
+            for i, c in enumerate(closes)]
+
+
+def random_walk(seed, n=60, drift=0.0):
+    rng = random.Random(seed)
+    closes = [100.0]
+    for _ in range(n - 1):
+        closes.append(closes[-1] * (1 + drift + rng.gauss(0, 0.01)))
+    return closes
+
+
+class TestScreener(unittest.TestCase):
+
+    def setUp(self):
+        self.universe = {
+            'UPUSDT': make_candles([100.0 + i for i in range(60)]),
+            'DOWNUSDT': make_candles([200.0 - i for i in range(60)]),
+            'FLATUSDT': make_candles([100.0, 101.0] * 30),
+            'SHORTUSDT': make_candles([100.0] * 10),
+        }
+        for k in range(5):
+            self.universe[f'RW{k}USDT'] = make_candles(random_walk(k, drift=0.002 * (k - 2)))
+        self.strategy = TrendStrategy(CONFIG)
+
+    def test_matches_strategy_per_symbol(self):
+        # 行列でまとめて計算した結果は、銘柄ごとに TrendStrategy を評価した結果と一致する
+        length = self.strategy.min_history() + 10
+        symbols, closes, highs, lows = price_matrix(self.universe, length)
+        self.assertNotIn('SHORTUSDT', symbols)
+        rows = {r.symbol: r for r in screen(symbols, closes, highs, lows, self.strategy)}
+        for symbol in symbols:
+            signal = self.strategy.evaluate(self.universe[symbol][-length:], PositionState())
+            row = rows[symbol]
+            self.assertEqual(signal.direction != 0, row.confirmed, symbol)
+            if signal.direction:
+                self.assertEqual(signal.direction, row.trend)
+                self.assertAlmostEqual(signal.strength, row.strength)
+
+    def test_ranking_puts_confirmed_first(self):
+        length = self.strategy.min_history() + 10
+        rows = screen(*price_matrix(self.universe, length), self.strategy)
+        confirmed = [r.confirmed for r in rows]
+        self.assertEqual(confirmed, sorted(confirmed, reverse=True))
+        by_symbol = {r.symbol: r for r in rows}
+        self.assertTrue(by_symbol['UPUSDT'].confirmed)
+        self.assertEqual(by_symbol['DOWNUSDT'].trend, -1)
+        flat = next(r for r in rows if r.symbol == 'FLATUSDT')
+        self.assertFalse(flat.confirmed)
+
+    def test_load_universe_uses_cache_and_skips_failures(self):
+        with tempfile.TemporaryDirectory() as d:
+            candles_to_csv(self.universe['UPUSDT'], os.path.join(d, 'UPUSDT_4h_recent.csv'))
+            with mock.patch('fxtrade.lib.screener.fetch_recent_binance_klines',
+                            side_effect=IOError('offline')) as fetch:
+                universe = load_universe(['UPUSDT', 'MISSINGUSDT'], '4h', 50, d,
+                                         clock=lambda: 60 * 3600)
+            self.assertEqual(list(universe), ['UPUSDT'])
+            self.assertEqual(len(universe['UPUSDT']), 50)
+            self.assertEqual(fetch.call_count, 1)
+
+    def test_cache_freshness_follows_last_candle(self):
+        # 最後の足（59時の足）は 60時に確定する。ファイルの更新時刻には関係なく、
+        # 次の足が確定したらキャッシュを使わずに取り直す
+        candles = self.universe['UPUSDT']
+        latest = make_candles([100.0 + i for i in range(61)])
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'UPUSDT_1h_recent.csv')
+            candles_to_csv(candles, path)
+            os.utime(path, (0, 0))
+            with mock.patch('fxtrade.lib.screener.fetch_recent_binance_klines',
+                            return_value=latest + latest[-1:]) as fetch:
+                universe = load_universe(['UPUSDT'], '1h', 50, d, clock=lambda: 60 * 3600 + 3599)
+                self.assertEqual(fetch.call_count, 0)
+                self.assertEqual(universe['UPUSDT'][-1].time, candles[-1].time)
+                universe = load_universe(['UPUSDT'], '1h', 50, d, clock=lambda: 61 * 3600)
+                self.assertEqual(fetch.call_count, 1)
+                self.assertEqual(universe['UPUSDT'][-1].time, 60 * 3600)
+
+    def test_screen_many_symbols(self):
+        with tempfile.TemporaryDirectory() as d:
+            symbols = [f'S{k}USDT' for k in range(200)]
+            for k, symbol in enumerate(symbols):
+                candles_to_csv(make_candles(random_walk(k, drift=0.001 * (k % 5 - 2))),
+                               os.path.join(d, f'{symbol}_1h_recent.csv'))
+            with mock.patch('fxtrade.lib.screener.fetch_recent_binance_klines',
+                            side_effect=IOError('offline')):
+                rows = screen_universe(symbols, '1h', d, CONFIG, clock=lambda: 60 * 3600)
+        self.assertEqual(len(rows), 200)
+        strengths = [r.strength for r in rows if r.confirmed]
+        self.assertEqual(strengths, sorted(strengths, reverse=True))
+
+
+if __name__ == '__main__':
+    unittest.main()
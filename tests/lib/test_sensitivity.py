@@ -0,0 +1,63 @@
+import unittest
+from unittest import mock
+
+
+from fxtrade.lib.exchange import PRODUCT_BTC_FX, PRODUCT_ETH_SPOT
+from fxtrade.lib.backtest import run_backtest
+from fxtrade.lib.sensitivity import run_start_dates, start_indices, distribution
+from fxtrade.lib.strategy import TrendStrategy
+from tests.lib.test_backtest import make_candles, trending_market
+
+
+class TestStartDates(unittest.TestCase):
+
+    CONFIG = {'strategy': {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}}
+
+    def setUp(self):
+        self.candles = make_candles(trending_market(500))
+
+    def test_start_indices(self):
+        starts = start_indices(self.candles, 24 * 3600, 5, warmup=32)
+        self.assertEqual(starts, [32, 56, 80, 104, 128])
+
+    def test_each_start_matches_run_backtest(self):
+        starts = start_indices(self.candles, 48 * 3600, 6, warmup=0)
+        for spec in (PRODUCT_BTC_FX, PRODUCT_ETH_SPOT):
+            results = run_start_dates(spec, self.candles, 500000, starts, config=self.CONFIG)
+            self.assertEqual([r.start for r in results], starts)
+            for r in results:
+                expected = run_backtest(spec, self.candles, 500000, config=self.CONFIG,
+                                        start=r.start)
+                self.assertEqual(r.result.final_equity, expected.final_equity)
+                self.assertEqual(r.result.max_drawdown, expected.max_drawdown)
+                self.assertEqual(r.result.trade_count, expected.trade_count)
+                self.assertEqual(r.result.years, expected.years)
+
+    def test_starts_inside_warmup_are_not_duplicated(self):
+        # 準備期間内の開始位置はどれも同じ位置から実行されるので、1つだけ残す
+        warmup = TrendStrategy(self.CONFIG['strategy']).min_history()
+        starts = [0, 5, 10, warmup + 24, warmup + 48]
+        results = run_start_dates(PRODUCT_BTC_FX, self.candles, 500000, starts,
+                                  config=self.CONFIG)
+        self.assertEqual([r.start for r in results], [0, warmup + 24, warmup + 48])
+        self.assertEqual(len({r.start_time for r in results}), 3)
+        self.assertEqual(start_indices(self.candles, 24 * 3600, 3, warmup=warmup)[0], warmup)
+
+    def test_signals_are_shared(self):
+        # 開始位置を増やしても、戦略の計算回数は1回分のバックテストに近い
+        # （30回分のバックテストなら 30 × 足の本数 だけ計算する）
+        starts = start_indices(self.candles, 12 * 3600, 30, warmup=0)
+        with mock.patch.object(TrendStrategy, 'evaluate', autospec=True,
+                               side_effect=TrendStrategy.evaluate) as evaluate:
+            run_start_dates(PRODUCT_BTC_FX, self.candles, 500000, starts, config=self.CONFIG)
+        self.assertLess(evaluate.call_count, len(starts) * len(self.candles) // 5)
+
+    def test_distribution(self):
+        d = distribution([0.3, 0.1, 0.2, 0.5, 0.4])
+        self.assertEqual((d['min'], d['median'], d['max']), (0.1, 0.3, 0.5))
+        self.assertAlmostEqual(d['p25'], 0.2)
+        self.assertEqual(distribution([]), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+from urllib import request, error
+
+
+from fxtrade import backtest_client
+from fxtrade.lib.candles import candles_to_csv
+from fxtrade.lib.exchange import PRODUCT_BTC_FX
+from fxtrade.lib.backtest import run_backtest
+from fxtrade.lib.history import DEFAULT_START_MS, INTERVAL_SECONDS
+from fxtrade.lib.service import BacktestService, DatasetCache, validate_job
+from tests.lib.test_backtest import make_candles, trending_market
+
+
+CONFIG = {'strategy': {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}}
+
+
+def post(address, path, body):
+    url = f'http://{address[0]}:{address[1]}{path}'
+    req = request.Request(url, json.dumps(body).encode(),
+                          {'Content-Type': 'application/json'}, method='POST')
+    with request.urlopen(req, timeout=30) as response:
+        return json.loads(response.read())
+
+
+class TestBacktestService(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.candles = make_candles(trending_market())
+        candles_to_csv(self.candles, os.path.join(self.tmp.name, 'BTCUSDT_1h.csv'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_dataset_cache_lru(self):
+        candles_to_csv(self.candles, os.path.join(self.tmp.name, 'BTCUSDT_4h.csv'))
+        cache = DatasetCache(self.tmp.name, maxsize=1)
+        first = cache.get('BTCUSDT', '1h')
+        self.assertIs(cache.get('BTCUSDT', '1h'), first)
+        cache.get('BTCUSDT', '4h')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual([k[1] for k in cache.items], ['4h'])
+
+    def test_concurrent_gets_load_once(self):
+        cache = DatasetCache(self.tmp.name)
+
+        def slow_load(*args):
+            time.sleep(0.1)
+            return self.candles
+
+        with mock.patch('fxtrade.lib.service.load_or_fetch', side_effect=slow_load) as load:
+            threads = [threading.Thread(target=cache.get, args=('BTCUSDT', '1h'))
+                       for _ in range(4)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        self.assertEqual(load.call_count, 1)
+        self.assertEqual((cache.stats()['hits'], cache.stats()['misses']), (3, 1))
+
+    def test_client_defaults_match_server(self):
+        # クライアントは起動を速くするため lib を import せず、同じ値の写しを持つ
+        self.assertEqual(backtest_client.INTERVALS, list(INTERVAL_SECONDS))
+        self.assertEqual(backtest_client.DEFAULT_START_MS, DEFAULT_START_MS)
+
+    def test_validate_job(self):
+        self.assertEqual(validate_job({})['product'], 'btc')
+        with self.assertRaises(ValueError):
+            validate_job({'product': 'doge'})
+        with self.assertRaises(ValueError):
+            validate_job({'interval': '1w'})
+
+    def test_jobs_match_run_backtest(self):
+        expected = run_backtest(PRODUCT_BTC_FX, self.candles, 500000, config=CONFIG)
+        service = BacktestService(port=0, workers=0, cache_dir=self.tmp.name).start()
+        try:
+            job = {'product': 'btc', 'interval': '1h', 'config': CONFIG, 'curve': True}
+            first = post(service.address, '/backtest', job)
+            second = post(service.address, '/backtest', dict(job, curve=False))
+            with request.urlopen(f'http://{service.address[0]}:{service.address[1]}/health',
+                                 timeout=10) as response:
+                health = json.loads(response.read())
+        finally:
+            service.close()
+        self.assertEqual(first['final_equity'], expected.final_equity)
+        self.assertEqual([tuple(p) for p in first['equity_curve']], expected.equity_curve)
+        self.assertNotIn('equity_curve', second)
+        self.assertEqual(health['jobs'], 2)
+        # 2回目はキャッシュ済みのデータセットを使う
+        self.assertEqual(health['cache']['hits'], 1)
+
+    def test_worker_pool(self):
+        service = BacktestService(port=0, workers=1, cache_dir=self.tmp.name).start()
+        try:
+            result = post(service.address, '/backtest', {'config': CONFIG})
+            post(service.address, '/backtest', {'config': CONFIG})
+            with self.assertRaises(error.HTTPError) as cm:
+                post(service.address, '/backtest', {'product': 'doge'})
+            with request.urlopen(f'http://{service.address[0]}:{service.address[1]}/health',
+                                 timeout=10) as response:
+                health = json.loads(response.read())
+        finally:
+            service.close()
+        self.assertIn('summary', result)
+        self.assertEqual(cm.exception.code, 400)
+        # ワーカープロセスのキャッシュも集計される
+        self.assertEqual((health['cache']['hits'], health['cache']['misses']), (1, 1))
+        self.assertEqual(health['cache']['datasets'], [['BTCUSDT', '1h', DEFAULT_START_MS]])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,8 @@ import unittest
 
 
 from fxtrade.lib.candles import Candle
-from fxtrade.lib.strategy import TrendStrategy, PositionState
+from fxtrade.lib.strategy import TrendStrategy, EnsembleStrategy, PositionState, \
+    create_strategy
 
 
 def make_candles(closes):
@@ -96,6 +97,98 @@ class TestTrendStrategy(unittest.TestCase):
         self.assertGreater(wild_signal.atr, calm_signal.atr)
 
 
+class TestRobustSources(unittest.TestCase):
+
+    CONFIG = {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}
+
+    def choppy(self, n=160):
+        closes = []
+        for i in range(n):
+            closes.append(100.0 + i * 0.3 + (5.0 if i % 7 == 0 else 0.0) - (i % 3))
+        return make_candles(closes)
+
+    def test_incremental_matches_fresh_evaluation(self):
+        # 同じインスタンスで1本ずつ進めた値は、毎回作り直した戦略の値と一致する
+        config = dict(self.CONFIG, **{'atr-source': 'median', 'band-source': 'quantile'})
+        candles = self.choppy()
+        strategy = TrendStrategy(config)
+        for end in range(40, len(candles)):
+            window = candles[max(0, end - 50):end]
+            a = strategy.evaluate(window, PositionState())
+            b = TrendStrategy(config).evaluate(window, PositionState())
+            self.assertEqual(a, b)
+
+    def test_zero_quantile_equals_donchian(self):
+        candles = make_candles(uptrend())
+        a = TrendStrategy(dict(self.CONFIG, **{'band-source': 'quantile', 'band-quantile': 0.0}))
+        b = TrendStrategy(self.CONFIG)
+        self.assertEqual(a.evaluate(candles, PositionState()),
+                         b.evaluate(candles, PositionState()))
+
+    def test_median_atr_narrows_stop_after_spike(self):
+        closes = uptrend()
+        closes[-5] += 40.0
+        candles = make_candles(closes)
+        state = PositionState(direction=1, entry_price=150.0, extreme_price=150.0)
+        ema_stop = TrendStrategy(self.CONFIG).evaluate(candles, PositionState(**vars(state)))
+        median = TrendStrategy(dict(self.CONFIG, **{'atr-source': 'median'}))
+        median_stop = median.evaluate(candles, PositionState(**vars(state)))
+        self.assertLess(median_stop.atr, ema_stop.atr)
+
+    def test_unknown_source(self):
+        with self.assertRaises(ValueError):
+            TrendStrategy({'atr-source': 'max'})
+        with self.assertRaises(ValueError):
+            TrendStrategy({'band-source': 'keltner'})
+
+
+class TestEnsembleStrategy(unittest.TestCase):
+
+    BASE = {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20, 'trail-atr-mult': 3.0}
+
+    def test_single_member_matches_trend_strategy(self):
+        # メンバーが1つなら単独の TrendStrategy と同じシグナルになる
+        closes = uptrend(120) + downtrend(120, start=219.0)
+        candles = make_candles(closes)
+        single = TrendStrategy(self.BASE)
+        ensemble = EnsembleStrategy(dict(self.BASE, members=[{}]))
+        state = PositionState()
+        for i in range(single.min_history(), len(candles)):
+            expected = single.evaluate(candles[:i], state)
+            if expected.direction != state.direction:
+                state = PositionState(expected.direction, expected.price, expected.price) \
+                    if expected.direction else PositionState()
+            actual = ensemble.evaluate(candles[:i], PositionState())
+            self.assertEqual(actual, expected)
+
+    def test_members_inherit_base_config(self):
+        ensemble = create_strategy(dict(self.BASE, members=[{'fast-span': 5}, {}]))
+        self.assertIsInstance(ensemble, EnsembleStrategy)
+        self.assertEqual([m.fast_span for m in ensemble.members], [5, 10])
+        self.assertEqual(ensemble.members[0].slow_span, 30)
+        self.assertIsInstance(create_strategy(self.BASE), TrendStrategy)
+
+    def test_vote_needs_majority(self):
+        # 全メンバーが同じ方向なら張り、賛成が半数以下ならポジションを取らない
+        candles = make_candles(downtrend())
+        ensemble = EnsembleStrategy(dict(self.BASE, mode='vote', members=[{}, {}]))
+        self.assertEqual(ensemble.evaluate(candles, PositionState()).direction, -1)
+        split = EnsembleStrategy(dict(self.BASE, mode='vote',
+                                      members=[{}, {'allow-short': False}]))
+        self.assertEqual(split.evaluate(candles, PositionState()).direction, 0)
+
+    def test_allow_short_propagates(self):
+        ensemble = EnsembleStrategy(dict(self.BASE, members=[{}, {}]))
+        ensemble.allow_short = False
+        self.assertFalse(any(m.allow_short for m in ensemble.members))
+        signal = ensemble.evaluate(make_candles(downtrend()), PositionState())
+        self.assertEqual(signal.direction, 0)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            EnsembleStrategy(dict(self.BASE, mode='median', members=[{}]))
+
+
 class TestPositionState(unittest.TestCase):
 
     def test_update_extreme_long(self):
@@ -0,0 +1,138 @@
+import os
+import tempfile
+import threading
+import unittest
+
+
+from fxtrade.lib.candles import candles_to_csv, pack_candles, PackedCandles
+from fxtrade.lib.exchange import PRODUCT_BTC_FX
+from fxtrade.lib.backtest import run_backtest
+from fxtrade.lib.indicators import SparseTable
+from fxtrade.lib.sweep import expand_sweep, SweepCoordinator, SweepWorker, run_node, \
+    run_cell, _Connection
+from tests.lib.test_backtest import make_candles, trending_market
+
+
+SWEEP = {
+    'products': ['btc'],
+    'intervals': ['1h'],
+    'initial': 500000,
+    'config': {'strategy': {'fast-span': 10, 'slow-span': 30, 'donchian-span': 20}},
+    'grid': {'strategy.donchian-span': [10, 20], 'risk.risk-per-trade': [0.02, 0.04]},
+}
+
+
+class TestPackedCandles(unittest.TestCase):
+
+    def test_roundtrip(self):
+        candles = make_candles(trending_market(50))
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'x.f64')
+            pack_candles(candles, path)
+            packed = PackedCandles.open(path)
+            self.assertEqual(len(packed), 50)
+            self.assertEqual(packed[0], candles[0])
+            self.assertEqual(packed[-1], candles[-1])
+            self.assertEqual(packed[10:20], candles[10:20])
+            self.assertEqual(list(packed), candles)
+
+    def test_backtest_on_packed_matches_list(self):
+        candles = make_candles(trending_market())
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'x.f64')
+            pack_candles(candles, path)
+            config = SWEEP['config']
+            a = run_backtest(PRODUCT_BTC_FX, candles, 500000, config=config)
+            b = run_backtest(PRODUCT_BTC_FX, PackedCandles.open(path), 500000, config=config)
+            self.assertEqual(a.final_equity, b.final_equity)
+
+
+class TestSweep(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = self.tmp.name
+        candles_to_csv(make_candles(trending_market(400)),
+                       os.path.join(self.cache_dir, 'BTCUSDT_1h.csv'))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_expand_sweep(self):
+        cells = expand_sweep(SWEEP)
+        self.assertEqual(len(cells), 4)
+        spans = sorted(c['config']['strategy']['donchian-span'] for c in cells)
+        self.assertEqual(spans, [10, 10, 20, 20])
+        # 元の設定は変更されない
+        self.assertEqual(SWEEP['config']['strategy']['donchian-span'], 20)
+        self.assertEqual(cells[0]['config']['strategy']['fast-span'], 10)
+
+    def test_shared_band_table_matches(self):
+        # ドンチャンの期間が違うセルでも、1つの索引から引いた帯で同じ結果になる
+        candles = make_candles(trending_market(400))
+        table = SparseTable.from_candles(candles)
+        for cell in expand_sweep(SWEEP):
+            self.assertEqual(run_cell(cell, candles, table), run_cell(cell, candles))
+
+    def test_local_workers_collect_all_results(self):
+        cells = expand_sweep(SWEEP)
+        coordinator = SweepCoordinator(cells, authkey='k').start()
+        try:
+            workers = [SweepWorker(coordinator.address, 'k', cache_dir=self.cache_dir,
+                                   poll=0.05) for _ in range(2)]
+            threads = [threading.Thread(target=w.run) for w in workers]
+            for t in threads:
+                t.start()
+            results = coordinator.wait(timeout=60, poll=0.05)
+            for t in threads:
+                t.join(timeout=10)
+        finally:
+            coordinator.close()
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all('final_equity' in r for r in results))
+
+    def test_lost_task_is_requeued(self):
+        cells = expand_sweep(SWEEP)[:1]
+        coordinator = SweepCoordinator(cells, authkey='k', heartbeat_timeout=0.2).start()
+        try:
+            # セルを受け取ったまま応答しなくなるワーカー
+            conn = _Connection(coordinator.address, 'k')
+            reply = conn.call('get', worker='dead')
+            self.assertEqual(reply['task'], 0)
+            worker = SweepWorker(coordinator.address, 'k', cache_dir=self.cache_dir,
+                                 heartbeat_interval=0.05, poll=0.05)
+            thread = threading.Thread(target=worker.run)
+            thread.start()
+            results = coordinator.wait(timeout=30, poll=0.05)
+            thread.join(timeout=10)
+            conn.close()
+        finally:
+            coordinator.close()
+        self.assertIn('final_equity', results[0])
+
+    def test_rejects_wrong_key(self):
+        coordinator = SweepCoordinator(expand_sweep(SWEEP), authkey='k').start()
+        try:
+            conn = _Connection(coordinator.address, 'wrong')
+            with self.assertRaises(RuntimeError):
+                conn.call('get', worker='w')
+            conn.close()
+        finally:
+            coordinator.close()
+
+    def test_node_processes_share_packed_dataset(self):
+        cells = expand_sweep(SWEEP)
+        coordinator = SweepCoordinator(cells, authkey='k').start()
+        try:
+            exitcodes = run_node(coordinator.address, 'k', workers=2,
+                                 cache_dir=self.cache_dir, heartbeat_interval=0.5)
+            results = coordinator.wait(timeout=60, poll=0.05)
+        finally:
+            coordinator.close()
+        self.assertEqual(exitcodes, [0, 0])
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'BTCUSDT_1h.f64')))
+        self.assertTrue(all('final_equity' in r for r in results))
+
+
+if __name__ == '__main__':
+    unittest.main()